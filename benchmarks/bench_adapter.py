@@ -0,0 +1,260 @@
+"""CPU microbenchmarks of the hot paths of the LMCache adapter.
+
+Every case is swept over the batch size, the context length, the number of
+layers and the LMCache chunk size. The KV caches are synthetic, the
+sequence group metadata are fakes and the LMCache engine is an in-memory
+stand-in, see `bench_utils.py`.
+
+Cases:
+    should_store    `lmcache_should_store` of a prefill batch
+    store_kv        `lmcache_store_kv` of a prefill batch that is not cached
+                    (the gather and the queuing, the store itself runs on
+                    the store worker and is not timed)
+    retrieve_kv     `lmcache_retrieve_kv` of a prefill batch whose first
+                    `--hit-ratio` of every prompt is cached
+    rebuild         `build_partial_prefill_input` after such a retrieval
+    broadcast       The payload of `broadcast_seq_group_metadata` for a new
+                    prefill batch, encoded by the driver and decoded by a
+                    worker in the same process (no collective is issued)
+    attach_blend    `attach_blend_prompt_indices` of a prefill batch
+
+Usage:
+    python benchmarks/bench_adapter.py --output results.json
+    python benchmarks/bench_adapter.py --cases store_kv retrieve_kv \\
+        --batch-sizes 1 8 --context-lens 1024 8192 --output new.json
+    python benchmarks/bench_adapter.py --compare old.json new.json
+"""
+import argparse
+import copy
+import itertools
+import json
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List
+
+import torch
+
+from lmcache_vllm.vllm_adapter import (lmcache_should_store, lmcache_store_kv,
+        lmcache_retrieve_kv, build_partial_prefill_input,
+        close_lmcache_engine, get_store_worker, lmcache_free_finished_requests,
+        RetrieveStatus)
+from lmcache_vllm.blend_adapter import attach_blend_prompt_indices
+from lmcache_vllm.metadata_broadcast import SeqMetadataBroadcaster
+
+from bench_utils import (FakeLlamaForCausalLM, InMemoryLMCacheEngine,
+                         install_engine, make_kv_caches,
+                         make_seq_group_metadata_list,
+                         make_prefill_model_input, time_fn, summarize,
+                         write_json)
+from bench_rebuild import make_rebuild_inputs
+
+class Scenario:
+    """The fakes of one point of the sweep, with a fresh engine."""
+    def __init__(self, batch_size: int, context_len: int, num_layers: int,
+                 chunk_size: int, args: argparse.Namespace):
+        self.batch_size = batch_size
+        self.context_len = context_len
+        self.num_layers = num_layers
+        self.chunk_size = chunk_size
+        self.block_size = args.block_size
+        self.hit_ratio = args.hit_ratio
+
+        num_blocks = batch_size * \
+            ((context_len + args.block_size - 1) // args.block_size)
+        self.kv_caches = make_kv_caches(
+            num_layers, num_blocks, args.block_size, args.num_heads,
+            args.head_size, getattr(torch, args.dtype))
+        self.model = FakeLlamaForCausalLM(num_layers)
+        self.cache_config = SimpleNamespace(block_size=args.block_size)
+        self.seq_group_metadata_list = make_seq_group_metadata_list(
+            batch_size, context_len, args.block_size)
+        self.request_ids = [seq_group_metadata.request_id for
+                            seq_group_metadata in self.seq_group_metadata_list]
+        self.model_input = make_prefill_model_input(
+            self.seq_group_metadata_list, args.block_size)
+
+        self.engine = InMemoryLMCacheEngine(chunk_size)
+        install_engine(self.engine)
+
+    def reset(self) -> None:
+        """Forget every stored chunk and every per-request state."""
+        self.engine.engine_.clear()
+        lmcache_free_finished_requests(self.request_ids)
+
+    def close(self) -> None:
+        close_lmcache_engine()
+
+    def store_prefix(self) -> None:
+        """Store the first `hit_ratio` of every prompt, in whole chunks."""
+        hit_len = int(self.context_len * self.hit_ratio) // \
+            self.chunk_size * self.chunk_size
+        for seq_group_metadata in self.seq_group_metadata_list:
+            for seq_data in seq_group_metadata.seq_data.values():
+                tokens = torch.tensor(seq_data.get_token_ids()[:hit_len])
+                kv = torch.randn((self.num_layers, 2, hit_len,
+                                  *self.kv_caches[0].shape[3:])).to(
+                                      self.kv_caches[0].dtype)
+                self.engine.store(tokens, kv)
+
+
+def bench_should_store(scenario: Scenario, iters: int) -> List[float]:
+    return time_fn(
+        lambda: lmcache_should_store(scenario.model_input, scenario.kv_caches),
+        iters)
+
+
+def bench_store_kv(scenario: Scenario, iters: int) -> List[float]:
+    store_status = lmcache_should_store(
+        scenario.model_input, scenario.kv_caches)
+    store_worker = get_store_worker(scenario.engine)
+
+    def setup():
+        store_worker.flush()
+        scenario.reset()
+
+    times = time_fn(
+        lambda: lmcache_store_kv(scenario.model, scenario.model_input,
+                                 scenario.cache_config, scenario.kv_caches,
+                                 store_status),
+        iters, setup=setup)
+    store_worker.flush()
+    return times
+
+
+def bench_retrieve_kv(scenario: Scenario, iters: int) -> List[float]:
+    retrieve_status = [RetrieveStatus.PREFILL] * scenario.batch_size
+    scenario.store_prefix()
+    return time_fn(
+        lambda: lmcache_retrieve_kv(scenario.model, scenario.model_input,
+                                    scenario.kv_caches, retrieve_status),
+        iters)
+
+
+def bench_rebuild(scenario: Scenario, iters: int) -> List[float]:
+    hit_len = int(scenario.context_len * scenario.hit_ratio)
+    kwargs = make_rebuild_inputs(scenario.batch_size, scenario.context_len,
+                                 hit_len, scenario.block_size)
+    return time_fn(lambda: build_partial_prefill_input(**kwargs), iters)
+
+
+def bench_broadcast(scenario: Scenario, iters: int) -> List[float]:
+    broadcasters = []
+
+    def setup():
+        broadcasters[:] = [SeqMetadataBroadcaster(), SeqMetadataBroadcaster()]
+
+    def broadcast():
+        driver, worker = broadcasters
+        payload = torch.tensor(
+            driver.encode(scenario.seq_group_metadata_list), dtype=torch.long)
+        worker.decode(payload.tolist())
+
+    return time_fn(broadcast, iters, setup=setup)
+
+
+def bench_attach_blend(scenario: Scenario, iters: int) -> List[float]:
+    attn_metadata = scenario.model_input.attn_metadata
+    attn_metadata_list = []
+
+    def setup():
+        scenario.reset()
+        attn_metadata_list[:] = [copy.copy(attn_metadata)]
+
+    return time_fn(
+        lambda: attach_blend_prompt_indices(
+            scenario.seq_group_metadata_list, attn_metadata_list[0]),
+        iters, setup=setup)
+
+
+CASES: Dict[str, Callable[[Scenario, int], List[float]]] = {
+    "should_store": bench_should_store,
+    "store_kv": bench_store_kv,
+    "retrieve_kv": bench_retrieve_kv,
+    "rebuild": bench_rebuild,
+    "broadcast": bench_broadcast,
+    "attach_blend": bench_attach_blend,
+}
+
+
+def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    print(f"{'case':>14} {'batch':>6} {'context':>8} {'layers':>7} "
+          f"{'chunk':>6} {'mean (us)':>12} {'median (us)':>12}")
+    for batch_size, context_len, num_layers, chunk_size in itertools.product(
+            args.batch_sizes, args.context_lens, args.num_layers,
+            args.chunk_sizes):
+        scenario = Scenario(batch_size, context_len, num_layers, chunk_size,
+                            args)
+        try:
+            for case in args.cases:
+                scenario.reset()
+                summary = summarize(CASES[case](scenario, args.iters))
+                results.append(dict(
+                    case=case, batch_size=batch_size,
+                    context_len=context_len, num_layers=num_layers,
+                    chunk_size=chunk_size, iters=args.iters, **summary))
+                print(f"{case:>14} {batch_size:>6} {context_len:>8} "
+                      f"{num_layers:>7} {chunk_size:>6} "
+                      f"{summary['mean_us']:>12.1f} "
+                      f"{summary['median_us']:>12.1f}")
+        finally:
+            scenario.close()
+    return results
+
+
+def compare(baseline_path: str, new_path: str) -> None:
+    """Print the median time of every point found in both result files."""
+    def load(path):
+        with open(path) as f:
+            data = json.load(f)
+        return {(r["case"], r["batch_size"], r["context_len"],
+                 r["num_layers"], r["chunk_size"]): r["median_us"]
+                for r in data["results"]}
+
+    baseline = load(baseline_path)
+    new = load(new_path)
+    print(f"{'case':>14} {'batch':>6} {'context':>8} {'layers':>7} "
+          f"{'chunk':>6} {'old (us)':>12} {'new (us)':>12} {'speedup':>8}")
+    for key in sorted(baseline.keys() & new.keys()):
+        case, batch_size, context_len, num_layers, chunk_size = key
+        print(f"{case:>14} {batch_size:>6} {context_len:>8} {num_layers:>7} "
+              f"{chunk_size:>6} {baseline[key]:>12.1f} {new[key]:>12.1f} "
+              f"{baseline[key] / new[key]:>7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cases", nargs="+", choices=list(CASES.keys()),
+                        default=list(CASES.keys()))
+    parser.add_argument("--batch-sizes", type=int, nargs="+",
+                        default=[1, 8, 32])
+    parser.add_argument("--context-lens", type=int, nargs="+",
+                        default=[1024, 4096])
+    parser.add_argument("--num-layers", type=int, nargs="+",
+                        default=[4, 32])
+    parser.add_argument("--chunk-sizes", type=int, nargs="+",
+                        default=[256])
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--head-size", type=int, default=128)
+    parser.add_argument("--dtype", default="float16")
+    parser.add_argument("--hit-ratio", type=float, default=0.75)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--output", help="Write the results to a JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="Compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        compare(*args.compare)
+        return
+
+    results = run(args)
+    if args.output is not None:
+        config = {key: value for key, value in vars(args).items()
+                  if key not in ("output", "compare")}
+        write_json(args.output, results, config)
+        print(f"Results are written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""CPU microbenchmark of `build_partial_prefill_input`.
+
+Rebuilds the model input of a batch of prefills whose leading tokens were
+retrieved from LMCache, and reports the rebuild cost as the batch grows.
+
+Usage:
+    python benchmarks/bench_rebuild.py --batch-sizes 1 4 16 64 --prompt-len 4096
+"""
+import argparse
+import time
+
+import torch
+
+from vllm.model_executor.sampling_metadata import SamplingMetadata
+
+from lmcache_vllm.vllm_adapter import build_partial_prefill_input
+
+from bench_utils import FakeAttentionMetadata
+
+
+def make_rebuild_inputs(batch_size: int, prompt_len: int, hit_len: int,
+                        block_size: int):
+    from vllm.worker.model_runner import ModelInputForGPUWithSamplingMetadata
+
+    num_blocks_per_seq = (prompt_len + block_size - 1) // block_size
+    num_tokens = batch_size * prompt_len
+    block_table_list = [
+        list(range(i * num_blocks_per_seq, (i + 1) * num_blocks_per_seq))
+        for i in range(batch_size)]
+    query_start_loc = torch.arange(0, num_tokens + 1, prompt_len,
+                                   dtype=torch.int32)
+    attn_metadata = FakeAttentionMetadata(
+        num_prefills=batch_size,
+        num_prefill_tokens=num_tokens,
+        num_decode_tokens=0,
+        slot_mapping=torch.arange(num_tokens, dtype=torch.long),
+        seq_lens=[prompt_len] * batch_size,
+        seq_lens_tensor=torch.full((batch_size,), prompt_len, dtype=torch.int),
+        max_query_len=prompt_len,
+        max_prefill_seq_len=prompt_len,
+        max_decode_seq_len=0,
+        query_start_loc=query_start_loc,
+        seq_start_loc=query_start_loc.clone(),
+        context_lens_tensor=torch.zeros(batch_size, dtype=torch.int),
+        block_tables=torch.empty((batch_size, 0), dtype=torch.int),
+    )
+    sampling_metadata = SamplingMetadata(
+        seq_groups=None,
+        selected_token_indices=query_start_loc[1:].long() - 1,
+        categorized_sample_indices={},
+        num_prompts=batch_size,
+    )
+    model_input = ModelInputForGPUWithSamplingMetadata(
+        input_tokens=torch.randint(0, 32000, (num_tokens,)),
+        input_positions=torch.arange(prompt_len).repeat(batch_size),
+        attn_metadata=attn_metadata,
+        sampling_metadata=sampling_metadata,
+        is_prompt=True,
+    )
+    return dict(
+        model_input=model_input,
+        seq_len_list=[prompt_len] * batch_size,
+        num_computed_tokens_list=[hit_len] * batch_size,
+        start_pos_list=[i * prompt_len for i in range(batch_size)],
+        slot_mapping_flat=attn_metadata.slot_mapping,
+        lmc_num_computed_tokens_list=[hit_len] * batch_size,
+        is_prefill_list=[True] * batch_size,
+        do_sample_list=[True] * batch_size,
+        seq_group_idx_list=list(range(batch_size)),
+        seq_group_metadata_list=[],
+        temp_block_table_list=block_table_list,
+        device=torch.device("cpu"),
+    )
+
+
+def bench_rebuild(batch_size: int, prompt_len: int, hit_len: int,
+                  block_size: int, iters: int) -> float:
+    """Return the mean rebuild time in microseconds."""
+    kwargs = make_rebuild_inputs(batch_size, prompt_len, hit_len, block_size)
+    build_partial_prefill_input(**kwargs)
+    start = time.perf_counter()
+    for _ in range(iters):
+        build_partial_prefill_input(**kwargs)
+    return (time.perf_counter() - start) / iters * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-sizes", type=int, nargs="+",
+                        default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument("--prompt-len", type=int, default=2048)
+    parser.add_argument("--hit-ratio", type=float, default=0.75)
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument("--iters", type=int, default=50)
+    args = parser.parse_args()
+
+    hit_len = int(args.prompt_len * args.hit_ratio)
+    print(f"{'batch':>6} {'rebuild (us)':>14} {'per seq (us)':>14}")
+    for batch_size in args.batch_sizes:
+        elapsed = bench_rebuild(batch_size, args.prompt_len, hit_len,
+                                args.block_size, args.iters)
+        print(f"{batch_size:>6} {elapsed:>14.1f} {elapsed / batch_size:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+"""Shared fakes and helpers of the CPU microbenchmarks.
+
+The fakes only carry what the LMCache adapter reads: synthetic paged KV
+caches, sequence group metadata, the attention metadata of a prefill batch,
+a model with the Llama module layout, and an in-memory stand-in of the
+LMCache engine registered under the adapter's engine name.
+"""
+import hashlib
+import json
+import platform
+import statistics
+import time
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+from torch import nn
+
+from lmcache.cache_engine import LMCacheEngineBuilder
+
+from lmcache_vllm.lmcache_utils import ENGINE_NAME
+from lmcache_vllm.model_layout import LLAMA_LAYOUT, register_model_layout
+from lmcache_vllm.metadata_broadcast import (BroadcastSeqData,
+                                             BroadcastSeqGroupMetadata)
+
+
+@dataclass
+class FakeAttentionMetadata:
+    """The attention metadata fields read and rebuilt by LMCache."""
+    num_prefills: int
+    num_prefill_tokens: int
+    num_decode_tokens: int
+    slot_mapping: torch.Tensor
+    seq_lens: List[int]
+    seq_lens_tensor: torch.Tensor
+    max_query_len: int
+    max_prefill_seq_len: int
+    max_decode_seq_len: int
+    query_start_loc: torch.Tensor
+    seq_start_loc: torch.Tensor
+    context_lens_tensor: torch.Tensor
+    block_tables: torch.Tensor
+    use_cuda_graph: bool = False
+    _cached_prefill_metadata: Optional[Any] = None
+    _cached_decode_metadata: Optional[Any] = None
+
+    @property
+    def prefill_metadata(self) -> Optional["FakeAttentionMetadata"]:
+        return self if self.num_prefills > 0 else None
+
+
+class FakeAttention(nn.Module):
+    """The fields of vLLM's `Attention` used to inject KV."""
+    def __init__(self):
+        super().__init__()
+        self.kv_cache_dtype = "auto"
+        self._k_scale = 1.0
+        self._v_scale = 1.0
+
+
+class FakeSelfAttention(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.attn = FakeAttention()
+
+
+class FakeDecoderLayer(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.self_attn = FakeSelfAttention()
+
+
+class FakeLlamaModel(nn.Module):
+    def __init__(self, num_layers: int):
+        super().__init__()
+        self.layers = nn.ModuleList(
+            [FakeDecoderLayer() for _ in range(num_layers)])
+        self.start_layer = 0
+        self.end_layer = num_layers
+
+
+class FakeLlamaForCausalLM(nn.Module):
+    """A model without weights that has the module layout of vLLM's
+    `LlamaForCausalLM`."""
+    def __init__(self, num_layers: int):
+        super().__init__()
+        self.model = FakeLlamaModel(num_layers)
+
+
+register_model_layout("FakeLlamaForCausalLM", LLAMA_LAYOUT)
+
+
+class InMemoryBackend:
+    """A dict of KV chunks with the interface of an LMCache storage backend."""
+    def __init__(self):
+        self.dict: Dict[str, torch.Tensor] = {}
+
+    def contains(self, key: str) -> bool:
+        return key in self.dict
+
+    def put(self, key: str, kv_chunk: torch.Tensor,
+            blocking: bool = True) -> None:
+        self.dict[key] = kv_chunk
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        return self.dict.get(key)
+
+    def clear(self) -> None:
+        self.dict.clear()
+
+    def close(self) -> None:
+        self.clear()
+
+
+class InMemoryLMCacheEngine:
+    """A local stand-in of `LMCacheEngine`.
+
+    KV is stored per chunk, under the rolling prefix hash of the chunk, as
+    blobs shaped [num_layers, 2, num_tokens, num_heads, head_size] like the
+    real engine. Only the methods and fields used by the adapter exist, so
+    the benchmarks measure the adapter rather than a storage backend.
+    """
+    def __init__(self, chunk_size: int, save_decode_cache: bool = False):
+        self.chunk_size = chunk_size
+        self.save_decode_cache = save_decode_cache
+        self.config = SimpleNamespace(enable_blending=False)
+        self.metadata = SimpleNamespace(fmt="vllm")
+        self.engine_ = InMemoryBackend()
+
+    def _get_init_hash(self) -> str:
+        return ""
+
+    def _hash(self, tokens: torch.Tensor, prefix_hash: str) -> str:
+        hasher = hashlib.sha256()
+        hasher.update(prefix_hash.encode("ascii"))
+        hasher.update(tokens.cpu().numpy().tobytes())
+        return hasher.hexdigest()
+
+    def _make_key(self, chunk_hash: str, fmt: str) -> str:
+        return f"{fmt}@{chunk_hash}"
+
+    def _chunk_keys(self, tokens: torch.Tensor) -> List[Tuple[int, int, str]]:
+        keys = []
+        prefix_hash = self._get_init_hash()
+        for start in range(0, len(tokens), self.chunk_size):
+            end = min(start + self.chunk_size, len(tokens))
+            prefix_hash = self._hash(tokens[start:end], prefix_hash)
+            keys.append((start, end, self._make_key(prefix_hash, "vllm")))
+        return keys
+
+    def lookup(self, tokens: torch.Tensor) -> int:
+        num_hit = 0
+        for _, end, key in self._chunk_keys(tokens):
+            if not self.engine_.contains(key):
+                break
+            num_hit = end
+        return num_hit
+
+    def store(self, tokens: torch.Tensor, kv_tensors: torch.Tensor,
+              mask: Optional[torch.Tensor] = None,
+              skip_existing: bool = True, blocking: bool = True) -> None:
+        num_skipped = 0 if mask is None else int((~mask).sum())
+        for start, end, key in self._chunk_keys(tokens):
+            if end <= num_skipped:
+                continue
+            if skip_existing and self.engine_.contains(key):
+                continue
+            # The KV of the masked tokens is not in the blob
+            self.engine_.put(key, kv_tensors[:, :, start - num_skipped:
+                                             end - num_skipped].clone())
+
+    def retrieve(self, tokens: torch.Tensor,
+                 mask: Optional[torch.Tensor] = None):
+        num_skipped = 0 if mask is None else int((~mask).sum())
+        ret_mask = torch.zeros_like(tokens, dtype=torch.bool)
+        chunks = []
+        for start, end, key in self._chunk_keys(tokens):
+            kv_chunk = self.engine_.get(key)
+            if kv_chunk is None:
+                break
+            if end > num_skipped:
+                chunks.append(kv_chunk[:, :, max(num_skipped - start, 0):])
+                ret_mask[max(start, num_skipped):end] = True
+        if len(chunks) == 0:
+            return (), ret_mask
+        kv = torch.cat(chunks, dim=2)
+        return tuple((kv[i, 0], kv[i, 1]) for i in range(kv.shape[0])), \
+            ret_mask
+
+    def close(self) -> None:
+        self.engine_.close()
+
+
+def install_engine(engine: InMemoryLMCacheEngine) -> None:
+    """Register `engine` as the engine of the adapter. It is removed by
+    `close_lmcache_engine`."""
+    LMCacheEngineBuilder._instances[ENGINE_NAME] = engine
+
+
+def make_kv_caches(
+        num_layers: int,
+        num_blocks: int,
+        block_size: int,
+        num_heads: int,
+        head_size: int,
+        dtype: torch.dtype = torch.float16,
+        device: str = "cpu",
+    ) -> List[torch.Tensor]:
+    """Paged KV caches shaped [2, num_blocks, block_size, num_heads,
+    head_size], one per layer."""
+    return [torch.randn((2, num_blocks, block_size, num_heads, head_size),
+                        dtype=torch.float32, device=device).to(dtype)
+            for _ in range(num_layers)]
+
+
+def make_seq_group_metadata_list(
+        batch_size: int,
+        context_len: int,
+        block_size: int,
+        vocab_size: int = 32000,
+        request_prefix: str = "req",
+    ) -> List[BroadcastSeqGroupMetadata]:
+    """One prompt group of `context_len` random tokens per sequence. The
+    sequence `i` owns the blocks [i * num_blocks_per_seq, (i + 1) *
+    num_blocks_per_seq)."""
+    num_blocks_per_seq = (context_len + block_size - 1) // block_size
+    seq_group_metadata_list = []
+    for seq_id in range(batch_size):
+        seq_data = BroadcastSeqData()
+        seq_data.token_ids = torch.randint(
+            0, vocab_size, (context_len,)).tolist()
+        seq_group_metadata_list.append(BroadcastSeqGroupMetadata(
+            request_id=f"{request_prefix}-{seq_id}",
+            seq_data={seq_id: seq_data},
+            block_tables={seq_id: list(range(
+                seq_id * num_blocks_per_seq,
+                (seq_id + 1) * num_blocks_per_seq))},
+        ))
+    return seq_group_metadata_list
+
+
+def make_prefill_model_input(
+        seq_group_metadata_list: List[BroadcastSeqGroupMetadata],
+        block_size: int,
+    ):
+    """The model input of a batch of full prefills of the given groups."""
+    from vllm.model_executor.sampling_metadata import SamplingMetadata
+    from vllm.worker.model_runner import ModelInputForGPUWithSamplingMetadata
+
+    seq_lens = []
+    slot_mapping = []
+    input_tokens = []
+    input_positions = []
+    request_ids_to_seq_ids = {}
+    for seq_group_metadata in seq_group_metadata_list:
+        request_ids_to_seq_ids[seq_group_metadata.request_id] = \
+            list(seq_group_metadata.seq_data.keys())
+        for seq_id, seq_data in seq_group_metadata.seq_data.items():
+            seq_len = seq_data.get_len()
+            block_table = torch.tensor(
+                seq_group_metadata.block_tables[seq_id], dtype=torch.long)
+            positions = torch.arange(seq_len)
+            seq_lens.append(seq_len)
+            input_tokens.append(torch.tensor(seq_data.get_token_ids()))
+            input_positions.append(positions)
+            slot_mapping.append(block_table[positions // block_size] * \
+                block_size + positions % block_size)
+
+    batch_size = len(seq_lens)
+    query_start_loc = torch.zeros(batch_size + 1, dtype=torch.int32)
+    query_start_loc[1:] = torch.cumsum(torch.tensor(seq_lens), 0)
+    num_tokens = sum(seq_lens)
+    attn_metadata = FakeAttentionMetadata(
+        num_prefills=batch_size,
+        num_prefill_tokens=num_tokens,
+        num_decode_tokens=0,
+        slot_mapping=torch.cat(slot_mapping),
+        seq_lens=seq_lens,
+        seq_lens_tensor=torch.tensor(seq_lens, dtype=torch.int),
+        max_query_len=max(seq_lens),
+        max_prefill_seq_len=max(seq_lens),
+        max_decode_seq_len=0,
+        query_start_loc=query_start_loc,
+        seq_start_loc=query_start_loc.clone(),
+        context_lens_tensor=torch.zeros(batch_size, dtype=torch.int),
+        block_tables=torch.empty((batch_size, 0), dtype=torch.int),
+    )
+    sampling_metadata = SamplingMetadata(
+        seq_groups=None,
+        selected_token_indices=query_start_loc[1:].long() - 1,
+        categorized_sample_indices={},
+        num_prompts=batch_size,
+    )
+    return ModelInputForGPUWithSamplingMetadata(
+        input_tokens=torch.cat(input_tokens),
+        input_positions=torch.cat(input_positions),
+        attn_metadata=attn_metadata,
+        sampling_metadata=sampling_metadata,
+        request_ids_to_seq_ids=request_ids_to_seq_ids,
+        seq_group_metadata_list=seq_group_metadata_list,
+        is_prompt=True,
+    )
+
+
+def time_fn(
+        fn: Callable[[], Any],
+        iters: int,
+        warmup: int = 1,
+        setup: Optional[Callable[[], None]] = None,
+    ) -> List[float]:
+    """Time `fn` over `iters` iterations after `warmup` ones. `setup` runs
+    before every call and is not timed.
+
+    :return: The time of each iteration in microseconds.
+    """
+    times = []
+    for i in range(warmup + iters):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            times.append(elapsed * 1e6)
+    return times
+
+
+def summarize(times: List[float]) -> Dict[str, float]:
+    return {
+        "mean_us": statistics.fmean(times),
+        "median_us": statistics.median(times),
+        "min_us": min(times),
+        "stdev_us": statistics.stdev(times) if len(times) > 1 else 0.0,
+    }
+
+
+def get_environment() -> Dict[str, str]:
+    """The versions the results were measured with."""
+    import lmcache_vllm
+    import vllm
+    environment = {
+        "lmcache_vllm": lmcache_vllm.__version__,
+        "vllm": vllm.__version__,
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "num_threads": str(torch.get_num_threads()),
+    }
+    try:
+        from importlib.metadata import version
+        environment["lmcache"] = version("lmcache")
+    except Exception:
+        pass
+    return environment
+
+
+def write_json(path: str, results: List[Dict[str, Any]],
+               config: Dict[str, Any]) -> None:
+    with open(path, "w") as f:
+        json.dump({
+            "environment": get_environment(),
+            "config": config,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results,
+        }, f, indent=2)
@@ -0,0 +1,420 @@
+import hashlib
+import threading
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from lmcache.logging import init_logger
+from lmcache_vllm.metrics import get_metrics
+from lmcache_vllm.prefix_memo import PrefixHashMemo
+
+logger = init_logger(__name__)
+
+
+class AdmissionDecision(Enum):
+    FULL = 1
+    PARTIAL = 2
+    REJECT = 3
+
+
+class BackendCostModel:
+    """Estimates the time of a retrieval from one backend as
+    `latency + num_bytes / bandwidth`.
+
+    The two parameters are fitted by least squares over the observed
+    (bytes, seconds) pairs with exponential forgetting, so the model follows
+    changes of the backend (e.g., a congested network).
+    """
+    def __init__(self, decay: float = 0.95):
+        self.decay = decay
+        self.num_samples = 0
+        self._w = 0.0
+        self._x = 0.0
+        self._y = 0.0
+        self._xx = 0.0
+        self._xy = 0.0
+
+    def observe(self, num_bytes: float, seconds: float) -> None:
+        d = self.decay
+        self._w = d * self._w + 1.0
+        self._x = d * self._x + num_bytes
+        self._y = d * self._y + seconds
+        self._xx = d * self._xx + num_bytes * num_bytes
+        self._xy = d * self._xy + num_bytes * seconds
+        self.num_samples += 1
+
+    def params(self) -> Tuple[float, float]:
+        """Get (latency in seconds, seconds per byte).
+        """
+        if self._w == 0.0:
+            return 0.0, 0.0
+        mean_x = self._x / self._w
+        mean_y = self._y / self._w
+        var_x = self._xx / self._w - mean_x * mean_x
+        if var_x <= 1e-12 * max(mean_x * mean_x, 1.0):
+            # All the retrievals have about the same size, so latency and
+            # bandwidth cannot be told apart. Charge everything to bandwidth.
+            return 0.0, mean_y / mean_x if mean_x > 0 else 0.0
+        slope = (self._xy / self._w - mean_x * mean_y) / var_x
+        slope = max(slope, 0.0)
+        latency = max(mean_y - slope * mean_x, 0.0)
+        return latency, slope
+
+    def estimate(self, num_bytes: float) -> float:
+        latency, seconds_per_byte = self.params()
+        return latency + num_bytes * seconds_per_byte
+
+
+class _PendingPrefillTiming:
+    def __init__(self, num_tokens: int, start, end=None):
+        self.num_tokens = num_tokens
+        self.start = start
+        self.end = end
+
+
+@dataclass
+class RetrievalPlan:
+    """The admission decision of one retrieval.
+
+    :ivar AdmissionDecision decision: Retrieve all, part or none of the hit.
+    :ivar int end: Retrieve the tokens up to this position.
+    :ivar float estimated_saving: The estimated time saved in seconds.
+    """
+    decision: AdmissionDecision
+    end: int
+    estimated_saving: float = 0.0
+
+
+class RetrievalAdmissionController:
+    """Decides whether retrieving a hit from LMCache is faster than
+    recomputing it.
+
+    It keeps a cost model of every backend, updated with the measured size
+    and time of each retrieval, and a calibrated prefill cost per token,
+    updated with the measured time of prefill-only forward passes. A hit is
+    retrieved fully if loading it is cheaper than recomputing it, and
+    rejected otherwise. If loading it exceeds the latency budget, only the
+    leading chunks that fit into the budget are retrieved.
+
+    Until both the backend and the prefill cost have been measured
+    `min_samples` times, every hit is retrieved fully.
+    """
+    def __init__(
+            self,
+            chunk_size: int,
+            prefill_cost_per_token: float = 0.0,
+            latency_budget: float = 0.0,
+            min_samples: int = 3,
+            ewma_alpha: float = 0.1,
+        ):
+        self.chunk_size = chunk_size
+        self.prefill_cost_per_token = prefill_cost_per_token
+        self.latency_budget = latency_budget
+        self.min_samples = min_samples
+        self.ewma_alpha = ewma_alpha
+        self.num_prefill_samples = min_samples \
+            if prefill_cost_per_token > 0 else 0
+        self.backends: Dict[str, BackendCostModel] = {}
+        self._lock = threading.Lock()
+        self._pending_timings: List[_PendingPrefillTiming] = []
+        self._current_timing: Optional[_PendingPrefillTiming] = None
+
+        metrics = get_metrics()
+        self._decision_counters = {
+            AdmissionDecision.FULL: metrics.counter(
+                "lmcache:retrieve_admission_full",
+                "Number of hits retrieved fully"),
+            AdmissionDecision.PARTIAL: metrics.counter(
+                "lmcache:retrieve_admission_partial",
+                "Number of hits retrieved partially"),
+            AdmissionDecision.REJECT: metrics.counter(
+                "lmcache:retrieve_admission_rejected",
+                "Number of hits recomputed instead of retrieved"),
+        }
+        self._saving_counter = metrics.counter(
+            "lmcache:retrieve_admission_estimated_saving_seconds",
+            "Estimated prefill time saved by the admitted retrievals")
+        self._rejected_tokens_counter = metrics.counter(
+            "lmcache:retrieve_admission_rejected_tokens",
+            "Number of hit tokens recomputed instead of retrieved")
+
+    def _backend(self, backend_name: str) -> BackendCostModel:
+        model = self.backends.get(backend_name)
+        if model is None:
+            model = BackendCostModel()
+            self.backends[backend_name] = model
+        return model
+
+    def observe_retrieval(
+            self,
+            backend_name: str,
+            num_bytes: int,
+            seconds: float,
+        ) -> None:
+        """Record the size and the time of a retrieval. It may be called
+        from the retrieval threads.
+        """
+        if num_bytes > 0:
+            with self._lock:
+                self._backend(backend_name).observe(num_bytes, seconds)
+
+    def observe_prefill(self, num_tokens: int, seconds: float) -> None:
+        """Record the time of a prefill-only forward pass.
+        """
+        if num_tokens <= 0 or seconds <= 0:
+            return
+        cost = seconds / num_tokens
+        if self.num_prefill_samples == 0:
+            self.prefill_cost_per_token = cost
+        else:
+            self.prefill_cost_per_token += \
+                self.ewma_alpha * (cost - self.prefill_cost_per_token)
+        self.num_prefill_samples += 1
+
+    def begin_forward(self, num_prefill_tokens: int,
+                      device: torch.device) -> None:
+        """Start timing a forward pass with `num_prefill_tokens` prefill
+        tokens (and no decode), with CUDA events on GPU so the time is read
+        later without synchronizing.
+        """
+        self._poll_timings()
+        if num_prefill_tokens <= 0:
+            return
+        if device.type == "cuda":
+            start = torch.cuda.Event(enable_timing=True)
+            start.record()
+        else:
+            start = time.perf_counter()
+        self._current_timing = _PendingPrefillTiming(num_prefill_tokens, start)
+
+    def end_forward(self) -> None:
+        timing = self._current_timing
+        self._current_timing = None
+        if timing is None:
+            return
+        if isinstance(timing.start, float):
+            self.observe_prefill(timing.num_tokens,
+                                 time.perf_counter() - timing.start)
+            return
+        timing.end = torch.cuda.Event(enable_timing=True)
+        timing.end.record()
+        self._pending_timings.append(timing)
+
+    def _poll_timings(self) -> None:
+        while len(self._pending_timings) > 0 and \
+                self._pending_timings[0].end.query():
+            timing = self._pending_timings.pop(0)
+            self.observe_prefill(
+                timing.num_tokens,
+                timing.start.elapsed_time(timing.end) / 1000)
+
+    def plan(
+            self,
+            backend_name: str,
+            start: int,
+            hit_end: int,
+            bytes_per_token: int,
+        ) -> RetrievalPlan:
+        """Decide how much of a hit to retrieve.
+
+        :param backend_name: The backend the hit is retrieved from.
+        :type backend_name: str
+
+        :param start: The first token that is not computed yet.
+        :type start: int
+
+        :param hit_end: The end of the hit in LMCache.
+        :type hit_end: int
+
+        :param bytes_per_token: The size of the KV of a token in all layers.
+        :type bytes_per_token: int
+
+        :return: The plan of the retrieval.
+        :rtype: RetrievalPlan
+        """
+        num_hit_tokens = hit_end - start
+        backend = self.backends.get(backend_name)
+        if num_hit_tokens <= 0:
+            return RetrievalPlan(AdmissionDecision.REJECT, start)
+        if backend is None or backend.num_samples < self.min_samples or \
+                self.num_prefill_samples < self.min_samples:
+            self._decision_counters[AdmissionDecision.FULL].inc()
+            return RetrievalPlan(AdmissionDecision.FULL, hit_end)
+
+        with self._lock:
+            latency, seconds_per_byte = backend.params()
+        load_time = latency + num_hit_tokens * bytes_per_token * seconds_per_byte
+        recompute_time = num_hit_tokens * self.prefill_cost_per_token
+        if load_time >= recompute_time:
+            self._decision_counters[AdmissionDecision.REJECT].inc()
+            self._rejected_tokens_counter.inc(num_hit_tokens)
+            return RetrievalPlan(AdmissionDecision.REJECT, start)
+
+        plan = RetrievalPlan(AdmissionDecision.FULL, hit_end,
+                             recompute_time - load_time)
+        if self.latency_budget > 0 and load_time > self.latency_budget:
+            # Retrieve the leading chunks that can be loaded in the budget
+            num_tokens = int((self.latency_budget - latency) /
+                             max(seconds_per_byte * bytes_per_token, 1e-12))
+            end = (start + max(num_tokens, 0)) // self.chunk_size * self.chunk_size
+            if end <= start:
+                self._decision_counters[AdmissionDecision.REJECT].inc()
+                self._rejected_tokens_counter.inc(num_hit_tokens)
+                return RetrievalPlan(AdmissionDecision.REJECT, start)
+            num_admitted = end - start
+            plan = RetrievalPlan(
+                AdmissionDecision.PARTIAL, end,
+                num_admitted * self.prefill_cost_per_token - latency -
+                num_admitted * bytes_per_token * seconds_per_byte)
+            self._rejected_tokens_counter.inc(hit_end - end)
+
+        self._decision_counters[plan.decision].inc()
+        self._saving_counter.inc(plan.estimated_saving)
+        return plan
+
+
+class CountMinSketch:
+    """A count-min sketch of small saturating counters with periodic aging,
+    as used by TinyLFU.
+
+    After `sample_size` increments all the counters are halved, so the
+    counts reflect recent popularity rather than all-time popularity.
+
+    The counter of a key in each row is derived from a digest of the key,
+    not from Python's randomized `hash`. Every process, e.g., every
+    tensor-parallel worker, therefore sees the same collisions and makes
+    the same decisions.
+    """
+    def __init__(
+            self,
+            width: int = 65536,
+            depth: int = 4,
+            max_count: int = 15,
+            sample_size: Optional[int] = None,
+        ):
+        self.width = width
+        self.depth = depth
+        self.max_count = max_count
+        self.sample_size = sample_size if sample_size is not None \
+            else 10 * width
+        self.num_increments = 0
+        self._tables = np.zeros((depth, width), dtype=np.uint8)
+        self._rows = np.arange(depth)
+
+    def _indices(self, key: str) -> np.ndarray:
+        digest = hashlib.blake2b(key.encode("utf-8"),
+                                 digest_size=4 * self.depth).digest()
+        return np.frombuffer(digest, dtype=np.uint32) % self.width
+
+    def estimate(self, key: str) -> int:
+        return int(self._tables[self._rows, self._indices(key)].min())
+
+    def increment(self, key: str) -> int:
+        """Count a sighting of `key` and return its new estimated count.
+        """
+        indices = self._indices(key)
+        counters = self._tables[self._rows, indices]
+        count = int(counters.min())
+        if count < self.max_count:
+            # Conservative update: only raise the counters at the minimum
+            at_min = counters == count
+            self._tables[self._rows[at_min], indices[at_min]] = count + 1
+            count += 1
+
+        self.num_increments += 1
+        if self.num_increments >= self.sample_size:
+            self._age()
+        return count
+
+    def _age(self) -> None:
+        self._tables >>= 1
+        self.num_increments //= 2
+
+
+class StoreAdmissionFilter:
+    """Admits the chunks of a prefill into LMCache only when they are seen
+    often enough, so one-off prompts do not take store bandwidth and cache
+    capacity from popular prefixes.
+
+    Every chunk of a sequence is counted once in a count-min sketch, keyed
+    by its rolling prefix hash, and stored if its count reaches `threshold`
+    (2 means "on the second sighting"). As a chunk key depends on all the
+    chunks before it, only the leading admitted chunks are stored.
+    """
+    def __init__(self, sketch: CountMinSketch, threshold: int = 2):
+        self.sketch = sketch
+        self.threshold = threshold
+
+        metrics = get_metrics()
+        self._admitted_counter = metrics.counter(
+            "lmcache:store_admission_admitted_chunks",
+            "Number of chunks admitted into LMCache")
+        self._rejected_counter = metrics.counter(
+            "lmcache:store_admission_rejected_chunks",
+            "Number of chunks not stored by the store admission")
+
+    def _count(self, key: str, is_new_sighting: bool) -> int:
+        if is_new_sighting:
+            return self.sketch.increment(key)
+        return self.sketch.estimate(key)
+
+    def admit(
+            self,
+            prefix_memo: PrefixHashMemo,
+            seq_id: int,
+            request_id: str,
+            tokens: torch.Tensor,
+            start: int,
+        ) -> int:
+        """Count the chunks of `tokens` from `start` and decide how many of
+        them to store.
+
+        :param prefix_memo: The memo holding the chunk hashes of the sequence.
+        :type prefix_memo: PrefixHashMemo
+
+        :param tokens: The tokens of the sequence to be stored.
+        :type tokens: torch.Tensor
+
+        :param start: The number of leading tokens already in LMCache, a
+            multiple of the chunk size.
+        :type start: int
+
+        :return: The end of the admitted tokens.
+        :rtype: int
+        """
+        chunk_size = prefix_memo.chunk_size
+        state = prefix_memo.get_state(seq_id, request_id)
+        hashes = prefix_memo.chunk_hashes(seq_id, tokens)
+        num_sighted_chunks = state.sighted_len // chunk_size
+        num_tokens = len(tokens)
+
+        # Every chunk is counted, including the ones after a chunk that is
+        # not admitted yet, since this sequence will not count them again
+        counts = [self._count(hashes[chunk_idx],
+                              chunk_idx >= num_sighted_chunks)
+                  for chunk_idx in range(start // chunk_size, len(hashes))]
+        # The trailing partial chunk is hashed like LMCache does
+        num_full_tokens = len(hashes) * chunk_size
+        if num_full_tokens < num_tokens:
+            prefix_hash = hashes[-1] if len(hashes) > 0 \
+                else prefix_memo.init_hash
+            key = prefix_memo.hash_fn(tokens[num_full_tokens:], prefix_hash)
+            counts.append(self._count(key, num_tokens > state.sighted_len))
+
+        # Only the leading admitted chunks can be found by a lookup
+        end = start
+        for count in counts:
+            if count < self.threshold:
+                break
+            end = min(end + chunk_size, num_tokens)
+
+        state.sighted_len = max(state.sighted_len, num_tokens)
+        num_admitted_chunks = (end - start + chunk_size - 1) // chunk_size
+        num_chunks = (num_tokens - start + chunk_size - 1) // chunk_size
+        self._admitted_counter.inc(num_admitted_chunks)
+        self._rejected_counter.inc(num_chunks - num_admitted_chunks)
+        return end
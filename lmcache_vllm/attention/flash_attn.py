@@ -200,5 +200,9 @@ def flash_attn_forward_for_cacheblend(
     return output.view(num_tokens, hidden_size)
 
 def inject_flash_attn():
-    import vllm.attention.backends.flash_attn
+    try:
+        import vllm.attention.backends.flash_attn
+    except ImportError:
+        # e.g., on cpu or on GPUs without flash-attn, see torch_sdpa
+        return
     vllm.attention.backends.flash_attn.FlashAttentionImpl.forward = flash_attn_forward_for_cacheblend
@@ -0,0 +1,171 @@
+import importlib
+from typing import Callable, Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+
+from vllm.attention.backends.abstract import AttentionType
+
+from lmcache.logging import init_logger
+
+logger = init_logger(__name__)
+
+# The vLLM backends without flash-attn that get the CacheBlend forward, by
+# module and implementation class. Both keep KV in the PagedAttention layout.
+SDPA_BLEND_BACKENDS = [
+    ("vllm.attention.backends.torch_sdpa", "TorchSDPABackendImpl"),
+    ("vllm.attention.backends.xformers", "XFormersImpl"),
+]
+
+# The original forward of each injected implementation class
+_original_forwards: Dict[type, Callable] = {}
+
+
+def seq_lens_to_start_loc(seq_lens: List[int],
+                          device: torch.device) -> torch.Tensor:
+    """Get the start location of every sequence in the flattened tokens,
+    with a trailing total, like `seq_start_loc`.
+    """
+    start_loc = torch.zeros(len(seq_lens) + 1, dtype=torch.int32)
+    start_loc[1:] = torch.cumsum(torch.tensor(seq_lens), dim=0)
+    return start_loc.to(device)
+
+
+def blend_sdpa_attention(
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        query_start_loc: List[int],
+        seq_start_loc: List[int],
+        query_positions: torch.Tensor,
+        scale: float,
+    ) -> torch.Tensor:
+    """Attention of a CacheBlend prefill, where only the selected tokens of
+    every sequence have a query but all of its tokens have KV.
+
+    A query attends to the keys up to its own position in the sequence.
+
+    :param query: [num_selected_tokens, num_heads, head_size].
+    :param key: [num_tokens, num_heads, head_size], with the KV heads
+        already repeated for the query heads.
+    :param value: Same shape as `key`.
+    :param query_start_loc: The start of every sequence in `query`.
+    :param seq_start_loc: The start of every sequence in `key` and `value`.
+    :param query_positions: The position of every query in its sequence.
+    :param scale: The softmax scale.
+
+    :return: [num_selected_tokens, num_heads, head_size].
+    """
+    output = torch.empty_like(query)
+    for i in range(len(query_start_loc) - 1):
+        q_start, q_end = query_start_loc[i], query_start_loc[i + 1]
+        kv_start, kv_end = seq_start_loc[i], seq_start_loc[i + 1]
+        if q_end == q_start:
+            continue
+        key_positions = torch.arange(kv_end - kv_start,
+                                     device=query_positions.device)
+        attn_mask = key_positions[None, :] <= \
+            query_positions[q_start:q_end, None]
+        # [num_heads, num_tokens, head_size]
+        seq_output = F.scaled_dot_product_attention(
+            query[q_start:q_end].transpose(0, 1),
+            key[kv_start:kv_end].transpose(0, 1),
+            value[kv_start:kv_end].transpose(0, 1),
+            attn_mask=attn_mask,
+            scale=scale,
+        )
+        output[q_start:q_end] = seq_output.transpose(0, 1)
+    return output
+
+
+def make_sdpa_forward_for_cacheblend(paged_attention) -> Callable:
+    def sdpa_forward_for_cacheblend(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        kv_cache: Optional[torch.Tensor],
+        attn_metadata,
+        k_scale: float = 1.0,
+        v_scale: float = 1.0,
+        attn_type: AttentionType = AttentionType.DECODER,
+    ) -> torch.Tensor:
+        """Forward pass of the backend, with the CacheBlend prefill (fewer
+        queries than keys) computed by torch SDPA.
+
+        Args:
+            query: shape = [num_tokens, num_heads * head_size]
+            key: shape = [num_kv_tokens, num_kv_heads * head_size]
+            value: shape = [num_kv_tokens, num_kv_heads * head_size]
+            kv_cache: PagedAttention layout, [2, num_blocks,
+                block_size * num_kv_heads * head_size]
+            attn_metadata: Metadata for attention.
+        Returns:
+            shape = [num_tokens, num_heads * head_size]
+        """
+        if key.shape[0] <= query.shape[0]:
+            return _original_forwards[type(self)](
+                self, query, key, value, kv_cache, attn_metadata,
+                k_scale, v_scale, attn_type)
+
+        # Injection for CacheBlend
+        if attn_type != AttentionType.DECODER:
+            raise NotImplementedError("CacheBlend only supports decoder "
+                                      "self-attention")
+        if getattr(self, "alibi_slopes", None) is not None or \
+                getattr(self, "sliding_window", None) is not None:
+            raise NotImplementedError("CacheBlend does not support ALiBi or "
+                                      "sliding window attention")
+
+        num_tokens, hidden_size = query.shape
+        query = query.view(-1, self.num_heads, self.head_size)
+        key = key.view(-1, self.num_kv_heads, self.head_size)
+        value = value.view(-1, self.num_kv_heads, self.head_size)
+
+        if kv_cache is not None and kv_cache.numel() > 0:
+            key_cache, value_cache = paged_attention.split_kv_cache(
+                kv_cache, self.num_kv_heads, self.head_size)
+            paged_attention.write_to_paged_cache(
+                key, value, key_cache, value_cache,
+                attn_metadata.slot_mapping.flatten(), self.kv_cache_dtype,
+                k_scale, v_scale)
+
+        num_queries_per_kv = self.num_heads // self.num_kv_heads
+        if num_queries_per_kv > 1:
+            key = key.repeat_interleave(num_queries_per_kv, dim=1)
+            value = value.repeat_interleave(num_queries_per_kv, dim=1)
+
+        # NOTE: a CacheBlend prefill has no context, so the KV of every
+        # sequence is all of its tokens
+        seq_start_loc = getattr(attn_metadata, "seq_start_loc", None)
+        if seq_start_loc is None:
+            seq_start_loc = seq_lens_to_start_loc(attn_metadata.seq_lens,
+                                                  key.device)
+        assert seq_start_loc[-1] == key.shape[0]
+
+        output = blend_sdpa_attention(
+            query, key, value,
+            attn_metadata.query_start_loc.tolist(),
+            seq_start_loc.tolist(),
+            attn_metadata.blend_metadata.positions.to(query.device),
+            self.scale)
+        return output.view(num_tokens, hidden_size)
+        # End of injection
+    return sdpa_forward_for_cacheblend
+
+
+def inject_sdpa_attn() -> None:
+    """Inject the CacheBlend forward into the attention backends without
+    flash-attn that can be imported.
+    """
+    for module_name, impl_name in SDPA_BLEND_BACKENDS:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError as e:
+            logger.debug(f"Skipping CacheBlend for {module_name}: {e}")
+            continue
+        impl = getattr(module, impl_name)
+        if impl in _original_forwards:
+            continue
+        _original_forwards[impl] = impl.forward
+        impl.forward = make_sdpa_forward_for_cacheblend(module.PagedAttention)
@@ -11,6 +11,10 @@ from lmcache.logging import init_logger
 from vllm.attention import AttentionMetadata
 from vllm.sequence import SequenceGroupMetadata
 from lmcache_vllm.lmcache_utils import ENGINE_NAME
+from lmcache_vllm.token_cache import get_token_cache
+from lmcache_vllm.metrics import get_metrics, RATIO_BUCKETS
+from lmcache_vllm.tracing import trace_span
+from lmcache_vllm.attention.torch_sdpa import seq_lens_to_start_loc
 
 logger = init_logger(__name__)
 
@@ -235,6 +239,7 @@ def attach_blend_prompt_indices(
     blend_metadata = BlendMetadata(0, None, None, None, [], [], None, None)
     setattr(attn_metadata, "blend_metadata", blend_metadata)
     seq_lens = attn_metadata.seq_lens
+    token_cache = get_token_cache()
     seq_data_idx = 0
     for seq_group_metadata in seq_group_metadata_list:
         for seqid, seq_data in seq_group_metadata.seq_data.items():
@@ -243,8 +248,9 @@ def attach_blend_prompt_indices(
                 indices = get_blend_indices(seq_group_metadata.request_id)
             else:
                 indices = []
-            attn_metadata.blend_metadata.request_prompt_list.append(torch.tensor(
-                seq_data.get_token_ids()[:seq_len], device="cpu"))
+            attn_metadata.blend_metadata.request_prompt_list.append(
+                token_cache.get_tokens(seqid, seq_group_metadata.request_id,
+                                       seq_data, seq_len))
             attn_metadata.blend_metadata.prompt_indices_list.append(indices)
             seq_data_idx += 1
     assert seq_data_idx == len(seq_lens)
@@ -273,10 +279,30 @@ def do_blend(
 
     # Store original query start loc
     if blend_metadata.original_query_start_loc is None:
+        if getattr(attn_metadata, "query_start_loc", None) is None:
+            # Backends such as torch SDPA have no query_start_loc. A blended
+            # prefill has no context, so its queries are its whole sequences
+            attn_metadata.query_start_loc = seq_lens_to_start_loc(
+                attn_metadata.seq_lens, fresh_q.device)
         blend_metadata.original_query_start_loc = attn_metadata.query_start_loc.clone()
 
-    # Retrieve the KV
     layer_id = blend_metadata.processed_layer_count
+    with trace_span("blend_layer", layer=layer_id):
+        return _do_blend_layer(fresh_q, fresh_k, fresh_v, attn_metadata,
+                               rotary_emb, reverse_rotary_emb, layer_id)
+
+def _do_blend_layer(
+        fresh_q: torch.Tensor,
+        fresh_k: torch.Tensor,
+        fresh_v: torch.Tensor,
+        attn_metadata: AttentionMetadata,
+        rotary_emb,
+        reverse_rotary_emb,
+        layer_id: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, AttentionMetadata]:
+    blend_metadata = attn_metadata.blend_metadata
+
+    # Retrieve the KV
     retrieved_kv = blend_metadata.retrieval_task.result(layer_id)
     if retrieved_kv.k is None or retrieved_kv.v is None:
         # Do nothing if no KV is retrieved
@@ -304,6 +330,12 @@ def do_blend(
     attn_metadata.blend_metadata.processed_layer_count += 1
     attn_metadata.blend_metadata.positions = blender_output.positions
 
+    get_metrics().histogram(
+        "lmcache:blend_recompute_ratio",
+        "Ratio of the tokens recomputed by CacheBlend in a layer",
+        RATIO_BUCKETS).observe(
+            blender_output.q.shape[0] / max(fresh_q.shape[0], 1))
+
     # Update attn_metadata for shorter attention
     if fresh_q.shape != blender_output.q.shape:
         # num_prefills: not change
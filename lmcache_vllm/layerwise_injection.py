@@ -0,0 +1,176 @@
+from typing import List, Optional
+
+import torch
+from torch import nn
+
+from lmcache.logging import init_logger
+from lmcache.utils import KVCache
+from lmcache_vllm.utils.kv_transfer import concat_layer_kv, inject_layer_kv
+
+logger = init_logger(__name__)
+
+# The injection task of the current model forward
+g_current_task: Optional["LayerwiseInjectionTask"] = None
+
+
+class LayerwiseInjectionTask:
+    """Injects the retrieved KV into the paged memory one layer at a time,
+    right before the attention of that layer runs.
+
+    The KV of all the sequences is concatenated per layer, so every layer
+    takes one host-to-device copy and one injection call. The copies of the
+    next `prefetch_depth` layers are queued on a side stream, so loading the
+    KV of later layers overlaps with the compute of earlier ones. Without a
+    side stream (e.g., on cpu) the copies are done synchronously when the
+    layer is injected.
+
+    Only the transfer into the paged memory is pipelined. `engine.retrieve`
+    returns the KV of all the layers at once, so the whole retrieval from
+    the LMCache backend still completes before the forward starts. Its time
+    is hidden only once the engine can load KV layer by layer.
+    """
+    def __init__(
+            self,
+            kv_caches: List[torch.Tensor],
+            attn_layers: List[nn.Module],
+            start_layer: int,
+            end_layer: int,
+            cuda_stream: Optional[torch.cuda.Stream] = None,
+            prefetch_depth: int = 2,
+        ):
+        self.kv_caches = kv_caches
+        self.attn_layers = attn_layers
+        self.start_layer = start_layer
+        self.end_layer = end_layer
+        self.num_layers = end_layer - start_layer
+        self.cuda_stream = cuda_stream \
+            if cuda_stream is not None and kv_caches[0].is_cuda else None
+        self.prefetch_depth = max(1, prefetch_depth)
+
+        # The retrieved KV and slot mapping of each sequence to be injected
+        self.kv_tuples: List[KVCache] = []
+        self.slot_mappings: List[torch.Tensor] = []
+        self._slot_mapping: Optional[torch.Tensor] = None
+
+        # The KV of each layer, concatenated over all the sequences
+        self._loaded: List[Optional[torch.Tensor]] = [None] * self.num_layers
+        self._load_events: List[Optional[torch.cuda.Event]] = \
+            [None] * self.num_layers
+        self._next_layer_to_load = 0
+        self._next_layer_to_inject = 0
+
+    def add_request(self, kv_tuple: KVCache, slot_mapping: torch.Tensor) -> None:
+        """Add the retrieved KV of a sequence and the slots to put it to.
+        """
+        self.kv_tuples.append(kv_tuple)
+        self.slot_mappings.append(slot_mapping)
+
+    def is_empty(self) -> bool:
+        return len(self.kv_tuples) == 0
+
+    def is_finished(self) -> bool:
+        return self._next_layer_to_inject >= self.num_layers
+
+    def _load_layer(self, layer_idx: int) -> None:
+        device = self.kv_caches[layer_idx].device
+        if self.cuda_stream is None:
+            self._loaded[layer_idx] = concat_layer_kv(
+                self.kv_tuples, layer_idx, device)
+            return
+
+        with torch.cuda.stream(self.cuda_stream):
+            self._loaded[layer_idx] = concat_layer_kv(
+                self.kv_tuples, layer_idx, device)
+            event = torch.cuda.Event()
+            event.record(self.cuda_stream)
+        self._load_events[layer_idx] = event
+
+    def _prefetch(self, up_to_layer: int) -> None:
+        up_to_layer = min(up_to_layer, self.num_layers)
+        while self._next_layer_to_load < up_to_layer:
+            self._load_layer(self._next_layer_to_load)
+            self._next_layer_to_load += 1
+
+    def start(self) -> None:
+        """Start loading the first layers in the background.
+        """
+        self._slot_mapping = torch.cat(self.slot_mappings)
+        self._prefetch(self.prefetch_depth)
+
+    def inject_layer(self, layer_idx: int) -> None:
+        """Inject the KV of the given layer (relative to start_layer) and
+        of every earlier layer that is not injected yet.
+        """
+        while self._next_layer_to_inject <= min(layer_idx, self.num_layers - 1):
+            idx = self._next_layer_to_inject
+            self._prefetch(idx + 1 + self.prefetch_depth)
+
+            kv = self._loaded[idx]
+            event = self._load_events[idx]
+            if event is not None:
+                compute_stream = torch.cuda.current_stream()
+                compute_stream.wait_event(event)
+                kv.record_stream(compute_stream)
+
+            inject_layer_kv(
+                self.attn_layers[idx + self.start_layer].attn,
+                self.kv_caches[idx],
+                kv,
+                self._slot_mapping)
+            self._loaded[idx] = None
+            self._load_events[idx] = None
+            self._next_layer_to_inject += 1
+
+    def finish(self) -> None:
+        """Inject all the layers that are not injected yet.
+        """
+        self.inject_layer(self.num_layers - 1)
+
+
+def _layerwise_pre_hook(layer_idx: int):
+    def hook(module, args):
+        if g_current_task is not None:
+            g_current_task.inject_layer(layer_idx)
+    return hook
+
+
+def install_layerwise_hooks(
+        attn_layers: List[nn.Module],
+        start_layer: int,
+        end_layer: int,
+    ) -> None:
+    """Register a forward pre-hook on the attention of every layer in
+    [start_layer, end_layer) which injects that layer's KV of the current
+    task. Installing the hooks more than once is a no-op.
+    """
+    for i in range(start_layer, end_layer):
+        attn = attn_layers[i].attn
+        if getattr(attn, "_lmcache_layerwise_hook", None) is not None:
+            continue
+        attn._lmcache_layerwise_hook = attn.register_forward_pre_hook(
+            _layerwise_pre_hook(i - start_layer))
+
+
+def start_layerwise_injection(task: LayerwiseInjectionTask) -> None:
+    """Make `task` the injection task of the next model forward.
+    """
+    global g_current_task
+    if g_current_task is not None:
+        finish_layerwise_injection()
+    task.start()
+    g_current_task = task
+
+
+def finish_layerwise_injection() -> None:
+    """Inject the layers of the current task that have not been reached by
+    the model forward (e.g., the forward is skipped) and clear the task.
+    """
+    global g_current_task
+    task = g_current_task
+    g_current_task = None
+    if task is None:
+        return
+    if not task.is_finished():
+        logger.debug(f"Injecting {task.num_layers - task._next_layer_to_inject} "
+                     f"layers outside of the model forward")
+        task.finish()
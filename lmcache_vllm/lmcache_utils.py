@@ -1 +1,40 @@
-ENGINE_NAME = "vllm-instance"
\ No newline at end of file
+import os
+
+ENGINE_NAME = "vllm-instance"
+
+
+def get_env_flag(name: str, default: bool = False) -> bool:
+    """Read a boolean switch from the environment variable `name`.
+    "1", "true", "yes" and "on" (case-insensitive) enable the switch.
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def get_env_int(name: str, default: int) -> int:
+    """Read an integer option from the environment variable `name`.
+    """
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return int(value)
+
+
+def get_env_float(name: str, default: float) -> float:
+    """Read a float option from the environment variable `name`.
+    """
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return float(value)
+
+
+def get_env_str(name: str, default: str) -> str:
+    """Read a lower-cased string option from the environment variable `name`.
+    """
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower()
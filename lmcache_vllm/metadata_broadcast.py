@@ -0,0 +1,243 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional
+
+import torch
+import torch.distributed as dist
+
+from vllm.sequence import SequenceGroupMetadata
+
+from lmcache.logging import init_logger
+
+logger = init_logger(__name__)
+
+# Flags of a sequence group in the payload
+_FLAG_IS_PROMPT = 1
+_FLAG_DO_SAMPLE = 2
+_FLAG_HAS_BLOCK_TABLES = 4
+
+
+class BroadcastSeqData:
+    """The part of `SequenceData` LMCache reads, mirrored on non-driver
+    workers.
+    """
+    def __init__(self):
+        self.token_ids: List[int] = []
+
+    def get_len(self) -> int:
+        return len(self.token_ids)
+
+    def get_token_ids(self) -> List[int]:
+        return self.token_ids
+
+
+@dataclass
+class BroadcastSeqGroupMetadata:
+    """The part of `SequenceGroupMetadata` LMCache reads, mirrored on
+    non-driver workers.
+    """
+    request_id: str
+    is_prompt: bool = True
+    do_sample: bool = True
+    seq_data: Dict[int, BroadcastSeqData] = field(default_factory=dict)
+    block_tables: Optional[Dict[int, List[int]]] = None
+
+
+@dataclass
+class _SentSeqState:
+    num_tokens: int = 0
+    block_table: List[int] = field(default_factory=list)
+
+
+class SeqMetadataBroadcaster:
+    """Broadcasts what LMCache needs from `seq_group_metadata_list` as a
+    compact int64 tensor of deltas.
+
+    The driver remembers how many tokens and which blocks of every sequence
+    it has sent, and only sends the tokens appended and the block-table
+    entries changed since then. Request ids are sent once per request and
+    referred to by a small integer handle afterwards. Non-driver workers
+    apply the deltas to their mirrored metadata.
+
+    Payload layout:
+        num_groups,
+        per group: handle, flags, len(request_id), *request_id (only the
+            first time), num_seqs,
+        per seq: seq_id, token_start, num_new_tokens, *new_tokens,
+            block_start, num_new_blocks, *new_blocks
+    A receiver truncates the tokens (blocks) of a sequence to token_start
+    (block_start) and then appends the new ones.
+    """
+    def __init__(self, group: Optional[dist.ProcessGroup] = None, src: int = 0):
+        self.group = group
+        self.src = src
+
+        # driver states
+        self._next_handle = 0
+        self._sent: Dict[int, _SentSeqState] = {}
+
+        # non-driver states
+        self._groups: Dict[int, BroadcastSeqGroupMetadata] = {}
+
+        # Both sides
+        self._handles: Dict[str, int] = {}
+        self._handle_seq_ids: Dict[int, List[int]] = {}
+
+    def encode(self, seq_group_metadata_list: List[SequenceGroupMetadata]) -> List[int]:
+        """Encode the deltas of the current step (driver only).
+        """
+        payload = [len(seq_group_metadata_list)]
+        for seq_group_metadata in seq_group_metadata_list:
+            request_id = seq_group_metadata.request_id
+            handle = self._handles.get(request_id)
+            is_new_request = handle is None
+            if is_new_request:
+                handle = self._next_handle
+                self._next_handle += 1
+                self._handles[request_id] = handle
+
+            flags = 0
+            if seq_group_metadata.is_prompt:
+                flags |= _FLAG_IS_PROMPT
+            if seq_group_metadata.do_sample:
+                flags |= _FLAG_DO_SAMPLE
+            block_tables = seq_group_metadata.block_tables
+            if block_tables is not None:
+                flags |= _FLAG_HAS_BLOCK_TABLES
+            payload.append(handle)
+            payload.append(flags)
+            if is_new_request:
+                request_id_bytes = request_id.encode("utf-8")
+                payload.append(len(request_id_bytes))
+                payload.extend(request_id_bytes)
+            else:
+                payload.append(0)
+
+            seq_ids = list(seq_group_metadata.seq_data.keys())
+            # Forget the sequences that left the group (e.g., finished beams)
+            for seq_id in self._handle_seq_ids.get(handle, ()):
+                if seq_id not in seq_ids:
+                    self._sent.pop(seq_id, None)
+            self._handle_seq_ids[handle] = seq_ids
+            payload.append(len(seq_ids))
+            for seq_id in seq_ids:
+                token_ids = seq_group_metadata.seq_data[seq_id].get_token_ids()
+                sent = self._sent.setdefault(seq_id, _SentSeqState())
+                payload.append(seq_id)
+
+                # Tokens are append-only, unless the sequence was reset
+                token_start = sent.num_tokens \
+                    if sent.num_tokens <= len(token_ids) else 0
+                payload.append(token_start)
+                payload.append(len(token_ids) - token_start)
+                payload.extend(token_ids[token_start:])
+                sent.num_tokens = len(token_ids)
+
+                # Block tables mostly grow by appending, but may be
+                # reallocated (e.g., preemption or copy-on-write)
+                block_table = block_tables.get(seq_id, []) \
+                    if block_tables is not None else []
+                num_sent_blocks = len(sent.block_table)
+                if block_table[:num_sent_blocks] == sent.block_table:
+                    block_start = num_sent_blocks
+                else:
+                    block_start = 0
+                    sent.block_table = []
+                new_blocks = block_table[block_start:]
+                payload.append(block_start)
+                payload.append(len(new_blocks))
+                payload.extend(new_blocks)
+                sent.block_table.extend(new_blocks)
+        return payload
+
+    def decode(self, payload: List[int]) -> List[BroadcastSeqGroupMetadata]:
+        """Apply the deltas of the current step (non-driver only).
+        """
+        pos = 0
+        def read(n: int = 1):
+            nonlocal pos
+            values = payload[pos:pos + n]
+            pos += n
+            return values
+
+        seq_group_metadata_list = []
+        num_groups, = read()
+        for _ in range(num_groups):
+            handle, flags, request_id_len = read(3)
+            if request_id_len > 0:
+                request_id = bytes(read(request_id_len)).decode("utf-8")
+                self._handles[request_id] = handle
+                self._groups[handle] = BroadcastSeqGroupMetadata(request_id)
+            group = self._groups[handle]
+            group.is_prompt = bool(flags & _FLAG_IS_PROMPT)
+            group.do_sample = bool(flags & _FLAG_DO_SAMPLE)
+            has_block_tables = bool(flags & _FLAG_HAS_BLOCK_TABLES)
+            if has_block_tables and group.block_tables is None:
+                group.block_tables = {}
+
+            num_seqs, = read()
+            seq_ids = []
+            for _ in range(num_seqs):
+                seq_id, token_start, num_new_tokens = read(3)
+                seq_ids.append(seq_id)
+                seq_data = group.seq_data.setdefault(seq_id, BroadcastSeqData())
+                del seq_data.token_ids[token_start:]
+                seq_data.token_ids.extend(read(num_new_tokens))
+
+                block_start, num_new_blocks = read(2)
+                new_blocks = read(num_new_blocks)
+                if group.block_tables is not None:
+                    block_table = group.block_tables.setdefault(seq_id, [])
+                    del block_table[block_start:]
+                    block_table.extend(new_blocks)
+
+            # Drop the sequences that left the group (e.g., finished beams)
+            for seq_id in list(group.seq_data.keys()):
+                if seq_id not in seq_ids:
+                    group.seq_data.pop(seq_id)
+                    if group.block_tables is not None:
+                        group.block_tables.pop(seq_id, None)
+            if not has_block_tables:
+                group.block_tables = None
+            self._handle_seq_ids[handle] = seq_ids
+            seq_group_metadata_list.append(group)
+        assert pos == len(payload)
+        return seq_group_metadata_list
+
+    def broadcast(
+            self,
+            seq_group_metadata_list: Optional[List[SequenceGroupMetadata]],
+            is_driver_worker: bool,
+        ) -> Optional[List[BroadcastSeqGroupMetadata]]:
+        """Send the deltas from the driver worker and apply them on the
+        others, with two tensor broadcasts (size and payload).
+
+        :return: None on the driver worker and the mirrored metadata list
+            on non-driver workers.
+        """
+        if is_driver_worker:
+            payload = self.encode(seq_group_metadata_list)
+            size = torch.tensor([len(payload)], dtype=torch.long)
+        else:
+            size = torch.zeros(1, dtype=torch.long)
+        dist.broadcast(size, src=self.src, group=self.group)
+
+        if is_driver_worker:
+            payload_tensor = torch.tensor(payload, dtype=torch.long)
+        else:
+            payload_tensor = torch.empty(size.item(), dtype=torch.long)
+        dist.broadcast(payload_tensor, src=self.src, group=self.group)
+
+        if is_driver_worker:
+            return None
+        return self.decode(payload_tensor.tolist())
+
+    def remove_requests(self, request_ids: Iterable[str]) -> None:
+        """Drop the states of finished requests on either side.
+        """
+        for request_id in request_ids:
+            handle = self._handles.pop(request_id, None)
+            if handle is None:
+                continue
+            for seq_id in self._handle_seq_ids.pop(handle, ()):
+                self._sent.pop(seq_id, None)
+            self._groups.pop(handle, None)
@@ -0,0 +1,145 @@
+import threading
+from typing import Dict, List, Optional, Sequence
+
+# Default buckets of latency histograms, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0)
+# Default buckets of ratio histograms
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+
+class Counter:
+    """A monotonically increasing value. `drain` returns the increase since
+    the last drain, so that an exporter can forward it.
+    """
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.total = 0.0
+        self._drained = 0.0
+
+    def inc(self, value: float = 1.0) -> None:
+        self.total += value
+
+    def drain(self) -> float:
+        total = self.total
+        delta = total - self._drained
+        self._drained = total
+        return delta
+
+
+class Gauge:
+    """A value that can go up and down.
+    """
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, value: float = 1.0) -> None:
+        self.value += value
+
+    def dec(self, value: float = 1.0) -> None:
+        self.value -= value
+
+
+class Histogram:
+    """A distribution of observed values.
+
+    Observations are appended to a pending list until they are drained by
+    an exporter, which keeps recording to a single append. At most
+    `max_pending` observations are kept between two drains, the extra ones
+    are only counted in `num_dropped`.
+    """
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            buckets: Sequence[float] = LATENCY_BUCKETS,
+            max_pending: int = 65536,
+        ):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.max_pending = max_pending
+        self.count = 0
+        self.sum = 0.0
+        self.num_dropped = 0
+        self._pending: List[float] = []
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        if len(self._pending) < self.max_pending:
+            self._pending.append(value)
+        else:
+            self.num_dropped += 1
+
+    def drain(self) -> List[float]:
+        pending, self._pending = self._pending, []
+        return pending
+
+
+class MetricsRegistry:
+    """The in-process LMCache metrics, created on first use by name.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, Counter] = {}
+        self.gauges: Dict[str, Gauge] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def counter(self, name: str, documentation: str = "") -> Counter:
+        metric = self.counters.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.counters.setdefault(
+                    name, Counter(name, documentation))
+        return metric
+
+    def gauge(self, name: str, documentation: str = "") -> Gauge:
+        metric = self.gauges.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.gauges.setdefault(
+                    name, Gauge(name, documentation))
+        return metric
+
+    def histogram(
+            self,
+            name: str,
+            documentation: str = "",
+            buckets: Sequence[float] = LATENCY_BUCKETS,
+        ) -> Histogram:
+        metric = self.histograms.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.histograms.setdefault(
+                    name, Histogram(name, documentation, buckets))
+        return metric
+
+    def snapshot(self) -> Dict[str, float]:
+        """Get the current totals of the counters and the gauges, and the
+        count and sum of the histograms, e.g., for logging.
+        """
+        result = {name: c.total for name, c in self.counters.items()}
+        result.update({name: g.value for name, g in self.gauges.items()})
+        for name, h in self.histograms.items():
+            result[f"{name}_count"] = h.count
+            result[f"{name}_sum"] = h.sum
+        return result
+
+
+g_metrics: Optional[MetricsRegistry] = None
+
+
+def get_metrics() -> MetricsRegistry:
+    """Get the metrics registry of this process.
+    """
+    global g_metrics
+    if g_metrics is None:
+        g_metrics = MetricsRegistry()
+    return g_metrics
@@ -0,0 +1,166 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Union
+
+from torch import nn
+
+from lmcache.logging import init_logger
+
+logger = init_logger(__name__)
+
+
+@dataclass
+class ModelLayout:
+    """How LMCache reaches the layers of a model architecture.
+
+    :ivar Callable get_model: Get the decoder stack from the vLLM model,
+        e.g., `LlamaForCausalLM.model`. The stack may carry `start_layer`
+        and `end_layer` under pipeline parallelism.
+    :ivar Callable get_layers: Get the decoder layers of the stack.
+    :ivar Callable get_attn_layer: Get the self-attention block of a decoder
+        layer, whose `attn` is the vLLM `Attention` owning the paged KV
+        cache of the layer.
+
+    There is no KV layout accessor: the layout of the paged KV caches,
+    [2, num_blocks, block_size, num_kv_heads, head_size], is set by the
+    attention backend, and the head counts by the model config. Neither
+    depends on the module structure of the architecture.
+    """
+    get_model: Callable[[nn.Module], nn.Module]
+    get_layers: Callable[[nn.Module], List[nn.Module]]
+    get_attn_layer: Callable[[nn.Module], nn.Module]
+
+
+@dataclass
+class ModelInputSubset:
+    """The layout of a loaded model, resolved once and cached on it.
+
+    :ivar List[nn.Module] model_layers: All the decoder layers.
+    :ivar List[nn.Module] attn_layers: The self-attention block of each
+        decoder layer.
+    :ivar int start_layer: The first layer of this pipeline stage.
+    :ivar int end_layer: The layer after the last one of this pipeline
+        stage. KV caches are indexed relative to `start_layer`.
+    """
+    model_layers: List[nn.Module]
+    attn_layers: List[nn.Module]
+    start_layer: int
+    end_layer: int
+
+
+LLAMA_LAYOUT = ModelLayout(
+    get_model=lambda model: model.model,
+    get_layers=lambda model: model.layers,
+    get_attn_layer=lambda layer: layer.self_attn,
+)
+
+GLM_LAYOUT = ModelLayout(
+    get_model=lambda model: model.transformer,
+    get_layers=lambda model: model.encoder.layers,
+    get_attn_layer=lambda layer: layer.self_attention,
+)
+
+QWEN_LAYOUT = ModelLayout(
+    get_model=lambda model: model.transformer,
+    get_layers=lambda model: model.h,
+    get_attn_layer=lambda layer: layer.attn,
+)
+
+# The layouts by the class name of the vLLM model
+_MODEL_LAYOUTS: Dict[str, ModelLayout] = {}
+
+_MODEL_INPUT_SUBSET_ATTR = "_lmcache_model_input_subset"
+# Cached on a model without layout, so that it is resolved only once
+_UNSUPPORTED = object()
+
+
+def register_model_layout(
+        architectures: Union[str, Iterable[str]],
+        layout: ModelLayout,
+    ) -> None:
+    """Register the layout of the vLLM model classes named `architectures`.
+    Subclasses of a registered class get its layout unless they are
+    registered themselves.
+    """
+    if isinstance(architectures, str):
+        architectures = [architectures]
+    for architecture in architectures:
+        _MODEL_LAYOUTS[architecture] = layout
+
+
+register_model_layout(
+    ["LlamaForCausalLM", "MistralForCausalLM", "MixtralForCausalLM",
+     "Qwen2ForCausalLM"], LLAMA_LAYOUT)
+register_model_layout(
+    ["ChatGLMForCausalLM", "ChatGLMModel"], GLM_LAYOUT)
+register_model_layout("QWenLMHeadModel", QWEN_LAYOUT)
+
+
+def get_model_layout(model_executable: nn.Module) -> Optional[ModelLayout]:
+    """Get the registered layout of the class of `model_executable` or of
+    its closest registered base class.
+    """
+    for cls in type(model_executable).__mro__:
+        layout = _MODEL_LAYOUTS.get(cls.__name__)
+        if layout is not None:
+            return layout
+    return None
+
+
+def resolve_model_input_subset(
+        model_executable: nn.Module,
+    ) -> Optional[ModelInputSubset]:
+    """Resolve the layers of a loaded model and cache them on the model.
+
+    An unregistered model with the Llama module layout gets that layout with
+    a warning.
+
+    :return: The layers, or None if the model has no known layout, in which
+        case LMCache does not store or retrieve its KV.
+    :rtype: Optional[ModelInputSubset]
+    """
+    layout = get_model_layout(model_executable)
+    if layout is None:
+        model = getattr(model_executable, "model", None)
+        if model is None or not hasattr(model, "layers"):
+            logger.warning(
+                f"Unsupported model architecture "
+                f"{type(model_executable).__name__} for LMCache, its KV is "
+                f"not stored or retrieved. Register its layout with "
+                f"`register_model_layout`")
+            setattr(model_executable, _MODEL_INPUT_SUBSET_ATTR, _UNSUPPORTED)
+            return None
+        logger.warning(f"No LMCache model layout is registered for "
+                       f"{type(model_executable).__name__}, assuming the "
+                       f"Llama layout")
+        layout = LLAMA_LAYOUT
+
+    model = layout.get_model(model_executable)
+    model_layers = layout.get_layers(model)
+    model_input_subset = ModelInputSubset(
+        model_layers=model_layers,
+        attn_layers=[layout.get_attn_layer(layer) for layer in model_layers],
+        # NOTE: ChatGLM and QWen have no `start_layer` and `end_layer`, and
+        # run on a single pipeline stage
+        start_layer=getattr(model, "start_layer", 0),
+        end_layer=getattr(model, "end_layer", len(model_layers)),
+    )
+    setattr(model_executable, _MODEL_INPUT_SUBSET_ATTR, model_input_subset)
+    return model_input_subset
+
+
+def create_model_input_subset(
+        model_executable: nn.Module,
+    ) -> Optional[ModelInputSubset]:
+    """Get the layers of a model, resolved by `resolve_model_input_subset`
+    the first time only.
+
+    :return: The layers, or None if the model is not supported.
+    :rtype: Optional[ModelInputSubset]
+    """
+    model_input_subset = getattr(
+        model_executable, _MODEL_INPUT_SUBSET_ATTR, None)
+    if model_input_subset is None:
+        return resolve_model_input_subset(model_executable)
+    if model_input_subset is _UNSUPPORTED:
+        return None
+    return model_input_subset
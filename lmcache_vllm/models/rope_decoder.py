@@ -0,0 +1,203 @@
+"""CacheBlend injection for the RoPE decoder-only models of vLLM.
+
+The supported architectures share the module structure of Llama: an
+attention with `qkv_proj`, `rotary_emb`, `attn` and `o_proj`, a decoder
+layer with `input_layernorm`, `self_attn`, `post_attention_layernorm` and
+an MLP, and a model whose forward passes the attention metadata to every
+layer. The injection
+1. attaches the reverse rotary embedding to every attention,
+2. runs `do_blend` between the rotary embedding and the attention,
+3. re-indexes the residual of the layers after the tokens are selected,
+4. runs `process_new_request` at the start of the model forward.
+"""
+import importlib
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+
+from vllm.attention import AttentionMetadata
+from vllm.model_executor.layers.rotary_embedding import RotaryEmbedding
+
+from lmcache.logging import init_logger
+from lmcache_vllm.blend_adapter import do_blend, process_new_request, disable_blend
+from lmcache_vllm.utils.positional_encoding import get_reverse_rope
+
+logger = init_logger(__name__)
+
+
+@dataclass
+class RopeDecoderSpec:
+    """The vLLM classes of a RoPE decoder architecture.
+
+    :ivar str module: The vLLM module defining the classes.
+    :ivar str attention: The attention class.
+    :ivar str decoder_layer: The decoder layer class.
+    :ivar str model: The decoder stack class.
+    :ivar str mlp: The attribute of the MLP (or MoE) of a decoder layer.
+    """
+    module: str
+    attention: str
+    decoder_layer: str
+    model: str
+    mlp: str = "mlp"
+
+
+# NOTE: Mistral checkpoints are served by vLLM's Llama classes
+ROPE_DECODER_SPECS: List[RopeDecoderSpec] = [
+    RopeDecoderSpec("vllm.model_executor.models.llama",
+                    "LlamaAttention", "LlamaDecoderLayer", "LlamaModel"),
+    RopeDecoderSpec("vllm.model_executor.models.qwen2",
+                    "Qwen2Attention", "Qwen2DecoderLayer", "Qwen2Model"),
+    RopeDecoderSpec("vllm.model_executor.models.mixtral",
+                    "MixtralAttention", "MixtralDecoderLayer", "MixtralModel",
+                    mlp="block_sparse_moe"),
+]
+
+# The reverse rotary embeddings by their parameters, shared by the layers
+_reverse_ropes: Dict[Tuple, Optional[Callable]] = {}
+
+
+def get_reverse_rope_of(rotary_emb) -> Optional[Callable]:
+    """Get the reverse of a vLLM rotary embedding, or None if it is not
+    supported (e.g., a scaled rotary embedding).
+    """
+    if type(rotary_emb) is not RotaryEmbedding:
+        logger.warning(f"{type(rotary_emb).__name__} is not supported by "
+                       f"CacheBlend")
+        return None
+    key = (rotary_emb.head_size, rotary_emb.rotary_dim,
+           rotary_emb.max_position_embeddings, rotary_emb.base,
+           rotary_emb.is_neox_style)
+    if key not in _reverse_ropes:
+        _reverse_ropes[key] = get_reverse_rope(*key)
+    return _reverse_ropes[key]
+
+
+def wrap_attn_init(original_init: Callable) -> Callable:
+    def attn_init_with_blend(self, *args, **kwargs) -> None:
+        original_init(self, *args, **kwargs)
+
+        # Injection for CacheBlend
+        self.reverse_rotary_emb = get_reverse_rope_of(self.rotary_emb)
+        if self.reverse_rotary_emb is None:
+            disable_blend()
+        # Injection end
+    return attn_init_with_blend
+
+
+def attn_forward_with_blend(
+    self,
+    positions: torch.Tensor,
+    hidden_states: torch.Tensor,
+    kv_cache: torch.Tensor,
+    attn_metadata: AttentionMetadata,
+) -> torch.Tensor:
+    qkv, _ = self.qkv_proj(hidden_states)
+    q, k, v = qkv.split([self.q_size, self.kv_size, self.kv_size], dim=-1)
+
+    # Injection for CacheBlend
+    if hasattr(attn_metadata, "blend_metadata"):
+        positions = attn_metadata.blend_metadata.positions
+    # End of injection
+
+    q, k = self.rotary_emb(positions, q, k)
+
+    # Injection for CacheBlend
+    q, k, v, attn_metadata = do_blend(
+            q, k, v, attn_metadata,
+            self.rotary_emb, self.reverse_rotary_emb
+        )
+    # End of injection
+
+    attn_output = self.attn(q, k, v, kv_cache, attn_metadata)
+    output, _ = self.o_proj(attn_output)
+    return output
+
+
+def make_decoder_layer_forward_with_blend(mlp: str) -> Callable:
+    def decoder_layer_forward_with_blend(
+        self,
+        positions: torch.Tensor,
+        hidden_states: torch.Tensor,
+        kv_cache: torch.Tensor,
+        attn_metadata: AttentionMetadata,
+        residual: Optional[torch.Tensor],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Self Attention
+        if residual is None:
+            residual = hidden_states
+            hidden_states = self.input_layernorm(hidden_states)
+        else:
+            hidden_states, residual = self.input_layernorm(
+                hidden_states, residual)
+        hidden_states = self.self_attn(
+            positions=positions,
+            hidden_states=hidden_states,
+            kv_cache=kv_cache,
+            attn_metadata=attn_metadata,
+        )
+
+        # Injection for CacheBlend
+        blend_metadata = getattr(attn_metadata, "blend_metadata", None)
+        if blend_metadata is not None and \
+                residual.shape[0] != hidden_states.shape[0]:
+            indexes = blend_metadata.blend_executor.indexes_in_kv
+            residual = residual[indexes]
+        # End of injection
+
+        hidden_states, residual = self.post_attention_layernorm(
+            hidden_states, residual)
+        hidden_states = getattr(self, mlp)(hidden_states)
+        return hidden_states, residual
+    return decoder_layer_forward_with_blend
+
+
+def wrap_model_forward(original_forward: Callable) -> Callable:
+    def model_forward_with_blend(
+        self,
+        input_ids: Optional[torch.Tensor],
+        positions: torch.Tensor,
+        kv_caches: List[torch.Tensor],
+        attn_metadata: AttentionMetadata,
+        *args,
+        **kwargs,
+    ):
+        # Injection for CacheBlend
+        attn_metadata = process_new_request(
+            input_ids, positions, attn_metadata, kv_caches)
+        # End of injection
+        return original_forward(self, input_ids, positions, kv_caches,
+                                attn_metadata, *args, **kwargs)
+    return model_forward_with_blend
+
+
+def inject_rope_decoder(spec: RopeDecoderSpec) -> bool:
+    """Inject CacheBlend into the classes of one architecture.
+
+    :return: False if the classes do not exist in this vLLM version.
+    """
+    try:
+        module = importlib.import_module(spec.module)
+        attention = getattr(module, spec.attention)
+        decoder_layer = getattr(module, spec.decoder_layer)
+        model = getattr(module, spec.model)
+    except (ImportError, AttributeError) as e:
+        logger.warning(f"Cannot inject CacheBlend into {spec.module}: {e}")
+        return False
+
+    if getattr(model, "_lmcache_blend_injected", False):
+        return True
+    attention.__init__ = wrap_attn_init(attention.__init__)
+    attention.forward = attn_forward_with_blend
+    decoder_layer.forward = make_decoder_layer_forward_with_blend(spec.mlp)
+    model.forward = wrap_model_forward(model.forward)
+    model._lmcache_blend_injected = True
+    return True
+
+
+def inject_rope_decoders() -> None:
+    """Inject CacheBlend into every supported RoPE decoder architecture.
+    """
+    for spec in ROPE_DECODER_SPECS:
+        inject_rope_decoder(spec)
@@ -0,0 +1,223 @@
+import queue
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Optional, Protocol
+
+import torch
+
+from lmcache.cache_engine import LMCacheEngine
+from lmcache.logging import init_logger
+
+logger = init_logger(__name__)
+
+
+class KVBackend(Protocol):
+    """The part of the LMCache storage backend interface used by prefetching.
+    """
+    def contains(self, key) -> bool:
+        ...
+
+    def get(self, key) -> Optional[torch.Tensor]:
+        ...
+
+    def put(self, key, kv_chunk: torch.Tensor, blocking: bool = True) -> None:
+        ...
+
+
+class ChunkPromoter:
+    """Walks the chunk keys of a prompt, in the same way LMCache hashes them,
+    and copies every chunk that is only in the slow backend into the local
+    backend. It stops at the first chunk that is in neither.
+
+    Without a slow backend it only looks the prompt up.
+    """
+    def __init__(
+            self,
+            chunk_size: int,
+            hash_fn: Callable[[torch.Tensor, str], str],
+            make_key_fn: Callable[[str], str],
+            local_backend: KVBackend,
+            slow_backend: Optional[KVBackend] = None,
+            init_hash: str = "",
+        ):
+        self.chunk_size = chunk_size
+        self.hash_fn = hash_fn
+        self.make_key_fn = make_key_fn
+        self.local_backend = local_backend
+        self.slow_backend = slow_backend
+        self.init_hash = init_hash
+
+    @classmethod
+    def from_engine(cls, engine: LMCacheEngine) -> Optional["ChunkPromoter"]:
+        """Build a promoter over the backends of `engine`. The local and
+        remote stores of a hybrid backend are the local and slow backends.
+
+        :return: The promoter, or None if the engine does not expose its
+            chunk hash and backend.
+        :rtype: Optional[ChunkPromoter]
+        """
+        if not (hasattr(engine, "_hash") and hasattr(engine, "_make_key")
+                and hasattr(engine, "engine_")):
+            return None
+        fmt = engine.metadata.fmt
+        def make_key_fn(chunk_hash: str) -> str:
+            return engine._make_key(chunk_hash, fmt)
+
+        init_hash = engine._get_init_hash() \
+            if hasattr(engine, "_get_init_hash") else ""
+        backend = engine.engine_
+        local_backend = getattr(backend, "local_store", None)
+        slow_backend = getattr(backend, "remote_store", None)
+        if local_backend is None or slow_backend is None:
+            local_backend, slow_backend = backend, None
+        return cls(engine.chunk_size, engine._hash, make_key_fn,
+                   local_backend, slow_backend, init_hash)
+
+    def __call__(
+            self,
+            tokens: torch.Tensor,
+            is_cancelled: Callable[[], bool],
+        ) -> int:
+        """Promote the cached prefix of `tokens`.
+
+        :return: The number of leading tokens found in either backend.
+        :rtype: int
+        """
+        prefix_hash = self.init_hash
+        num_cached_tokens = 0
+        for chunk in torch.split(tokens, self.chunk_size):
+            if is_cancelled():
+                break
+            prefix_hash = self.hash_fn(chunk, prefix_hash)
+            key = self.make_key_fn(prefix_hash)
+            if not self.local_backend.contains(key):
+                if self.slow_backend is None or \
+                        not self.slow_backend.contains(key):
+                    break
+                kv_chunk = self.slow_backend.get(key)
+                if kv_chunk is None:
+                    break
+                self.local_backend.put(key, kv_chunk, blocking=False)
+            num_cached_tokens += len(chunk)
+        return num_cached_tokens
+
+
+@dataclass
+class PrefetchTask:
+    """The prefetch of one request.
+
+    :ivar str request_id: The request to prefetch for.
+    :ivar torch.Tensor tokens: The prompt tokens.
+    :ivar threading.Event cancelled: Set when the request is aborted.
+    :ivar threading.Event done: Set when the prefetch finishes.
+    :ivar Optional[int] num_cached_tokens: The cached prefix length found.
+    """
+    request_id: str
+    tokens: torch.Tensor
+    cancelled: threading.Event = field(default_factory=threading.Event)
+    done: threading.Event = field(default_factory=threading.Event)
+    num_cached_tokens: Optional[int] = None
+
+
+class Prefetcher:
+    """Prefetches the KV of requests into the local tier while they wait in
+    the vLLM queue.
+
+    Requests are submitted when their prompt is tokenized and handed to
+    `fetch_fn` by a background thread. The queue is bounded: when it is full
+    the new request is not prefetched, which only means it is retrieved from
+    the slow tier later as before. A cancelled request is skipped if it has
+    not started, and `fetch_fn` can stop early by polling `is_cancelled`.
+    """
+    def __init__(
+            self,
+            fetch_fn: Callable[[torch.Tensor, Callable[[], bool]], int],
+            max_pending: int = 64,
+        ):
+        self.fetch_fn = fetch_fn
+        self._tasks: Dict[str, PrefetchTask] = {}
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[Optional[PrefetchTask]]" = \
+            queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(
+            target=self._run, name="lmcache-prefetcher", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                if task.cancelled.is_set():
+                    continue
+                task.num_cached_tokens = self.fetch_fn(
+                    task.tokens, task.cancelled.is_set)
+                logger.debug(f"Prefetched {task.num_cached_tokens} tokens "
+                             f"for request {task.request_id}")
+            except Exception as e:
+                logger.error("Failed to prefetch KV cache", exc_info=e)
+            finally:
+                if task is not None:
+                    task.done.set()
+                self._queue.task_done()
+
+    def submit(self, request_id: str, tokens: torch.Tensor) -> bool:
+        """Queue the prefetch of a request.
+
+        :return: False if the queue is full and the request is not prefetched.
+        :rtype: bool
+        """
+        task = PrefetchTask(request_id, tokens)
+        with self._lock:
+            self._tasks[request_id] = task
+        try:
+            self._queue.put_nowait(task)
+        except queue.Full:
+            logger.debug(f"Prefetch queue is full, skipping request {request_id}")
+            with self._lock:
+                self._tasks.pop(request_id, None)
+            return False
+        return True
+
+    def cancel(self, request_ids: Iterable[str]) -> None:
+        """Cancel the prefetch of the given requests and forget them.
+        """
+        with self._lock:
+            for request_id in request_ids:
+                task = self._tasks.pop(request_id, None)
+                if task is not None:
+                    task.cancelled.set()
+
+    def get_num_cached_tokens(self, request_id: str) -> Optional[int]:
+        """Get the cached prefix length found by a finished prefetch.
+
+        :return: The number of cached leading tokens, or None if the request
+            is unknown or its prefetch has not finished.
+        :rtype: Optional[int]
+        """
+        task = self._tasks.get(request_id)
+        if task is None or not task.done.is_set():
+            return None
+        return task.num_cached_tokens
+
+    def wait(self, request_id: str, timeout: Optional[float] = None) -> bool:
+        """Wait for the prefetch of a request to finish.
+
+        :return: False if the request is unknown or the wait timed out.
+        :rtype: bool
+        """
+        task = self._tasks.get(request_id)
+        if task is None:
+            return False
+        return task.done.wait(timeout)
+
+    def close(self) -> None:
+        """Cancel the pending prefetches and stop the background thread.
+        """
+        with self._lock:
+            for task in self._tasks.values():
+                task.cancelled.set()
+            self._tasks.clear()
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,246 @@
+import hashlib
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+import torch
+
+from lmcache.cache_engine import LMCacheEngine
+from lmcache.logging import init_logger
+
+logger = init_logger(__name__)
+
+
+@dataclass
+class SeqPrefixState:
+    """What the adapter knows about the prefix of one sequence in LMCache.
+
+    :ivar str request_id: The request that owns the sequence.
+    :ivar List[str] chunk_hashes: The rolling prefix hashes of the full
+        chunks hashed so far.
+    :ivar int stored_len: The number of leading tokens known to be stored.
+    :ivar int pending_len: The number of leading tokens stored or queued to
+        be stored. It falls back to `stored_len` if a queued store fails.
+    :ivar int sighted_len: The number of leading tokens already counted by
+        the store admission.
+    """
+    request_id: str
+    chunk_hashes: List[str] = field(default_factory=list)
+    stored_len: int = 0
+    pending_len: int = 0
+    sighted_len: int = 0
+
+
+def _default_hash(tokens: torch.Tensor, prefix_hash: str) -> str:
+    hasher = hashlib.sha256()
+    hasher.update(prefix_hash.encode("ascii"))
+    hasher.update(tokens.cpu().numpy().tobytes())
+    return hasher.hexdigest()
+
+
+class PrefixHashMemo:
+    """Per-sequence memo of rolling chunk hashes and stored-prefix lengths,
+    keyed by `seq_id`.
+
+    It replaces the full-prefix `engine.lookup` of the store path: once a
+    sequence has been retrieved or stored, only the chunks completed since
+    then are hashed and checked against the backend.
+
+    A store only counts as stored once the store worker has completed it,
+    see `record_pending` and `finish_store`, which may be called from the
+    store worker thread.
+    """
+    def __init__(
+            self,
+            chunk_size: int,
+            hash_fn: Callable[[torch.Tensor, str], str],
+            init_hash: str = "",
+            contains_fn: Optional[Callable[[str], bool]] = None,
+            make_key_fn: Optional[Callable[[str], str]] = None,
+        ):
+        self.chunk_size = chunk_size
+        self.hash_fn = hash_fn
+        self.init_hash = init_hash
+        self.contains_fn = contains_fn
+        self.make_key_fn = make_key_fn
+        self._states: Dict[int, SeqPrefixState] = {}
+        self._request_to_seq_ids: Dict[str, Set[int]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_engine(cls, engine: LMCacheEngine) -> "PrefixHashMemo":
+        """Build a memo that hashes chunks exactly like `engine` does, so
+        its hashes can be used as LMCache keys.
+        """
+        if hasattr(engine, "_hash"):
+            hash_fn = engine._hash
+            init_hash = engine._get_init_hash() \
+                if hasattr(engine, "_get_init_hash") else ""
+        else:
+            logger.warning("LMCache engine does not expose its chunk hash, "
+                           "the prefix memo will not check the backend")
+            hash_fn = _default_hash
+            init_hash = ""
+
+        contains_fn = None
+        make_key_fn = None
+        if hasattr(engine, "_hash") and hasattr(engine, "_make_key") \
+                and hasattr(engine, "engine_"):
+            fmt = engine.metadata.fmt
+            def make_key_fn(chunk_hash: str) -> str:
+                return engine._make_key(chunk_hash, fmt)
+
+            def contains_fn(chunk_hash: str) -> bool:
+                return engine.engine_.contains(make_key_fn(chunk_hash))
+
+        return cls(engine.chunk_size, hash_fn, init_hash, contains_fn,
+                   make_key_fn)
+
+    def _get_or_create(self, seq_id: int, request_id: str) -> SeqPrefixState:
+        state = self._states.get(seq_id)
+        if state is None:
+            state = SeqPrefixState(request_id)
+            self._states[seq_id] = state
+            self._request_to_seq_ids.setdefault(request_id, set()).add(seq_id)
+        return state
+
+    def has(self, seq_id: int) -> bool:
+        return seq_id in self._states
+
+    def get_state(self, seq_id: int, request_id: str) -> SeqPrefixState:
+        """Get the state of a sequence, creating it if it is unknown.
+        """
+        return self._get_or_create(seq_id, request_id)
+
+    def chunk_hashes(self, seq_id: int, tokens: torch.Tensor) -> List[str]:
+        """Get the rolling hashes of the full chunks of `tokens`, hashing
+        only the chunks completed since the last call. The sequence must be
+        known to the memo (see `get_state`).
+        """
+        state = self._states[seq_id]
+        hashes = state.chunk_hashes
+        num_full_chunks = len(tokens) // self.chunk_size
+        prefix_hash = hashes[-1] if len(hashes) > 0 else self.init_hash
+        for chunk_idx in range(len(hashes), num_full_chunks):
+            start = chunk_idx * self.chunk_size
+            prefix_hash = self.hash_fn(
+                tokens[start:start + self.chunk_size], prefix_hash)
+            hashes.append(prefix_hash)
+        return hashes[:num_full_chunks]
+
+    def record_stored(self, seq_id: int, request_id: str, num_tokens: int) -> None:
+        """Record that the first `num_tokens` tokens of the sequence are in
+        LMCache (e.g., after a retrieval hit or a lookup).
+        """
+        with self._lock:
+            state = self._get_or_create(seq_id, request_id)
+            state.stored_len = max(state.stored_len, num_tokens)
+            state.pending_len = max(state.pending_len, state.stored_len)
+
+    def record_pending(self, seq_id: int, request_id: str,
+                       num_tokens: int) -> None:
+        """Record that a store of the first `num_tokens` tokens of the
+        sequence is queued, so that the next steps do not store them again.
+        """
+        with self._lock:
+            state = self._get_or_create(seq_id, request_id)
+            state.pending_len = max(state.pending_len, num_tokens)
+
+    def finish_store(self, seq_id: int, start: int, num_tokens: int,
+                     success: bool) -> None:
+        """Record the completion of a store of the tokens from `start` to
+        `num_tokens`, queued by `record_pending`.
+
+        A failed or dropped store leaves a gap, after which the chunks are
+        stored under hashes that a lookup never reaches. So everything after
+        the stored prefix is stored again, and a later store completed after
+        the gap does not count.
+        """
+        with self._lock:
+            state = self._states.get(seq_id)
+            if state is None:
+                # The request has finished
+                return
+            if not success:
+                state.pending_len = state.stored_len
+            elif start <= state.stored_len:
+                state.stored_len = max(state.stored_len, num_tokens)
+
+    def lookup(self, seq_id: int, tokens: torch.Tensor,
+               include_pending: bool = True) -> Optional[int]:
+        """Memoized version of `engine.lookup(tokens)`.
+
+        The stored prefix is only a hint, since the backend may evict it.
+        Its last full chunk is checked against the backend, and the whole
+        prefix is probed again if that chunk is gone.
+
+        :param include_pending: Whether the tokens queued to be stored count
+            as stored. Pass False to get only what a retrieval can load.
+        :type include_pending: bool
+
+        :return: The number of leading tokens already in LMCache (or queued
+            to be stored, if `include_pending`), or None if nothing is known
+            about the sequence yet.
+        :rtype: Optional[int]
+        """
+        state = self._states.get(seq_id)
+        if state is None:
+            return None
+
+        num_tokens = len(tokens)
+        if self.contains_fn is None:
+            known_len = max(state.stored_len, state.pending_len) \
+            if include_pending else state.stored_len
+            if known_len >= num_tokens:
+                return num_tokens
+            return known_len // self.chunk_size * self.chunk_size
+
+        hashes = self.chunk_hashes(seq_id, tokens)
+        num_stored_chunks = min(state.stored_len, num_tokens) // self.chunk_size
+        if num_stored_chunks > 0 and \
+                not self.contains_fn(hashes[num_stored_chunks - 1]):
+            logger.debug(f"The stored prefix of sequence {seq_id} is no "
+                         f"longer in LMCache")
+            with self._lock:
+                state.stored_len = 0
+                state.pending_len = 0
+
+        known_len = max(state.stored_len, state.pending_len) \
+            if include_pending else state.stored_len
+        if known_len >= num_tokens:
+            return num_tokens
+
+        num_known_chunks = known_len // self.chunk_size
+        while num_known_chunks < len(hashes) and \
+                self.contains_fn(hashes[num_known_chunks]):
+            num_known_chunks += 1
+
+        # A partial trailing chunk is hashed differently from the full chunk
+        num_full_tokens = len(hashes) * self.chunk_size
+        if num_known_chunks == len(hashes) and num_full_tokens < num_tokens:
+            prefix_hash = hashes[-1] if len(hashes) > 0 else self.init_hash
+            if self.contains_fn(self.hash_fn(tokens[num_full_tokens:],
+                                             prefix_hash)):
+                return num_tokens
+        return num_known_chunks * self.chunk_size
+
+    def last_chunk_key(self, seq_id: int, tokens: torch.Tensor) -> Optional[str]:
+        """Get the LMCache key of the last full chunk of `tokens`, which is
+        hashed under the running prefix hash of the sequence.
+
+        :return: The key, or None if the memo cannot build LMCache keys.
+        :rtype: Optional[str]
+        """
+        if self.make_key_fn is None:
+            return None
+        hashes = self.chunk_hashes(seq_id, tokens)
+        if len(hashes) == 0:
+            return None
+        return self.make_key_fn(hashes[-1])
+
+    def remove_requests(self, request_ids: Iterable[str]) -> None:
+        """Drop the memo of the sequences of finished requests.
+        """
+        for request_id in request_ids:
+            for seq_id in self._request_to_seq_ids.pop(request_id, ()):
+                self._states.pop(seq_id, None)
@@ -0,0 +1,463 @@
+"""Replays a request trace against vLLM with LMCache and reports the TTFT,
+the throughput, the LMCache hit rate and the store/retrieve volume.
+
+Trace format (JSONL, one request per line):
+    {"timestamp": 0.0, "prompt": "...", "max_tokens": 64}
+    {"timestamp": 0.5, "prompt_token_ids": [1, 2, 3], "max_tokens": 16}
+`timestamp` is the arrival time in seconds (relative to any origin), and
+`max_tokens` is optional. Multi-turn and RAG traces are expressed by
+prompts that share their prefixes.
+
+Usage:
+    lmcache_vllm replay --trace trace.jsonl --endpoint http://localhost:8000
+    lmcache_vllm replay --trace trace.jsonl --model meta-llama/Llama-3.1-8B
+    lmcache_vllm replay --trace trace.jsonl --tiny-llama
+
+The local modes run the model on a CUDA device, since lmcache_vllm only
+patches vLLM's GPU model runner. `--tiny-llama` serves a small Llama with
+random weights, which is enough to measure the hit rate and the LMCache
+overheads without a checkpoint.
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from lmcache.logging import init_logger
+
+logger = init_logger(__name__)
+
+# The LMCache counters reported for a run
+LMCACHE_COUNTERS = (
+    "lmcache:retrieve_queried_tokens",
+    "lmcache:retrieve_hit_tokens",
+    "lmcache:retrieved_bytes",
+    "lmcache:stored_bytes",
+)
+
+
+@dataclass
+class TraceRequest:
+    """One request of the trace.
+
+    :ivar float timestamp: The arrival time relative to the first request.
+    :ivar Optional[str] prompt: The prompt text.
+    :ivar Optional[List[int]] prompt_token_ids: The prompt tokens, used
+        instead of `prompt` if both are given.
+    :ivar int max_tokens: The number of tokens to generate.
+    """
+    timestamp: float
+    prompt: Optional[str]
+    prompt_token_ids: Optional[List[int]]
+    max_tokens: int
+
+
+@dataclass
+class RequestResult:
+    """The measurements of one replayed request.
+
+    :ivar Optional[float] ttft: The time to the first token, None if the
+        request failed.
+    :ivar float latency: The end-to-end latency.
+    :ivar int num_prompt_tokens: The number of prompt tokens.
+    :ivar int num_output_tokens: The number of generated tokens.
+    """
+    ttft: Optional[float]
+    latency: float
+    num_prompt_tokens: int
+    num_output_tokens: int
+
+
+def load_trace(
+        path: str,
+        time_scale: float = 1.0,
+        default_max_tokens: int = 16,
+        num_requests: Optional[int] = None,
+    ) -> List[TraceRequest]:
+    """Load a JSONL trace, sorted by arrival time. The inter-arrival times
+    are multiplied by `time_scale` (0 sends every request at once).
+    """
+    requests = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "prompt" not in entry and "prompt_token_ids" not in entry:
+                raise ValueError(f"Trace entry without a prompt: {line}")
+            requests.append(TraceRequest(
+                timestamp=float(entry.get("timestamp", 0.0)),
+                prompt=entry.get("prompt"),
+                prompt_token_ids=entry.get("prompt_token_ids"),
+                max_tokens=int(entry.get("max_tokens", default_max_tokens))))
+    requests.sort(key=lambda request: request.timestamp)
+    if num_requests is not None:
+        requests = requests[:num_requests]
+    if len(requests) > 0:
+        origin = requests[0].timestamp
+        for request in requests:
+            request.timestamp = (request.timestamp - origin) * time_scale
+    return requests
+
+
+def make_tiny_llama(path: str) -> str:
+    """Write the config of a small Llama to `path`, to be served with
+    randomly initialized weights (`load_format="dummy"`).
+    """
+    from transformers import LlamaConfig
+
+    LlamaConfig(
+        vocab_size=32000,
+        hidden_size=256,
+        intermediate_size=512,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        max_position_embeddings=4096,
+        torch_dtype="float16",
+    ).save_pretrained(path)
+    return path
+
+
+def byte_token_ids(prompt: str, vocab_size: int) -> List[int]:
+    """Token ids of a text prompt for a model without tokenizer. Prompts
+    sharing a prefix share the prefix of their token ids.
+    """
+    return [byte % vocab_size for byte in prompt.encode("utf-8")]
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if len(values) == 0:
+        return {}
+    array = np.array(values)
+    return {
+        "mean": float(array.mean()),
+        "p50": float(np.percentile(array, 50)),
+        "p90": float(np.percentile(array, 90)),
+        "p99": float(np.percentile(array, 99)),
+        "max": float(array.max()),
+    }
+
+
+def summarize(
+        results: List[RequestResult],
+        duration: float,
+        counters: Dict[str, float],
+    ) -> Dict:
+    """Aggregate the measurements of a run."""
+    succeeded = [result for result in results if result.ttft is not None]
+    num_prompt_tokens = sum(r.num_prompt_tokens for r in succeeded)
+    num_output_tokens = sum(r.num_output_tokens for r in succeeded)
+    queried = counters.get("lmcache:retrieve_queried_tokens", 0.0)
+    cached = counters.get("lmcache:retrieve_hit_tokens", 0.0)
+    return {
+        "num_requests": len(results),
+        "num_failed": len(results) - len(succeeded),
+        "duration_s": duration,
+        "ttft_s": percentiles([r.ttft for r in succeeded]),
+        "latency_s": percentiles([r.latency for r in succeeded]),
+        "request_throughput": len(succeeded) / duration,
+        "output_throughput": num_output_tokens / duration,
+        "prompt_tokens": num_prompt_tokens,
+        "output_tokens": num_output_tokens,
+        "cached_tokens": cached,
+        "computed_tokens": num_prompt_tokens - cached,
+        "hit_rate": cached / num_prompt_tokens if num_prompt_tokens else 0.0,
+        "lookup_hit_rate": cached / queried if queried else 0.0,
+        "retrieved_bytes": counters.get("lmcache:retrieved_bytes", 0.0),
+        "stored_bytes": counters.get("lmcache:stored_bytes", 0.0),
+    }
+
+
+def print_summary(summary: Dict) -> None:
+    print(f"Requests:          {summary['num_requests']} "
+          f"({summary['num_failed']} failed) in {summary['duration_s']:.2f} s")
+    print(f"Throughput:        {summary['request_throughput']:.2f} req/s, "
+          f"{summary['output_throughput']:.1f} output tok/s")
+    for name, label in (("ttft_s", "TTFT"), ("latency_s", "Latency")):
+        stats = summary[name]
+        if stats:
+            print(f"{label + ' (ms):':<19}" + ", ".join(
+                f"{key} {value * 1e3:.1f}" for key, value in stats.items()))
+    print(f"Prompt tokens:     {summary['prompt_tokens']} "
+          f"({summary['cached_tokens']:.0f} cached, "
+          f"{summary['computed_tokens']:.0f} computed)")
+    print(f"Hit rate:          {summary['hit_rate']:.1%} of the prompt tokens,"
+          f" {summary['lookup_hit_rate']:.1%} of the looked up tokens")
+    print(f"LMCache volume:    {summary['retrieved_bytes'] / 2**20:.1f} MiB "
+          f"retrieved, {summary['stored_bytes'] / 2**20:.1f} MiB stored")
+
+
+class LocalReplayer:
+    """Replays a trace against an `LLMEngine` in this process, so that the
+    model runs through the patched model runner and the LMCache counters
+    are read from the in-process metrics registry.
+
+    The engine is stepped in a loop and the requests are added when their
+    arrival time has passed. The first token time is taken when the step
+    producing it returns, as seen by an online server.
+    """
+    def __init__(self, engine_args):
+        import torch
+        from vllm import LLMEngine
+
+        # NOTE: only the GPU model runner is patched by lmcache_vllm
+        if not torch.cuda.is_available():
+            raise RuntimeError("Replaying in this process needs a CUDA "
+                               "device, use --endpoint otherwise")
+        self.engine = LLMEngine.from_engine_args(engine_args)
+        self.skip_tokenizer = engine_args.skip_tokenizer_init
+        self.vocab_size = self.engine.model_config.get_vocab_size()
+
+    def _inputs(self, request: TraceRequest) -> Dict:
+        if request.prompt_token_ids is not None:
+            return {"prompt_token_ids": [token_id % self.vocab_size for
+                                         token_id in request.prompt_token_ids]}
+        if self.skip_tokenizer:
+            return {"prompt_token_ids": byte_token_ids(
+                request.prompt, self.vocab_size)}
+        return {"prompt": request.prompt}
+
+    def run(self, trace: List[TraceRequest]) -> List[RequestResult]:
+        from vllm import SamplingParams
+
+        results: List[Optional[RequestResult]] = [None] * len(trace)
+        arrival: Dict[str, float] = {}
+        first_token: Dict[str, float] = {}
+        next_idx = 0
+        start = time.perf_counter()
+        while next_idx < len(trace) or self.engine.has_unfinished_requests():
+            now = time.perf_counter()
+            while next_idx < len(trace) and \
+                    trace[next_idx].timestamp <= now - start:
+                request = trace[next_idx]
+                request_id = str(next_idx)
+                self.engine.add_request(
+                    request_id, self._inputs(request),
+                    SamplingParams(max_tokens=request.max_tokens,
+                                   temperature=0.0, ignore_eos=True,
+                                   detokenize=not self.skip_tokenizer))
+                arrival[request_id] = start + request.timestamp
+                next_idx += 1
+
+            if not self.engine.has_unfinished_requests():
+                time.sleep(max(0.0, start + trace[next_idx].timestamp -
+                               time.perf_counter()))
+                continue
+
+            outputs = self.engine.step()
+            now = time.perf_counter()
+            for output in outputs:
+                request_id = output.request_id
+                if request_id not in first_token and \
+                        len(output.outputs[0].token_ids) > 0:
+                    first_token[request_id] = now
+                if output.finished:
+                    results[int(request_id)] = RequestResult(
+                        ttft=first_token.get(request_id, now) -
+                            arrival[request_id],
+                        latency=now - arrival[request_id],
+                        num_prompt_tokens=len(output.prompt_token_ids),
+                        num_output_tokens=len(output.outputs[0].token_ids))
+        return results
+
+    def read_counters(self) -> Dict[str, float]:
+        from lmcache_vllm.metrics import get_metrics
+        from lmcache_vllm.vllm_adapter import lmcache_flush_stores
+
+        # The stores of the last steps may still be queued
+        lmcache_flush_stores()
+        counters = get_metrics().counters
+        return {name: counters[name].total if name in counters else 0.0
+                for name in LMCACHE_COUNTERS}
+
+    def close(self) -> None:
+        from lmcache_vllm.vllm_adapter import close_lmcache_engine
+
+        close_lmcache_engine()
+
+
+class EndpointReplayer:
+    """Replays a trace against a running OpenAI-compatible server started
+    with `lmcache_vllm serve`.
+
+    The completions are streamed and the first token time is taken at the
+    first streamed chunk. The LMCache counters are read from the `/metrics`
+    endpoint of the server before and after the run, so the stores still
+    queued in the server at the end of the run are not counted.
+    """
+    def __init__(self, endpoint: str, model: Optional[str] = None,
+                 timeout: float = 600.0):
+        self.endpoint = endpoint.rstrip("/")
+        self.model = model
+        self.timeout = timeout
+
+    async def _get_model(self, session) -> str:
+        async with session.get(f"{self.endpoint}/v1/models") as response:
+            response.raise_for_status()
+            return (await response.json())["data"][0]["id"]
+
+    async def _send(self, session, request: TraceRequest,
+                    start: float) -> RequestResult:
+        await asyncio.sleep(max(0.0, start + request.timestamp -
+                                time.perf_counter()))
+        payload = {
+            "model": self.model,
+            "prompt": request.prompt_token_ids
+                if request.prompt_token_ids is not None else request.prompt,
+            "max_tokens": request.max_tokens,
+            "temperature": 0.0,
+            "ignore_eos": True,
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        }
+        sent = time.perf_counter()
+        ttft = None
+        usage = {}
+        try:
+            async with session.post(f"{self.endpoint}/v1/completions",
+                                    json=payload) as response:
+                response.raise_for_status()
+                async for line in response.content:
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[len(b"data:"):].strip()
+                    if data == b"[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    if ttft is None and chunk.get("choices"):
+                        ttft = time.perf_counter() - sent
+                    if chunk.get("usage"):
+                        usage = chunk["usage"]
+        except Exception as e:
+            logger.error(f"Request failed: {e}")
+            ttft = None
+        return RequestResult(
+            ttft=ttft,
+            latency=time.perf_counter() - sent,
+            num_prompt_tokens=usage.get("prompt_tokens", 0),
+            num_output_tokens=usage.get("completion_tokens", 0))
+
+    async def _run(self, trace: List[TraceRequest]) -> List[RequestResult]:
+        import aiohttp
+
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            if self.model is None:
+                self.model = await self._get_model(session)
+            start = time.perf_counter()
+            return await asyncio.gather(
+                *[self._send(session, request, start) for request in trace])
+
+    def run(self, trace: List[TraceRequest]) -> List[RequestResult]:
+        return asyncio.run(self._run(trace))
+
+    def read_counters(self) -> Dict[str, float]:
+        from urllib.request import urlopen
+
+        from prometheus_client.parser import text_string_to_metric_families
+
+        with urlopen(f"{self.endpoint}/metrics", timeout=30) as response:
+            text = response.read().decode("utf-8")
+        counters = dict.fromkeys(LMCACHE_COUNTERS, 0.0)
+        for family in text_string_to_metric_families(text):
+            if family.name not in counters:
+                continue
+            for sample in family.samples:
+                if sample.name.endswith("_total"):
+                    counters[family.name] += sample.value
+        return counters
+
+
+def run_replay(replayer, trace: List[TraceRequest]) -> Dict:
+    counters_before = replayer.read_counters()
+    start = time.perf_counter()
+    results = replayer.run(trace)
+    duration = time.perf_counter() - start
+    counters_after = replayer.read_counters()
+    counters = {name: counters_after[name] - counters_before[name]
+                for name in LMCACHE_COUNTERS}
+    return summarize(results, duration, counters)
+
+
+def make_parser(
+        parser: Optional[argparse.ArgumentParser] = None,
+    ) -> argparse.ArgumentParser:
+    if parser is None:
+        parser = argparse.ArgumentParser(
+            prog="lmcache_vllm replay",
+            description="Replay a request trace and report the TTFT and the "
+                        "LMCache hit rate")
+    parser.add_argument("--trace", required=True,
+                        help="The JSONL trace to replay")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--endpoint",
+                        help="The URL of a running lmcache_vllm server")
+    target.add_argument("--model",
+                        help="The model to run in this process")
+    target.add_argument("--tiny-llama", action="store_true",
+                        help="Run a small randomly initialized Llama on the "
+                             "GPU in this process")
+    parser.add_argument("--served-model-name",
+                        help="The model name to request from the endpoint, "
+                             "defaults to the first served model")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="Multiply the inter-arrival times "
+                             "(0 sends every request at once)")
+    parser.add_argument("--max-tokens", type=int, default=16,
+                        help="The output length of requests without one")
+    parser.add_argument("--num-requests", type=int,
+                        help="Only replay the first requests of the trace")
+    parser.add_argument("--max-model-len", type=int, default=4096)
+    parser.add_argument("--gpu-memory-utilization", type=float, default=0.8)
+    parser.add_argument("--output", help="Write the summary to a JSON file")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = make_parser().parse_args(argv)
+    trace = load_trace(args.trace, args.time_scale, args.max_tokens,
+                       args.num_requests)
+    logger.info(f"Replaying {len(trace)} requests from {args.trace}")
+
+    if args.endpoint is not None:
+        replayer = EndpointReplayer(args.endpoint, args.served_model_name)
+        summary = run_replay(replayer, trace)
+    else:
+        from vllm import EngineArgs
+
+        with tempfile.TemporaryDirectory() as model_dir:
+            if args.tiny_llama:
+                model = make_tiny_llama(model_dir)
+                load_format = "dummy"
+            else:
+                model = args.model
+                load_format = "auto"
+            engine_args = EngineArgs(
+                model=model,
+                load_format=load_format,
+                skip_tokenizer_init=args.tiny_llama,
+                max_model_len=args.max_model_len,
+                gpu_memory_utilization=args.gpu_memory_utilization,
+                device="cuda",
+                enforce_eager=True,
+                disable_log_stats=True,
+            )
+            replayer = LocalReplayer(engine_args)
+            try:
+                summary = run_replay(replayer, trace)
+            finally:
+                replayer.close()
+
+    print_summary(summary)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "summary": summary}, f, indent=2)
+        print(f"Summary is written to {os.path.abspath(args.output)}")
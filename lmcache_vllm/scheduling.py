@@ -0,0 +1,94 @@
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+
+from vllm.sequence import SequenceGroup
+
+from lmcache.logging import init_logger
+
+logger = init_logger(__name__)
+
+
+class CacheAwareWaitingPolicy:
+    """Orders the waiting queue of the vLLM scheduler by the prefill work
+    that is left after the LMCache hit of each request.
+
+    A request with a long cached prefix only prefills its suffix, so running
+    it first lowers the mean time to first token. To prevent starvation,
+    requests that have waited for at least `max_wait` seconds are moved to
+    the front in their arrival order, ahead of any ranked request. Requests
+    that already ran and were preempted by recomputation stay at the head of
+    the queue in their current order, where vLLM put them to resume first.
+
+    The cached prefix length of a request is looked up with
+    `lookup_fn(request_id, token_ids)` and remembered while it waits. If
+    the lookup returns None (e.g., its prefetch has not finished), the
+    request is ranked as uncached and looked up again at the next step.
+    """
+    def __init__(
+            self,
+            lookup_fn: Callable[[str, List[int]], Optional[int]],
+            max_wait: float = 5.0,
+        ):
+        self.lookup_fn = lookup_fn
+        self.max_wait = max_wait
+        self._cached_lens: Dict[str, int] = {}
+
+    def _num_uncached_tokens(self, seq_group: SequenceGroup) -> int:
+        seq = seq_group.get_seqs()[0]
+        num_tokens = seq.get_len()
+        cached_len = self._cached_lens.get(seq_group.request_id)
+        if cached_len is None:
+            cached_len = self.lookup_fn(seq_group.request_id,
+                                        seq.get_token_ids())
+            if cached_len is None:
+                return num_tokens
+            self._cached_lens[seq_group.request_id] = cached_len
+        return num_tokens - min(cached_len, num_tokens)
+
+    @staticmethod
+    def _has_run(seq_group: SequenceGroup) -> bool:
+        seq = seq_group.get_seqs()[0]
+        return seq.get_output_len() > 0 or \
+            seq.data.get_num_computed_tokens() > 0
+
+    def reorder(
+            self,
+            waiting: Deque[SequenceGroup],
+            now: Optional[float] = None,
+        ) -> Deque[SequenceGroup]:
+        """Get the waiting queue in the order to be scheduled.
+
+        :param waiting: The waiting queue of the scheduler, in FCFS order.
+        :type waiting: Deque[SequenceGroup]
+
+        :param now: The current time, defaults to `time.time()`.
+        :type now: Optional[float]
+
+        :return: The reordered waiting queue.
+        :rtype: Deque[SequenceGroup]
+        """
+        # Forget the requests that are not waiting anymore
+        waiting_ids = {seq_group.request_id for seq_group in waiting}
+        for request_id in list(self._cached_lens.keys()):
+            if request_id not in waiting_ids:
+                self._cached_lens.pop(request_id)
+
+        if len(waiting) <= 1:
+            return waiting
+
+        if now is None:
+            now = time.time()
+        resumed = []
+        aged = []
+        ranked = []
+        for seq_group in waiting:
+            if self._has_run(seq_group):
+                resumed.append(seq_group)
+            elif now - seq_group.metrics.arrival_time >= self.max_wait:
+                aged.append(seq_group)
+            else:
+                ranked.append((self._num_uncached_tokens(seq_group),
+                               seq_group.metrics.arrival_time, seq_group))
+        ranked.sort(key=lambda item: item[:2])
+        return deque(resumed + aged + [item[2] for item in ranked])
@@ -1,6 +1,13 @@
+import sys
+
 from lmcache_vllm.vllm import scripts
 
 def main():
+    # `lmcache_vllm replay` is handled here, every other subcommand by vLLM
+    if len(sys.argv) > 1 and sys.argv[1] == "replay":
+        from lmcache_vllm.replay import main as replay_main
+        replay_main(sys.argv[2:])
+        return
     scripts.main()
 
 if __name__ == "__main__":
@@ -0,0 +1,67 @@
+from typing import Dict, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+try:
+    from vllm.engine.metrics_types import StatLoggerBase, Stats
+except ImportError:
+    from vllm.engine.metrics import StatLoggerBase, Stats
+
+from lmcache.logging import init_logger
+from lmcache_vllm.metrics import MetricsRegistry, get_metrics
+
+logger = init_logger(__name__)
+
+# The Prometheus collectors of this process, by metric name. They are shared
+# by the stat loggers of all the engines, as a collector can only be
+# registered once.
+_collectors: Dict[str, object] = {}
+
+
+class LMCacheStatLogger(StatLoggerBase):
+    """Exports the LMCache metrics to Prometheus, next to vLLM's metrics on
+    the `/metrics` endpoint.
+
+    The metrics are recorded in the in-process registry of
+    `lmcache_vllm.metrics`, which is cheap, and forwarded to Prometheus
+    when vLLM logs its stats (every engine step).
+    """
+    def __init__(
+            self,
+            local_interval: float,
+            labels: Dict[str, str],
+            registry: Optional[MetricsRegistry] = None,
+        ):
+        super().__init__(local_interval)
+        self.labels = labels
+        self.registry = registry if registry is not None else get_metrics()
+
+    def _collector(self, cls, metric, **kwargs):
+        collector = _collectors.get(metric.name)
+        if collector is None:
+            collector = cls(
+                name=metric.name,
+                documentation=metric.documentation or metric.name,
+                labelnames=list(self.labels.keys()),
+                **kwargs)
+            _collectors[metric.name] = collector
+        return collector.labels(**self.labels)
+
+    def log(self, stats: Stats) -> None:
+        for metric in list(self.registry.counters.values()):
+            delta = metric.drain()
+            if delta > 0:
+                self._collector(Counter, metric).inc(delta)
+        for metric in list(self.registry.gauges.values()):
+            self._collector(Gauge, metric).set(metric.value)
+        for metric in list(self.registry.histograms.values()):
+            values = metric.drain()
+            if len(values) == 0:
+                continue
+            histogram = self._collector(
+                Histogram, metric, buckets=list(metric.buckets))
+            for value in values:
+                histogram.observe(value)
+
+    def info(self, type: str, obj) -> None:
+        pass
@@ -0,0 +1,335 @@
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, List, Optional, Tuple, Union
+
+import torch
+
+from lmcache.logging import init_logger
+from lmcache_vllm.metrics import get_metrics
+from lmcache_vllm.tracing import trace_span
+from lmcache_vllm.utils.kv_transfer import gather_kv_for_store
+
+logger = init_logger(__name__)
+
+# (tokens, slot_mapping, kv_tensors_mask, chunk_key, on_done) of one sequence
+# to be stored. If chunk_key is not None, the KV is a single chunk put under
+# that key. on_done, if not None, is called with whether the store succeeded.
+StoreRequest = Tuple[torch.Tensor, Union[List[int], torch.Tensor],
+                     torch.Tensor, Optional[str],
+                     Optional[Callable[[bool], None]]]
+
+# What to do when a new store does not fit into the queue
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+BLOCK = "block"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+@dataclass
+class PendingStore:
+    """A gathered KV buffer waiting to be stored.
+
+    :ivar torch.Tensor tokens: The tokens of the sequence (on cpu).
+    :ivar torch.Tensor kv_tensors: The gathered KV shaped [num_layers, 2,
+        num_tokens, num_heads, head_size], in host memory.
+    :ivar torch.Tensor kv_tensors_mask: The mask of the stored tokens.
+    :ivar Optional[torch.cuda.Event] copy_done: Recorded after the gather
+        and the copy were queued. None if the KV caches are on cpu.
+    :ivar Optional[str] chunk_key: The LMCache key to put the KV under as a
+        single chunk, or None to store it through `store_fn`.
+    :ivar Optional[Callable] on_done: Called with True once the KV is in
+        LMCache, or with False if the store failed or was dropped.
+    :ivar float enqueue_time: When the store was queued.
+    """
+    tokens: torch.Tensor
+    kv_tensors: torch.Tensor
+    kv_tensors_mask: torch.Tensor
+    copy_done: Optional[torch.cuda.Event] = None
+    chunk_key: Optional[str] = None
+    on_done: Optional[Callable[[bool], None]] = None
+    enqueue_time: float = field(default_factory=time.perf_counter)
+
+    @property
+    def num_bytes(self) -> int:
+        return self.kv_tensors.nbytes
+
+    def wait(self) -> None:
+        if self.copy_done is not None:
+            self.copy_done.synchronize()
+
+    def done(self, success: bool) -> None:
+        if self.on_done is not None:
+            self.on_done(success)
+
+
+class StoreWorker:
+    """Moves the store path of LMCache off the compute stream, through a
+    bounded queue.
+
+    On CUDA with a side stream, the gather and the device-to-host copy are
+    queued on the side stream that waits for the forward pass through an
+    event. The compute stream in turn only waits for the (device-local)
+    gather, so that later writes into the paged memory cannot race with it,
+    but never for the copy to host memory. A background thread hands every
+    buffer to `store_fn` once its copy has completed, in submission order.
+
+    Without a side stream, the gather and the device-to-host copy are
+    queued on the compute stream instead. Either way a queued store holds
+    host memory only, never GPU memory outside of vLLM's budget. With KV
+    caches on cpu the gather runs on the calling thread. In all cases the
+    background thread hands the buffers to `store_fn` in submission order.
+
+    Requests with a chunk key (e.g., a new decode chunk) are handed to
+    `put_fn` instead, which puts them into the backend without hashing the
+    whole sequence again.
+
+    The queue holds at most `max_depth` stores and `max_bytes` bytes of KV
+    (0 for no limit). When a new store does not fit, the overflow policy
+    either drops the oldest pending stores, drops the new one, or blocks the
+    caller until the background thread makes room. Dropping a store only
+    loses a cache entry, and is reported to its `on_done` callback.
+    """
+    def __init__(
+            self,
+            store_fn: Callable[[torch.Tensor, torch.Tensor, torch.Tensor], None],
+            cuda_stream: Optional[torch.cuda.Stream] = None,
+            put_fn: Optional[Callable[[str, torch.Tensor], None]] = None,
+            max_depth: int = 0,
+            max_bytes: int = 0,
+            overflow_policy: str = DROP_OLDEST,
+        ):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown store queue overflow policy: "
+                             f"{overflow_policy}")
+        self.store_fn = store_fn
+        self.cuda_stream = cuda_stream
+        self.put_fn = put_fn
+        self.max_depth = max_depth
+        self.max_bytes = max_bytes
+        self.overflow_policy = overflow_policy
+
+        self._queue: Deque[PendingStore] = deque()
+        # (copy_done, kv_buffer) of the copies queued on the side stream
+        self._copy_buffers: Deque[Tuple[torch.cuda.Event, torch.Tensor]] = \
+            deque()
+        self._num_bytes = 0
+        self._num_unfinished = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        metrics = get_metrics()
+        self._depth_gauge = metrics.gauge(
+            "lmcache:store_queue_depth", "Number of pending stores")
+        self._bytes_gauge = metrics.gauge(
+            "lmcache:store_queue_bytes", "Bytes of KV of the pending stores")
+        self._dropped_counter = metrics.counter(
+            "lmcache:store_queue_dropped", "Number of dropped stores")
+        self._dropped_bytes_counter = metrics.counter(
+            "lmcache:store_queue_dropped_bytes",
+            "Bytes of KV of the dropped stores")
+        self._queue_time_histogram = metrics.histogram(
+            "lmcache:store_queue_time_seconds",
+            "Time a store waits in the queue")
+        self._block_time_histogram = metrics.histogram(
+            "lmcache:store_queue_block_time_seconds",
+            "Time the model runner is blocked by a full store queue")
+
+        self._thread = threading.Thread(
+            target=self._run, name="lmcache-store-worker", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while len(self._queue) == 0 and not self._closed:
+                    self._cond.wait()
+                if len(self._queue) == 0:
+                    return
+                pending = self._queue.popleft()
+                self._num_bytes -= pending.num_bytes
+                self._update_gauges()
+                self._cond.notify_all()
+
+            self._queue_time_histogram.observe(
+                time.perf_counter() - pending.enqueue_time)
+            try:
+                pending.wait()
+                if pending.chunk_key is not None:
+                    assert self.put_fn is not None
+                    self.put_fn(pending.chunk_key, pending.kv_tensors)
+                else:
+                    self.store_fn(pending.tokens, pending.kv_tensors,
+                                  pending.kv_tensors_mask)
+            except Exception as e:
+                logger.error("Failed to store KV cache into LMCache", exc_info=e)
+                pending.done(False)
+            else:
+                pending.done(True)
+            finally:
+                with self._cond:
+                    self._num_unfinished -= 1
+                    self._cond.notify_all()
+
+    def _update_gauges(self) -> None:
+        self._depth_gauge.set(len(self._queue))
+        self._bytes_gauge.set(self._num_bytes)
+
+    def _is_full(self, num_bytes: int) -> bool:
+        if len(self._queue) == 0:
+            # A single store larger than max_bytes is still accepted
+            return False
+        if self.max_depth > 0 and len(self._queue) >= self.max_depth:
+            return True
+        return self.max_bytes > 0 and self._num_bytes + num_bytes > self.max_bytes
+
+    def _drop(self, pending: PendingStore) -> None:
+        self._dropped_counter.inc()
+        self._dropped_bytes_counter.inc(pending.num_bytes)
+        self._num_unfinished -= 1
+        pending.done(False)
+
+    def _put(self, pending: PendingStore) -> None:
+        with self._cond:
+            self._num_unfinished += 1
+            if self._is_full(pending.num_bytes):
+                if self.overflow_policy == DROP_NEWEST:
+                    logger.debug("Store queue is full, dropping the new store")
+                    self._drop(pending)
+                    return
+                elif self.overflow_policy == DROP_OLDEST:
+                    while self._is_full(pending.num_bytes):
+                        logger.debug("Store queue is full, dropping the "
+                                     "oldest store")
+                        oldest = self._queue.popleft()
+                        self._num_bytes -= oldest.num_bytes
+                        self._drop(oldest)
+                else:
+                    start = time.perf_counter()
+                    while self._is_full(pending.num_bytes):
+                        self._cond.wait()
+                    self._block_time_histogram.observe(
+                        time.perf_counter() - start)
+
+            pending.enqueue_time = time.perf_counter()
+            self._queue.append(pending)
+            self._num_bytes += pending.num_bytes
+            self._update_gauges()
+            self._cond.notify_all()
+
+    def _use_cuda_stream(self, kv_caches: List[torch.Tensor]) -> bool:
+        return self.cuda_stream is not None and kv_caches[0].is_cuda
+
+    def submit(
+            self,
+            store_requests: List[StoreRequest],
+            kv_caches: List[torch.Tensor],
+            num_layers: int,
+        ) -> None:
+        """Queue the gather, the copy to host memory and the store of the
+        given sequences.
+
+        :param store_requests: (tokens, slot_mapping, kv_tensors_mask,
+            chunk_key, on_done) of each sequence to be stored.
+        :type store_requests: List[StoreRequest]
+
+        :param kv_caches: The paged memory to get KV from.
+        :type kv_caches: List[torch.Tensor]
+
+        :param num_layers: The number of layers to store.
+        :type num_layers: int
+        """
+        if len(store_requests) == 0:
+            return
+
+        with trace_span("store_gather", num_seqs=len(store_requests)):
+            self._submit(store_requests, kv_caches, num_layers)
+
+    def _submit(
+            self,
+            store_requests: List[StoreRequest],
+            kv_caches: List[torch.Tensor],
+            num_layers: int,
+        ) -> None:
+        if not self._use_cuda_stream(kv_caches):
+            for tokens, slot_mapping, mask, chunk_key, on_done in \
+                    store_requests:
+                kv_tensors = gather_kv_for_store(
+                    kv_caches, slot_mapping, num_layers)
+                copy_done = None
+                if kv_tensors.is_cuda:
+                    # The pending stores are kept in host memory. The copy
+                    # is ordered after the gather on the compute stream, so
+                    # the gathered buffer can be freed right away.
+                    kv_buffer = kv_tensors
+                    kv_tensors = torch.empty(
+                        kv_buffer.shape, dtype=kv_buffer.dtype,
+                        pin_memory=True)
+                    kv_tensors.copy_(kv_buffer, non_blocking=True)
+                    # The background thread may not use the compute stream
+                    copy_done = torch.cuda.Event()
+                    copy_done.record()
+                self._put(PendingStore(
+                    tokens, kv_tensors, mask, copy_done, chunk_key, on_done))
+            return
+
+        compute_stream = torch.cuda.current_stream()
+        forward_done = torch.cuda.Event()
+        forward_done.record(compute_stream)
+        self._release_copied_buffers()
+
+        pending_list = []
+        with torch.cuda.stream(self.cuda_stream):
+            self.cuda_stream.wait_event(forward_done)
+            kv_buffers = [gather_kv_for_store(kv_caches, slot_mapping,
+                                              num_layers)
+                          for _, slot_mapping, _, _, _ in store_requests]
+            gather_done = torch.cuda.Event()
+            gather_done.record(self.cuda_stream)
+
+            for (tokens, _, mask, chunk_key, on_done), kv_buffer in \
+                    zip(store_requests, kv_buffers):
+                kv_tensors = torch.empty(
+                    kv_buffer.shape, dtype=kv_buffer.dtype, pin_memory=True)
+                kv_tensors.copy_(kv_buffer, non_blocking=True)
+                copy_done = torch.cuda.Event()
+                copy_done.record(self.cuda_stream)
+                # The gathered buffer must outlive its copy
+                self._copy_buffers.append((copy_done, kv_buffer))
+                pending_list.append(PendingStore(
+                    tokens, kv_tensors, mask, copy_done, chunk_key, on_done))
+
+        # NOTE: vLLM may overwrite the gathered blocks before the next
+        # forward pass (e.g., swap-in or copy-on-write into freed blocks),
+        # so the compute stream waits for the gathers right away. The event
+        # is recorded before the copies are queued, so it does not wait for
+        # the device-to-host copies.
+        compute_stream.wait_event(gather_done)
+
+        for pending in pending_list:
+            self._put(pending)
+
+    def _release_copied_buffers(self) -> None:
+        """Drop the gathered device buffers whose copy to host memory has
+        completed."""
+        while len(self._copy_buffers) > 0 and \
+                self._copy_buffers[0][0].query():
+            self._copy_buffers.popleft()
+
+    def flush(self) -> None:
+        """Block until every submitted store has been handed to `store_fn`.
+        """
+        with self._cond:
+            while self._num_unfinished > 0:
+                self._cond.wait()
+
+    def close(self) -> None:
+        """Flush the pending stores and stop the background thread.
+        """
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._copy_buffers.clear()
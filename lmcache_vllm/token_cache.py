@@ -0,0 +1,113 @@
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+import torch
+
+from vllm.sequence import SequenceData
+
+
+class SeqTokenBuffer:
+    """A growable, compact token buffer of one sequence.
+    """
+    def __init__(self, request_id: str, dtype: torch.dtype):
+        self.request_id = request_id
+        self.buffer = torch.empty(0, dtype=dtype)
+        self.length = 0
+
+    def sync(self, token_ids) -> None:
+        """Append the tokens of `token_ids` that are not in the buffer yet.
+        """
+        num_tokens = len(token_ids)
+        if num_tokens < self.length:
+            # The sequence was reset, rebuild the buffer
+            self.length = 0
+        if num_tokens == self.length:
+            return
+
+        if num_tokens > self.buffer.shape[0]:
+            capacity = max(num_tokens, 2 * self.buffer.shape[0])
+            new_buffer = torch.empty(capacity, dtype=self.buffer.dtype)
+            new_buffer[:self.length] = self.buffer[:self.length]
+            self.buffer = new_buffer
+        self.buffer[self.length:num_tokens] = torch.tensor(
+            token_ids[self.length:num_tokens], dtype=self.buffer.dtype)
+        self.length = num_tokens
+
+
+class TokenTensorCache:
+    """Per-sequence token tensors shared by the retrieve, store and blend
+    paths, keyed by `seq_id`.
+
+    The tokens are kept in a compact buffer (int32 when the vocabulary
+    allows) that only grows by appending the new tokens of a sequence. The
+    int64 tensor handed out to LMCache, which hashes the token bytes, is
+    cached until the sequence grows, so the paths of one step share it.
+    """
+    def __init__(self, dtype: torch.dtype = torch.int32):
+        self.dtype = dtype
+        self._buffers: Dict[int, SeqTokenBuffer] = {}
+        self._request_to_seq_ids: Dict[str, Set[int]] = {}
+        # seq_id -> (num_tokens, int64 token tensor)
+        self._last_tokens: Dict[int, Tuple[int, torch.Tensor]] = {}
+
+    def get_tokens(
+            self,
+            seq_id: int,
+            request_id: str,
+            seq_data: SequenceData,
+            num_tokens: int,
+        ) -> torch.Tensor:
+        """Get the first `num_tokens` tokens of a sequence.
+
+        :return: The tokens as an int64 tensor on cpu. It must not be
+            modified in place.
+        :rtype: torch.Tensor
+        """
+        last = self._last_tokens.get(seq_id)
+        if last is not None and last[0] == num_tokens:
+            return last[1]
+
+        seq_buffer = self._buffers.get(seq_id)
+        if seq_buffer is None:
+            seq_buffer = SeqTokenBuffer(request_id, self.dtype)
+            self._buffers[seq_id] = seq_buffer
+            self._request_to_seq_ids.setdefault(request_id, set()).add(seq_id)
+        if seq_buffer.length < num_tokens:
+            seq_buffer.sync(seq_data.get_token_ids())
+        assert num_tokens <= seq_buffer.length
+
+        tokens = seq_buffer.buffer[:num_tokens]
+        if tokens.dtype != torch.long:
+            tokens = tokens.to(torch.long)
+        self._last_tokens[seq_id] = (num_tokens, tokens)
+        return tokens
+
+    def remove_requests(self, request_ids: Iterable[str]) -> None:
+        """Drop the buffers of the sequences of finished requests.
+        """
+        for request_id in request_ids:
+            for seq_id in self._request_to_seq_ids.pop(request_id, ()):
+                self._buffers.pop(seq_id, None)
+                self._last_tokens.pop(seq_id, None)
+
+
+g_token_cache: Optional[TokenTensorCache] = None
+
+
+def init_token_cache(vocab_size: int) -> TokenTensorCache:
+    """Create the token cache with the most compact dtype for `vocab_size`.
+    """
+    global g_token_cache
+    if g_token_cache is None:
+        dtype = torch.int32 if vocab_size <= torch.iinfo(torch.int32).max \
+            else torch.int64
+        g_token_cache = TokenTensorCache(dtype)
+    return g_token_cache
+
+
+def get_token_cache() -> TokenTensorCache:
+    """Get the token cache, creating an int64 one if it is not initialized.
+    """
+    global g_token_cache
+    if g_token_cache is None:
+        g_token_cache = TokenTensorCache(torch.int64)
+    return g_token_cache
@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import torch
+
+from lmcache.logging import init_logger
+from lmcache_vllm.lmcache_utils import get_env_flag, get_env_int
+
+logger = init_logger(__name__)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer: "StepTracer", name: str, args: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.record_function = None
+
+    def __enter__(self):
+        if self.tracer.profiler is not None:
+            self.record_function = torch.profiler.record_function(self.name)
+            self.record_function.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.tracer.sync_cuda and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        end = time.perf_counter()
+        if self.record_function is not None:
+            self.record_function.__exit__(exc_type, exc_value, traceback)
+        self.tracer.add_event(self.name, self.start, end, self.args)
+        return False
+
+
+class StepTracer:
+    """Records the spans of the LMCache hot paths for a window of model
+    runner steps and writes them as a Chrome trace (chrome://tracing or
+    Perfetto).
+
+    The window starts at step `start_step` and lasts `num_steps` steps.
+    Optionally the window is also captured by `torch.profiler`, whose trace
+    is written next to the span trace and contains the spans as
+    `record_function` ranges. With `sync_cuda`, every span synchronizes the
+    device when it ends, so it includes the GPU time of its work.
+    """
+    def __init__(
+            self,
+            output_dir: str,
+            num_steps: int = 20,
+            start_step: int = 0,
+            use_torch_profiler: bool = False,
+            sync_cuda: bool = False,
+        ):
+        self.output_dir = output_dir
+        self.num_steps = num_steps
+        self.start_step = start_step
+        self.use_torch_profiler = use_torch_profiler
+        self.sync_cuda = sync_cuda
+
+        self.step = 0
+        self.active = False
+        self.finished = False
+        self.profiler: Optional[torch.profiler.profile] = None
+        self._events: List[Dict[str, Any]] = []
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+
+    def span(self, name: str, **args):
+        if not self.active:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def add_event(self, name: str, start: float, end: float,
+                  args: Dict[str, Any]) -> None:
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self._origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": self._pid,
+            "tid": threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+        # list.append is atomic, spans may end on the retrieval threads
+        self._events.append(event)
+
+    def step_begin(self) -> None:
+        if self.finished or self.step != self.start_step:
+            return
+        logger.info(f"Tracing LMCache for {self.num_steps} steps")
+        self.active = True
+        if self.use_torch_profiler:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities)
+            self.profiler.__enter__()
+
+    def step_end(self) -> None:
+        self.step += 1
+        if self.active and self.step >= self.start_step + self.num_steps:
+            self._finish()
+
+    def _finish(self) -> None:
+        self.active = False
+        self.finished = True
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(
+            self.output_dir,
+            f"lmcache_trace_{self._pid}_steps_{self.start_step}"
+            f"-{self.start_step + self.num_steps}")
+
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            self.profiler.export_chrome_trace(f"{prefix}_torch.json")
+            self.profiler = None
+
+        with open(f"{prefix}.json", "w") as f:
+            json.dump({"traceEvents": self._events,
+                       "displayTimeUnit": "ms"}, f)
+        logger.info(f"LMCache trace is written to {prefix}.json")
+        self._events = []
+
+
+g_tracer: Optional[StepTracer] = None
+g_tracer_checked = False
+
+
+def get_tracer() -> Optional[StepTracer]:
+    """Get the tracer, which is enabled by setting the environment variable
+    `LMCACHE_TRACE_DIR` to the output directory. `LMCACHE_TRACE_STEPS` (20)
+    and `LMCACHE_TRACE_START_STEP` (0) set the traced window,
+    `LMCACHE_TRACE_TORCH_PROFILER` also captures it with torch.profiler and
+    `LMCACHE_TRACE_SYNC_CUDA` makes spans include their GPU time.
+    """
+    global g_tracer, g_tracer_checked
+    if not g_tracer_checked:
+        g_tracer_checked = True
+        output_dir = os.environ.get("LMCACHE_TRACE_DIR")
+        if output_dir:
+            g_tracer = StepTracer(
+                output_dir,
+                get_env_int("LMCACHE_TRACE_STEPS", 20),
+                get_env_int("LMCACHE_TRACE_START_STEP", 0),
+                get_env_flag("LMCACHE_TRACE_TORCH_PROFILER"),
+                get_env_flag("LMCACHE_TRACE_SYNC_CUDA"))
+    return g_tracer
+
+
+def trace_span(name: str, **args):
+    """A context manager recording a span named `name` if tracing is active.
+    It is a no-op object otherwise.
+    """
+    tracer = g_tracer if g_tracer_checked else get_tracer()
+    if tracer is None:
+        return _NULL_SPAN
+    return tracer.span(name, **args)
+
+
+def trace_step_begin() -> None:
+    tracer = get_tracer()
+    if tracer is not None:
+        tracer.step_begin()
+
+
+def trace_step_end() -> None:
+    tracer = get_tracer()
+    if tracer is not None:
+        tracer.step_end()
+
+
+def close_tracer() -> None:
+    """Write the trace of a window that is still being captured, e.g., when
+    the engine shuts down before the last traced step.
+    """
+    if g_tracer is not None and g_tracer.active:
+        g_tracer._finish()
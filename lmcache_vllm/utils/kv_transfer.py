@@ -0,0 +1,159 @@
+from typing import List, Union
+
+import torch
+
+from vllm import _custom_ops as ops
+
+from lmcache.utils import KVCache
+
+
+def slot_mapping_to_tensor(
+        slot_mapping: Union[List[int], torch.Tensor],
+        device: Union[str, torch.device],
+    ) -> torch.Tensor:
+    """Convert a vLLM slot mapping into a flat int64 index tensor on `device`.
+
+    :param slot_mapping: The slot mapping as a python list or a tensor.
+    :param device: The device of the paged KV cache.
+
+    :return: The slot mapping as a 1-D `torch.long` tensor.
+    :rtype: torch.Tensor
+    """
+    if not torch.is_tensor(slot_mapping):
+        slot_mapping = torch.tensor(slot_mapping, dtype=torch.long)
+    return slot_mapping.flatten().to(device=device, dtype=torch.long,
+                                     non_blocking=True)
+
+
+def gather_kv_for_store(
+        kv_caches: List[torch.Tensor],
+        slot_mapping: Union[List[int], torch.Tensor],
+        num_layers: int,
+    ) -> torch.Tensor:
+    """Gather the K and V of the given slots for the first `num_layers`
+    paged caches into a single contiguous buffer.
+
+    Each paged cache is shaped [2, num_blocks, block_size, num_heads,
+    head_size]. The slot mapping is converted once and every layer is
+    gathered with a single `index_select` over both K and V, directly into
+    its slice of the output buffer.
+
+    :param kv_caches: The paged memory of the current pipeline stage.
+    :type kv_caches: List[torch.Tensor]
+
+    :param slot_mapping: The slots to gather.
+    :type slot_mapping: Union[List[int], torch.Tensor]
+
+    :param num_layers: The number of layers to gather (end_layer - start_layer).
+    :type num_layers: int
+
+    :return: The gathered KV shaped [num_layers, 2, num_tokens, num_heads,
+        head_size]. Indexing it by layer yields (K, V) pairs, the same layout
+        LMCacheEngine.store expects for the vllm format.
+    :rtype: torch.Tensor
+    """
+    first_cache = kv_caches[0]
+    _, _, _, num_heads, head_size = first_cache.shape
+    slot_tensor = slot_mapping_to_tensor(slot_mapping, first_cache.device)
+    num_tokens = slot_tensor.shape[0]
+
+    kv_buffer = torch.empty(
+        (num_layers, 2, num_tokens, num_heads, head_size),
+        dtype=first_cache.dtype,
+        device=first_cache.device)
+    if num_tokens == 0:
+        return kv_buffer
+
+    for layer_idx in range(num_layers):
+        flat_cache = kv_caches[layer_idx].view(2, -1, num_heads, head_size)
+        torch.index_select(flat_cache, 1, slot_tensor, out=kv_buffer[layer_idx])
+    return kv_buffer
+
+
+def concat_layer_kv(
+        kv_tuples: List[KVCache],
+        layer_idx: int,
+        device: Union[str, torch.device],
+    ) -> torch.Tensor:
+    """Concatenate the K and V of one layer over all the given retrieval
+    results and move them to `device` with a single transfer.
+
+    :param kv_tuples: The KV retrieved from LMCache for each sequence.
+    :type kv_tuples: List[KVCache]
+
+    :param layer_idx: The layer to concatenate.
+    :type layer_idx: int
+
+    :param device: The device of the paged KV cache.
+
+    :return: The KV of the layer shaped [2, num_tokens, num_heads, head_size].
+    :rtype: torch.Tensor
+    """
+    first_k = kv_tuples[0][layer_idx][0]
+    _, num_heads, head_size = first_k.shape
+    num_tokens = sum(kv[layer_idx][0].shape[0] for kv in kv_tuples)
+    target_device = torch.device(device)
+
+    if first_k.device == target_device:
+        staging_device = target_device
+        pin_memory = False
+    else:
+        staging_device = first_k.device
+        pin_memory = first_k.device.type == "cpu" and \
+            target_device.type == "cuda"
+
+    kv_buffer = torch.empty(
+        (2, num_tokens, num_heads, head_size),
+        dtype=first_k.dtype,
+        device=staging_device,
+        pin_memory=pin_memory)
+    offset = 0
+    for kv in kv_tuples:
+        k, v = kv[layer_idx][0], kv[layer_idx][1]
+        kv_buffer[0, offset:offset + k.shape[0]].copy_(k)
+        kv_buffer[1, offset:offset + v.shape[0]].copy_(v)
+        offset += k.shape[0]
+    return kv_buffer.to(target_device, non_blocking=True)
+
+
+def scatter_kv_to_paged_cache(
+        kv_cache: torch.Tensor,
+        kv: torch.Tensor,
+        slot_mapping: torch.Tensor,
+    ) -> None:
+    """Write KV shaped [2, num_tokens, num_heads, head_size] into the given
+    slots of a paged cache shaped [2, num_blocks, block_size, num_heads,
+    head_size]. Pure torch fallback of `reshape_and_cache_flash`.
+    """
+    _, _, _, num_heads, head_size = kv_cache.shape
+    flat_cache = kv_cache.view(2, -1, num_heads, head_size)
+    flat_cache.index_copy_(1, slot_mapping.to(torch.long),
+                           kv.to(flat_cache.dtype))
+
+
+def inject_layer_kv(
+        attn: torch.nn.Module,
+        kv_cache: torch.Tensor,
+        kv: torch.Tensor,
+        slot_mapping: torch.Tensor,
+    ) -> None:
+    """Put the KV of one layer into the paged cache with one kernel call.
+
+    :param attn: The vLLM `Attention` module of the layer.
+    :param kv_cache: The paged cache of the layer.
+    :param kv: The KV shaped [2, num_tokens, num_heads, head_size].
+    :param slot_mapping: The slots to put the KV to.
+    """
+    if not kv_cache.is_cuda:
+        scatter_kv_to_paged_cache(kv_cache, kv, slot_mapping)
+        return
+    ops.reshape_and_cache_flash(
+        kv[0],
+        kv[1],
+        kv_cache[0],
+        kv_cache[1],
+        slot_mapping,
+        attn.kv_cache_dtype,
+        attn._k_scale,
+        attn._v_scale,
+    )
@@ -80,9 +80,11 @@ def validate_reverse_correctness(
     hidden_dim = head_size * 8
     num_tokens = 10
 
-    dumb_q = torch.rand((num_tokens, hidden_dim), device = "cuda", dtype = torch.bfloat16)
-    dumb_k = torch.rand((num_tokens, hidden_dim), device = "cuda", dtype = torch.bfloat16)
-    positions = torch.arange(num_tokens)
+    # Validate on cpu if there is no GPU, e.g., with the CPU backend
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dumb_q = torch.rand((num_tokens, hidden_dim), device = device, dtype = torch.bfloat16)
+    dumb_k = torch.rand((num_tokens, hidden_dim), device = device, dtype = torch.bfloat16)
+    positions = torch.arange(num_tokens, device = device)
 
     q1 = dumb_q.clone()
     k1 = dumb_k.clone()
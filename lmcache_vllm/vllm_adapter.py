@@ -1,20 +1,19 @@
-from typing import TYPE_CHECKING, List, Optional, Tuple
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from types import SimpleNamespace
 from enum import Enum
 import os
+import time
 import torch
 import dataclasses
-from copy import deepcopy
-from torch.nn.utils.rnn import pad_sequence
-from dataclasses import dataclass
-from torch import nn
-import torch.distributed as dist
+import copy
+import functools
 from vllm.attention.backends.utils import compute_slot_mapping
+from vllm.distributed import get_world_group
 
 if TYPE_CHECKING:
     from vllm.worker.model_runner import ModelInputForGPUWithSamplingMetadata
 
-from vllm import _custom_ops as ops
 from vllm.sequence import SequenceGroupMetadata
 from vllm.config import ModelConfig, ParallelConfig, CacheConfig
 from vllm.utils import get_kv_cache_torch_dtype
@@ -22,14 +21,51 @@ from vllm.utils import get_kv_cache_torch_dtype
 from lmcache.logging import init_logger
 from lmcache.cache_engine import LMCacheEngine, LMCacheEngineBuilder
 from lmcache.config import LMCacheEngineConfig, LMCacheEngineMetadata
-from lmcache.utils import _lmcache_nvtx_annotate
-from lmcache_vllm.lmcache_utils import ENGINE_NAME
+from lmcache.utils import _lmcache_nvtx_annotate, KVCache
+from lmcache_vllm.lmcache_utils import (ENGINE_NAME, get_env_flag, get_env_int,
+        get_env_float, get_env_str)
 from lmcache_vllm.blend_adapter import drop_blend_spt, remove_request_id_indices
+from lmcache_vllm.utils.kv_transfer import concat_layer_kv, inject_layer_kv
+from lmcache_vllm.store_worker import StoreWorker
+from lmcache_vllm.prefix_memo import PrefixHashMemo
+from lmcache_vllm.metadata_broadcast import SeqMetadataBroadcaster
+from lmcache_vllm.token_cache import get_token_cache, init_token_cache
+from lmcache_vllm.prefetcher import ChunkPromoter, Prefetcher
+from lmcache_vllm.scheduling import CacheAwareWaitingPolicy
+from lmcache_vllm.metrics import get_metrics
+from lmcache_vllm.model_layout import create_model_input_subset
+from lmcache_vllm.tracing import trace_span, close_tracer
+from lmcache_vllm.admission import (RetrievalAdmissionController,
+        CountMinSketch, StoreAdmissionFilter)
+from lmcache_vllm.layerwise_injection import (LayerwiseInjectionTask,
+        install_layerwise_hooks, start_layerwise_injection)
 
 logger = init_logger(__name__)
 
 
-LMCACHE_CUDA_STREAM = torch.cuda.Stream()
+LMCACHE_CUDA_STREAM = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+# The background worker of the asynchronous store mode
+g_store_worker: Optional[StoreWorker] = None
+# The thread pool of concurrent retrieval
+g_retrieve_pool: Optional[ThreadPoolExecutor] = None
+# The per-sequence prefix hashes and stored lengths
+g_prefix_memo: Optional[PrefixHashMemo] = None
+# The delta broadcaster of seq_group_metadata_list under tensor parallelism
+g_metadata_broadcaster: Optional[SeqMetadataBroadcaster] = None
+# The prefetcher of the KV of waiting requests
+g_prefetcher: Optional[Prefetcher] = None
+# The cache-aware order of the waiting queue of the scheduler
+g_waiting_policy: Optional[CacheAwareWaitingPolicy] = None
+# Whether `LMCACHE_SCHED_POLICY` has been read into g_waiting_policy
+g_waiting_policy_resolved: bool = False
+# The cost-model-based admission of retrievals
+g_retrieval_admission: Optional[RetrievalAdmissionController] = None
+# Whether the retrieval admission is turned off despite its environment
+# variable (e.g., with more than one worker)
+g_retrieval_admission_disabled: bool = False
+# The frequency-based admission of prefill stores
+g_store_admission: Optional[StoreAdmissionFilter] = None
 
 class StoreStatus(Enum):
     PREFILL = 1
@@ -44,6 +80,8 @@ class RetrieveStatus(Enum):
     CHUNK_PREFILL_LAST = 3
     NONE = 4
 
+# The checkpoints whose prompts are patched to cache the decode KV. The
+# layers of a model are found by its architecture, see `model_layout`.
 SUPPORTED_MODELS = SimpleNamespace(
     llama_family = ["meta-llama/Llama-3.1-8B-Instruct"],
     longchat_family = ["lmsys/longchat-7b-16k"],
@@ -52,55 +90,6 @@ SUPPORTED_MODELS = SimpleNamespace(
     qwen_family = ["Qwen/Qwen-7B"],
 )
 
-@dataclass
-class ModelInputSubset:
-    model_layers: List[nn.Module]
-    attn_layers: List[nn.Module]
-    start_layer: int
-    end_layer: int
-    
-
-def create_model_input_subset(
-    model_name: str,
-    model_executable: "ModelInputForGPUWithSamplingMetadata",
-) -> ModelInputSubset:
-    if model_name in SUPPORTED_MODELS.llama_family or \
-        model_name in SUPPORTED_MODELS.mistral_family:
-        model = model_executable.model
-        model_layers = model.layers
-        attn_layers = [layer.self_attn for layer in model_layers]
-    elif model_name in SUPPORTED_MODELS.glm_family:
-        model = model_executable.transformer
-        model_layers = model.encoder.layers
-        attn_layers = [layer.self_attention for layer in model_layers]
-    else:
-        # FIXME(Jiayi): `else` is the default setting, which could be wrong
-        model = model_executable.model
-        model_layers = model.layers
-        attn_layers = [layer.self_attn for layer in model_layers]
-    
-    # FIXME(Jiayi): ChatGLM does not have `model` or `start_layer`
-    # How does PP work in this case?
-    if hasattr(model, "start_layer"):
-        start_layer = model.start_layer
-    else:
-        start_layer = 0
-
-    if hasattr(model, "end_layer"):
-        end_layer = model.end_layer
-    else:
-        end_layer = len(model_layers)
-    
-    model_input_subset = ModelInputSubset(
-        model_layers=model_layers,
-        attn_layers=attn_layers,
-        start_layer=start_layer,
-        end_layer=end_layer
-    )
-    
-    return model_input_subset
-
-
 def lmcache_get_config() -> LMCacheEngineConfig:
     """Get the LMCache configuration from the environment variable
     `LMCACHE_CONFIG_FILE`. If the environment variable is not set, this
@@ -191,6 +180,8 @@ def init_lmcache_engine(
             config,
             metadata)
 
+    init_token_cache(model_config.get_vocab_size())
+
     return engine
 
 def broadcast_seq_group_metadata(
@@ -199,6 +190,9 @@ def broadcast_seq_group_metadata(
     ) -> "ModelInputForGPUWithSamplingMetadata":
     """Brodcast the `model_input` from driver worker to non-driver workers.
 
+    Only the request ids, the newly appended tokens and the block-table
+    changes since the last step are sent, see `SeqMetadataBroadcaster`.
+
     :param model_input: The model input for the current request.
     :type model_input: ModelInputForGPUWithSamplingMetadata
 
@@ -208,36 +202,366 @@ def broadcast_seq_group_metadata(
     : return: Original `model_input` if driver_worker.
               Broadcasted `model_input` otherwise.
     """
+    world_group = get_world_group()
+    if world_group.world_size == 1:
+        return model_input
+
+    global g_metadata_broadcaster
+    if g_metadata_broadcaster is None:
+        g_metadata_broadcaster = SeqMetadataBroadcaster(
+            group=world_group.cpu_group, src=world_group.first_rank)
 
-    # broadcast len of `seq_group_metadata_list`
-    if is_driver_worker:
-        seq_group_len = [len(model_input.seq_group_metadata_list)]
-    else:
-        seq_group_len = [0]
-    dist.broadcast_object_list(seq_group_len, src=0)
-    seq_group_len = seq_group_len[0]
-    
-    # broadcast `seq_group_metadata_list`
-    if is_driver_worker:
-        seq_group_metadata_list = model_input.seq_group_metadata_list
-    else:
-        seq_group_metadata_list = [None] * seq_group_len
-    dist.broadcast_object_list(seq_group_metadata_list , src=0)
-    
     if is_driver_worker:
+        g_metadata_broadcaster.broadcast(
+            model_input.seq_group_metadata_list, is_driver_worker)
         return model_input
     else:
+        seq_group_metadata_list = g_metadata_broadcaster.broadcast(
+            None, is_driver_worker)
         return dataclasses.replace(model_input, seq_group_metadata_list=seq_group_metadata_list)
 
+def get_prefix_memo(engine: LMCacheEngine) -> PrefixHashMemo:
+    """Get the per-sequence prefix hash memo shared by retrieve and store.
+    """
+    global g_prefix_memo
+    if g_prefix_memo is None:
+        g_prefix_memo = PrefixHashMemo.from_engine(engine)
+    return g_prefix_memo
+
+def lmcache_lookup_seq(
+        engine: LMCacheEngine,
+        prefix_memo: PrefixHashMemo,
+        seq_id: int,
+        request_id: str,
+        tokens: torch.Tensor,
+        include_pending: bool = True,
+    ) -> int:
+    """Get the number of leading tokens of a sequence that are in LMCache
+    (or queued to be stored). The chunk hashes are memoized, so only the
+    chunks completed since the last lookup of the sequence are hashed.
+
+    :param include_pending: Whether the tokens queued to be stored count as
+        cached. Pass False to get only what a retrieval can load.
+    :type include_pending: bool
+
+    :return: The number of cached leading tokens.
+    :rtype: int
+    """
+    if prefix_memo.contains_fn is not None:
+        prefix_memo.get_state(seq_id, request_id)
+    num_hit_tokens = prefix_memo.lookup(seq_id, tokens, include_pending)
+    if num_hit_tokens is None:
+        # The memo cannot check the backend, so ask the engine once
+        num_hit_tokens = engine.lookup(tokens)
+        prefix_memo.record_stored(seq_id, request_id, num_hit_tokens)
+    return num_hit_tokens
+
+def lmcache_free_finished_requests(
+        finished_requests_ids: Optional[List[str]],
+    ) -> None:
+    """Drop the per-sequence states of the finished requests.
+
+    :param finished_requests_ids: The requests finished since the last step.
+    :type finished_requests_ids: Optional[List[str]]
+    """
+    if not finished_requests_ids:
+        return
+    if g_prefix_memo is not None:
+        g_prefix_memo.remove_requests(finished_requests_ids)
+    if g_metadata_broadcaster is not None:
+        g_metadata_broadcaster.remove_requests(finished_requests_ids)
+    get_token_cache().remove_requests(finished_requests_ids)
+
+def lmcache_put_chunk(
+        engine: LMCacheEngine,
+        chunk_key: str,
+        kv_chunk: torch.Tensor,
+        blocking: bool = True,
+    ) -> None:
+    """Put a single chunk of KV into the storage backend of LMCache.
+
+    :param chunk_key: The key built from the rolling prefix hash of the chunk.
+    :type chunk_key: str
+
+    :param kv_chunk: The KV of the chunk shaped [num_layers, 2, chunk_size,
+        num_heads, head_size].
+    :type kv_chunk: torch.Tensor
+    """
+    engine.engine_.put(chunk_key, kv_chunk, blocking = blocking)
+
+def get_prefetcher() -> Optional[Prefetcher]:
+    """Get the prefetcher, which is enabled by the environment variable
+    `LMCACHE_PREFETCH`. The size of its queue is set by
+    `LMCACHE_PREFETCH_QUEUE_SIZE`.
+
+    :return: The prefetcher or None if prefetching is disabled or not
+        supported by the LMCache engine.
+    :rtype: Optional[Prefetcher]
+    """
+    global g_prefetcher
+    if g_prefetcher is not None:
+        return g_prefetcher
+    if not get_env_flag("LMCACHE_PREFETCH"):
+        return None
+    engine = LMCacheEngineBuilder.get(ENGINE_NAME)
+    if engine is None:
+        return None
+
+    promoter = ChunkPromoter.from_engine(engine)
+    if promoter is None:
+        logger.warning("LMCache engine does not expose its chunk hash and "
+                       "backend, prefetching is disabled")
+        return None
+    if promoter.slow_backend is None:
+        logger.info("LMCache has a single storage tier, prefetching only "
+                    "looks up the cached prefix")
+    logger.info("KV cache prefetching is enabled")
+    g_prefetcher = Prefetcher(
+        promoter, get_env_int("LMCACHE_PREFETCH_QUEUE_SIZE", 64))
+    return g_prefetcher
+
+def lmcache_prefetch(request_id: str, prompt_token_ids: List[int]) -> None:
+    """Start prefetching the KV of a request that just arrived.
+
+    :param request_id: The request id.
+    :type request_id: str
+
+    :param prompt_token_ids: The tokens of the prompt.
+    :type prompt_token_ids: List[int]
+    """
+    prefetcher = get_prefetcher()
+    if prefetcher is None or len(prompt_token_ids) == 0:
+        return
+    prefetcher.submit(
+        request_id, torch.tensor(prompt_token_ids, dtype=torch.long))
+
+def lmcache_cancel_prefetch(request_ids: Iterable[str]) -> None:
+    """Cancel the prefetch of aborted or finished requests.
+
+    :param request_ids: The request ids.
+    :type request_ids: Iterable[str]
+    """
+    if g_prefetcher is not None:
+        g_prefetcher.cancel(request_ids)
+
+def lmcache_lookup_cached_prefix(
+        request_id: str,
+        token_ids: List[int],
+    ) -> Optional[int]:
+    """Get the number of leading tokens of a request that are in LMCache.
+
+    With prefetching enabled, the result of the prefetch of the request is
+    used, so the scheduler never waits for the backend. Only without a
+    prefetcher is the prefix looked up synchronously.
+
+    :param request_id: The request id.
+    :type request_id: str
+
+    :param token_ids: The tokens of the request.
+    :type token_ids: List[int]
+
+    :return: The number of cached leading tokens, or None if the prefetch
+        of the request has not finished yet.
+    :rtype: Optional[int]
+    """
+    engine = LMCacheEngineBuilder.get(ENGINE_NAME)
+    if engine is None or len(token_ids) == 0:
+        return 0
+    if g_prefetcher is not None:
+        return g_prefetcher.get_num_cached_tokens(request_id)
+    return engine.lookup(torch.tensor(token_ids, dtype=torch.long))
+
+def get_waiting_policy() -> Optional[CacheAwareWaitingPolicy]:
+    """Get the waiting queue policy of the scheduler, which is selected by
+    the environment variable `LMCACHE_SCHED_POLICY` ("fcfs" by default, or
+    "cache_aware"). `LMCACHE_SCHED_MAX_WAIT` is the number of seconds after
+    which a waiting request is scheduled in arrival order again.
+
+    The variable is read once, when the LLM engine is created.
+
+    :return: The cache-aware policy or None for vLLM's FCFS order.
+    :rtype: Optional[CacheAwareWaitingPolicy]
+
+    :raises ValueError: if the policy is unknown.
+    """
+    global g_waiting_policy, g_waiting_policy_resolved
+    if g_waiting_policy_resolved:
+        return g_waiting_policy
+    policy = get_env_str("LMCACHE_SCHED_POLICY", "fcfs")
+    if policy not in ("fcfs", "cache_aware"):
+        raise ValueError(f"Unknown LMCACHE_SCHED_POLICY: {policy}")
+    if policy == "cache_aware":
+        logger.info("Cache-aware scheduling is enabled")
+        g_waiting_policy = CacheAwareWaitingPolicy(
+            lmcache_lookup_cached_prefix,
+            get_env_float("LMCACHE_SCHED_MAX_WAIT", 5.0))
+    g_waiting_policy_resolved = True
+    return g_waiting_policy
+
+def get_retrieval_admission(
+        engine: LMCacheEngine,
+    ) -> Optional[RetrievalAdmissionController]:
+    """Get the retrieval admission controller, which is enabled by the
+    environment variable `LMCACHE_RETRIEVE_ADMISSION`.
+    `LMCACHE_RETRIEVE_LATENCY_BUDGET_MS` bounds the load time of a single
+    retrieval (0 for no bound) and `LMCACHE_PREFILL_COST_PER_TOKEN_US` sets
+    the prefill cost before it is calibrated (0 to wait for calibration).
+
+    :return: The controller or None if the admission is disabled.
+    :rtype: Optional[RetrievalAdmissionController]
+    """
+    global g_retrieval_admission, g_retrieval_admission_disabled
+    if g_retrieval_admission is not None:
+        return g_retrieval_admission
+    if g_retrieval_admission_disabled or \
+            not get_env_flag("LMCACHE_RETRIEVE_ADMISSION"):
+        return None
+    if get_world_group().world_size > 1:
+        # The decisions depend on local timings, which differ across
+        # workers, while every worker must rebuild the same input
+        logger.warning("Retrieval admission is not supported with more "
+                       "than one worker, it is disabled")
+        g_retrieval_admission_disabled = True
+        return None
+    logger.info("Retrieval admission is enabled")
+    g_retrieval_admission = RetrievalAdmissionController(
+        engine.chunk_size,
+        get_env_float("LMCACHE_PREFILL_COST_PER_TOKEN_US", 0.0) / 1e6,
+        get_env_float("LMCACHE_RETRIEVE_LATENCY_BUDGET_MS", 0.0) / 1e3)
+    return g_retrieval_admission
+
+def get_store_admission() -> Optional[StoreAdmissionFilter]:
+    """Get the store admission filter, which is enabled by the environment
+    variable `LMCACHE_STORE_ADMISSION`. A chunk is stored once it has been
+    seen `LMCACHE_STORE_ADMISSION_THRESHOLD` times (2 by default). The
+    sketch has `LMCACHE_STORE_ADMISSION_WIDTH` counters per row and is aged
+    every `LMCACHE_STORE_ADMISSION_SAMPLE_SIZE` sightings.
+
+    :return: The filter or None if every chunk is stored.
+    :rtype: Optional[StoreAdmissionFilter]
+    """
+    global g_store_admission
+    if g_store_admission is not None:
+        return g_store_admission
+    if not get_env_flag("LMCACHE_STORE_ADMISSION"):
+        return None
+    width = get_env_int("LMCACHE_STORE_ADMISSION_WIDTH", 65536)
+    sketch = CountMinSketch(
+        width,
+        sample_size=get_env_int("LMCACHE_STORE_ADMISSION_SAMPLE_SIZE",
+                                10 * width))
+    logger.info("Store admission is enabled")
+    g_store_admission = StoreAdmissionFilter(
+        sketch, get_env_int("LMCACHE_STORE_ADMISSION_THRESHOLD", 2))
+    return g_store_admission
+
+def get_backend_name(engine: LMCacheEngine) -> str:
+    """Get the name of the storage backend of the LMCache engine.
+    """
+    backend = getattr(engine, "engine_", None)
+    return type(backend).__name__ if backend is not None else "default"
+
+def lmcache_begin_forward(model_input: "ModelInputForGPUWithSamplingMetadata",
+                          device: torch.device) -> None:
+    """Start timing the model forward to calibrate the prefill cost of the
+    retrieval admission. Only forwards without decodes are timed.
+    """
+    if g_retrieval_admission is None:
+        return
+    attn_metadata = model_input.attn_metadata
+    num_prefill_tokens = 0
+    if attn_metadata.num_decode_tokens == 0:
+        num_prefill_tokens = attn_metadata.num_prefill_tokens
+    g_retrieval_admission.begin_forward(num_prefill_tokens, device)
+
+def lmcache_end_forward() -> None:
+    """Stop timing the model forward started by `lmcache_begin_forward`.
+    """
+    if g_retrieval_admission is not None:
+        g_retrieval_admission.end_forward()
+
+def get_store_worker(engine: LMCacheEngine) -> StoreWorker:
+    """Get the worker that owns the bounded store queue. The gather and the
+    copy to host memory run on a side stream if the environment variable
+    `LMCACHE_ASYNC_STORE` is set.
+
+    The queue is bounded by `LMCACHE_STORE_QUEUE_DEPTH` stores (64 by
+    default) and `LMCACHE_STORE_QUEUE_MAX_BYTES` bytes (0 for no limit).
+    `LMCACHE_STORE_QUEUE_POLICY` is "drop_oldest" (default), "drop_newest"
+    or "block".
+
+    :return: The store worker.
+    :rtype: StoreWorker
+    """
+    global g_store_worker
+    if g_store_worker is not None:
+        return g_store_worker
+
+    metrics = get_metrics()
+    stored_bytes_counter = metrics.counter(
+        "lmcache:stored_bytes", "Bytes of KV stored into LMCache")
+    store_latency_histogram = metrics.histogram(
+        "lmcache:store_latency_seconds",
+        "Time of the store of a sequence into LMCache")
+
+    def store_fn(tokens, kv_tensors, kv_tensors_mask):
+        # We are off the critical path, so it is fine to store in
+        # blocking mode
+        start = time.perf_counter()
+        engine.store(tokens, kv_tensors, kv_tensors_mask,
+                     skip_existing = True, blocking = True)
+        store_latency_histogram.observe(time.perf_counter() - start)
+        stored_bytes_counter.inc(kv_tensors.nbytes)
+
+    def put_fn(chunk_key, kv_chunk):
+        start = time.perf_counter()
+        lmcache_put_chunk(engine, chunk_key, kv_chunk, blocking = True)
+        store_latency_histogram.observe(time.perf_counter() - start)
+        stored_bytes_counter.inc(kv_chunk.nbytes)
+
+    cuda_stream = None
+    if get_env_flag("LMCACHE_ASYNC_STORE"):
+        logger.info("Asynchronous KV cache store is enabled")
+        cuda_stream = LMCACHE_CUDA_STREAM
+    g_store_worker = StoreWorker(
+        store_fn, cuda_stream, put_fn,
+        max_depth = get_env_int("LMCACHE_STORE_QUEUE_DEPTH", 64),
+        max_bytes = get_env_int("LMCACHE_STORE_QUEUE_MAX_BYTES", 0),
+        overflow_policy = get_env_str("LMCACHE_STORE_QUEUE_POLICY",
+                                      "drop_oldest"))
+    return g_store_worker
+
+def lmcache_flush_stores() -> None:
+    """Block until every queued store is in LMCache.
+    """
+    if g_store_worker is not None:
+        g_store_worker.flush()
+
 def close_lmcache_engine() -> None:
     """Close the LMCache engine if it is initialized.
     """
+    global g_store_worker
+    if g_store_worker is not None:
+        logger.debug("Flushing pending LMCache stores")
+        g_store_worker.close()
+        g_store_worker = None
+    global g_retrieve_pool
+    if g_retrieve_pool is not None:
+        g_retrieve_pool.shutdown(wait=True)
+        g_retrieve_pool = None
+    global g_prefix_memo
+    g_prefix_memo = None
+    global g_prefetcher
+    if g_prefetcher is not None:
+        g_prefetcher.close()
+        g_prefetcher = None
+    close_tracer()
     logger.debug("Closing LMCache Engine")
     LMCacheEngineBuilder.destroy(ENGINE_NAME)
 
 def lmcache_should_retrieve(
         model_input: "ModelInputForGPUWithSamplingMetadata", 
-        kv_caches: List[torch.Tensor]) -> RetrieveStatus:
+        kv_caches: List[torch.Tensor]) -> List[RetrieveStatus]:
     """Check should we retrieve KV from LMCache for the current model_input.
 
     :param model_input: The model input for the current request.
@@ -246,16 +570,21 @@ def lmcache_should_retrieve(
     :param kv_caches: The paged memory
     :type kv_caches: List[torch.Tensor]
 
-    :return: RetrieveStatus.
+    :return: A list of RetrieveStatus, one per sequence.
+             RetrieveStatus.PREFILL for a prefill (or the last chunk of a
+             chunked prefill) whose next token is sampled.
+             RetrieveStatus.CHUNK_PREFILL for a chunk that is not the last one.
+             RetrieveStatus.NONE for decodes or if no retrieval is required.
     """
 
     # model_input doesn't have seq_lens in tp
     # but attn_metadata does
     seq_lens = model_input.attn_metadata.seq_lens
+    retrieve_status = [RetrieveStatus.NONE] * len(seq_lens)
     
     has_engine = LMCacheEngineBuilder.get(ENGINE_NAME) is not None
     if not has_engine or kv_caches is None:
-        return RetrieveStatus.NONE
+        return retrieve_status
 
     attn_meta = model_input.attn_metadata
     prefill_meta = attn_meta.prefill_metadata
@@ -263,33 +592,42 @@ def lmcache_should_retrieve(
     # check if the current run is profiling
     is_profile_run = (kv_caches is None) or (kv_caches[0] is None)
     if is_profile_run:
-        return RetrieveStatus.NONE
-    
-    # check if the current run is prefill
-    # TODO (Jiayi): chunked prefill + prefix caching in a single batch
-    # is not and should not be supported here
-    # what about multuple chunk prefills in a single batch??
+        return retrieve_status
     
-    # Assume all chunks are prefills
-    is_all_prefill_run = ((attn_meta.num_prefills == len(seq_lens))\
-        and prefill_meta is not None)
-    if is_all_prefill_run:
-        selected_token_indices = model_input.sampling_metadata.selected_token_indices
-        if len(selected_token_indices) == 0:
-            # There should only be 1 chunk in chunked prefill
-            assert len(seq_lens) == 1
-            return RetrieveStatus.CHUNK_PREFILL
-        
-        # `<` means chunked prefill is batched with decode
-        if len(selected_token_indices) == len(seq_lens):
-            return RetrieveStatus.PREFILL
+    # No prefill in the current run
+    if prefill_meta is None:
+        return retrieve_status
+
+    # The status of each sequence comes from its own sequence group, so
+    # prefills batched with decodes (chunked prefill) are handled as well.
+    # Decodes are never retrieved.
+    seq_data_idx = 0
+    num_sampled_seqs = 0
+    for seq_group_metadata in model_input.seq_group_metadata_list:
+        for _ in seq_group_metadata.seq_data:
+            if seq_group_metadata.do_sample:
+                num_sampled_seqs += 1
+            if seq_group_metadata.is_prompt:
+                if seq_group_metadata.do_sample:
+                    retrieve_status[seq_data_idx] = RetrieveStatus.PREFILL
+                else:
+                    retrieve_status[seq_data_idx] = RetrieveStatus.CHUNK_PREFILL
+            seq_data_idx += 1
+    assert seq_data_idx == len(seq_lens)
 
-    return RetrieveStatus.NONE
+    # More selected tokens than sampled sequences means some prompt tokens
+    # are needed for their logits (e.g., prompt logprobs), which must not
+    # be skipped
+    selected_token_indices = model_input.sampling_metadata.selected_token_indices
+    if len(selected_token_indices) != num_sampled_seqs:
+        return [RetrieveStatus.NONE] * len(seq_lens)
+
+    return retrieve_status
 
 
 def lmcache_should_store(
         model_input: "ModelInputForGPUWithSamplingMetadata", 
-        kv_caches: List[torch.Tensor]) -> StoreStatus:
+        kv_caches: List[torch.Tensor]) -> List[StoreStatus]:
     """Check should we store KV into LMCache for the current model_input.
 
     :param model_input: The model input for the current request.
@@ -298,7 +636,7 @@ def lmcache_should_store(
     :param kv_caches: The paged memory
     :type kv_caches: List[torch.Tensor]
 
-    :return: A list of StoreStatus.
+    :return: A list of StoreStatus, one per sequence.
              StoreStatus.PREFILL/DECODE/CHUNK_PREFILL if we should store KV after PREFILL/DECODE.
              StoreStatus.NONE if no storing is required.
     """
@@ -339,42 +677,36 @@ def lmcache_should_store(
     if is_profile_run:
         return store_status
 
-    # FIXME(Jiayi): need to support chunked prefill (batch prefill and decode)
-    # check if the current run is prefill
-    is_all_prefill_run = ((attn_meta.num_prefills == len(seq_lens))\
-        and (prefill_meta is not None))
-
-    if is_all_prefill_run:
-        selected_token_indices = model_input.sampling_metadata.selected_token_indices
-        seq_group_metadata_list = model_input.seq_group_metadata_list
-        seq_data_idx = 0
-        selected_token_indices_idx = 0
-        for seq_group_idx, seq_group_metadata in enumerate(seq_group_metadata_list):
-            
-            # TODO(Jiayi): Figure out scenarios (other than chunk prefill) 
-            # where `do_sample`` is False 
-            if not seq_group_metadata.do_sample:
-                store_status[seq_data_idx] = StoreStatus.CHUNK_PREFILL
-                seq_data_idx += 1 
-                continue
+    # The status of each sequence comes from its own sequence group and
+    # query span, so prefills batched with decodes (chunked prefill) are
+    # stored as well
+    query_start_loc = None
+    if prefill_meta is not None:
+        query_start_loc = attn_meta.query_start_loc.tolist()
 
-            for seqid, seq_data in seq_group_metadata.seq_data.items():
-                if seq_data.get_len()-1 != selected_token_indices[selected_token_indices_idx]:
-                    # last chunk in chunk prefill
-                    # or prefix already hit in retrieve
-                    store_status[seq_data_idx] = StoreStatus.SUFFIX_PREFILL
+    seq_data_idx = 0
+    for seq_group_metadata in model_input.seq_group_metadata_list:
+        for _ in seq_group_metadata.seq_data:
+            seq_len = seq_lens[seq_data_idx]
+            if seq_group_metadata.is_prompt:
+                # TODO(Jiayi): Figure out scenarios (other than chunk prefill) 
+                # where `do_sample`` is False 
+                if not seq_group_metadata.do_sample:
+                    store_status[seq_data_idx] = StoreStatus.CHUNK_PREFILL
                 else:
-                    store_status[seq_data_idx] = StoreStatus.PREFILL
-                seq_data_idx += 1
-                selected_token_indices_idx += 1
-        return store_status
-        
-
-    # Determine whether to save decoded KV cache
-    if engine.save_decode_cache:
-        for idx, seq_len in enumerate(seq_lens):
-            if seq_len % engine.chunk_size == 0:
-                store_status[idx] = StoreStatus.DECODE
+                    query_len = query_start_loc[seq_data_idx + 1] - \
+                        query_start_loc[seq_data_idx]
+                    if query_len != seq_len:
+                        # last chunk in chunk prefill
+                        # or prefix already hit in retrieve
+                        store_status[seq_data_idx] = StoreStatus.SUFFIX_PREFILL
+                    else:
+                        store_status[seq_data_idx] = StoreStatus.PREFILL
+            elif engine.save_decode_cache:
+                # Determine whether to save decoded KV cache
+                if seq_len % engine.chunk_size == 0:
+                    store_status[seq_data_idx] = StoreStatus.DECODE
+            seq_data_idx += 1
     return store_status
 
 
@@ -404,27 +736,26 @@ def lmcache_store_kv(
     assert engine is not None, "LMCache engine is not initialized."
 
     seq_lens = model_input.attn_metadata.seq_lens
-        
-    # FIXME(Jiayi): ChatGLM does not have `model` or `start_layer`
-    # How does PP work in this case?
-    if hasattr(model_executable, "model") and \
-        hasattr(model_executable.model, "start_layer"):
-        start_layer = model_executable.model.start_layer
-    else:
-        start_layer = 0
+    model_input_subset = create_model_input_subset(model_executable)
+    if model_input_subset is None:
+        # The architecture of the model is not supported
+        return
+    start_layer = model_input_subset.start_layer
+    end_layer = model_input_subset.end_layer
 
-    # FIXME(Jiayi): ChatGLM does not have `model` or `start_layer`
-    # How does PP work in this case?
-    if hasattr(model_executable, "model") and \
-        hasattr(model_executable.model, "start_layer"):
-        end_layer = model_executable.model.end_layer
-    else:
-        end_layer = len(kv_caches)
+    # All the stores go through the bounded store queue, and are gathered
+    # on LMCACHE_CUDA_STREAM if async store is enabled
+    store_worker = get_store_worker(engine)
+    store_requests = []
+    prefix_memo = get_prefix_memo(engine)
+    token_cache = get_token_cache()
+    store_admission = get_store_admission()
 
-    seq_data_idx = 0
+    seq_data_idx = -1
     seq_group_metadata_list = model_input.seq_group_metadata_list
     for seq_group_metadata in seq_group_metadata_list:
         for seqid, seq_data in seq_group_metadata.seq_data.items():
+            seq_data_idx += 1
             status = store_status[seq_data_idx]
             # TODO (Jiayi): can chunk prefill and vllm prefix caching use the same logic?
             if status in [StoreStatus.NONE]:
@@ -436,50 +767,142 @@ def lmcache_store_kv(
                 if status == StoreStatus.DECODE:
                     if seq_len % engine.chunk_size != 0:
                         continue
-            current_tokens = torch.tensor(seq_data.get_token_ids()[:seq_len], device="cpu")
+            current_tokens = token_cache.get_tokens(
+                seqid, seq_group_metadata.request_id, seq_data, seq_len)
             vllm_block_size = cache_config.block_size
-            skip_leading_tokens = engine.lookup(current_tokens)
+            skip_leading_tokens = lmcache_lookup_seq(
+                engine, prefix_memo, seqid, seq_group_metadata.request_id,
+                current_tokens)
             assert skip_leading_tokens <= seq_len
+
+            # A decode store only appends the last chunk, which can be put
+            # under the running prefix hash without re-hashing the sequence.
+            # A sequence unknown to the memo (e.g., forked after its
+            # prefill) is hashed once here and memoized from then on.
+            chunk_key = None
+            if status == StoreStatus.DECODE and \
+                    skip_leading_tokens == seq_len - engine.chunk_size:
+                chunk_key = prefix_memo.last_chunk_key(seqid, current_tokens)
+
+            # Only the chunks of a prefill seen often enough are stored
+            if store_admission is not None and \
+                    status != StoreStatus.DECODE and \
+                    skip_leading_tokens < seq_len:
+                seq_len = store_admission.admit(
+                    prefix_memo, seqid, seq_group_metadata.request_id,
+                    current_tokens, skip_leading_tokens)
+                current_tokens = current_tokens[:seq_len]
+
             if skip_leading_tokens < seq_len:
                 assert skip_leading_tokens % engine.chunk_size == 0
                 slot_mapping = []
                 compute_slot_mapping(False, slot_mapping, seqid, seq_len, 
                     skip_leading_tokens, 0, vllm_block_size, seq_group_metadata.block_tables)
-                kv_tuple_list = []
-                if len(slot_mapping) > 0:
-                    for layer_id in range(start_layer, end_layer):
-                        kv_cache = kv_caches[layer_id - start_layer]
-
-                        _, _, num_heads, head_size = kv_cache[0].shape
-
-                        key_cache = kv_cache[0].reshape(-1, num_heads, head_size)
-                        value_cache = kv_cache[1].reshape(-1, num_heads, head_size)
-                        
-                        kv_tuple_list.append(
-                                (key_cache[slot_mapping],
-                                value_cache[slot_mapping])
-                            )
-
-                    stored_token_num = len(slot_mapping)
-                    skipped_token_num = seq_len - stored_token_num
+                stored_token_num = len(slot_mapping)
+                skipped_token_num = seq_len - stored_token_num
+                if stored_token_num > 0:
                     kv_tensors_mask = torch.ones_like(current_tokens, dtype=torch.bool)
                     kv_tensors_mask[:skipped_token_num] = False
-                    engine.store(current_tokens.cpu(), tuple(kv_tuple_list), kv_tensors_mask,
-                                skip_existing = True, blocking = False)
+                    # The tokens count as stored once the store worker has
+                    # put them, and are stored again if it drops them
+                    prefix_memo.record_pending(
+                        seqid, seq_group_metadata.request_id, seq_len)
+                    on_done = functools.partial(prefix_memo.finish_store,
+                                                seqid, skip_leading_tokens,
+                                                seq_len)
+                    store_requests.append((current_tokens, slot_mapping,
+                                           kv_tensors_mask, chunk_key,
+                                           on_done))
             else:
                 stored_token_num = 0
                 skipped_token_num = seq_len
             logger.debug(f"Store skips {skipped_token_num} tokens "\
                     f"and then stores {stored_token_num} tokens")
-            seq_data_idx += 1
+
+    store_worker.submit(store_requests, kv_caches, end_layer - start_layer)
+
+def get_retrieve_pool() -> Optional[ThreadPoolExecutor]:
+    """Get the thread pool used to issue the retrievals of a batch
+    concurrently. Its size is set by the environment variable
+    `LMCACHE_RETRIEVE_WORKERS` (default: 4). A size of 1 or less disables
+    concurrent retrieval.
+
+    :return: The thread pool or None if concurrent retrieval is disabled.
+    :rtype: Optional[ThreadPoolExecutor]
+    """
+    global g_retrieve_pool
+    if g_retrieve_pool is None:
+        num_workers = get_env_int("LMCACHE_RETRIEVE_WORKERS", 4)
+        if num_workers <= 1:
+            return None
+        g_retrieve_pool = ThreadPoolExecutor(
+            max_workers=num_workers,
+            thread_name_prefix="lmcache-retrieve")
+    return g_retrieve_pool
+
+def retrieve_kv_concurrently(
+    engine: LMCacheEngine,
+    full_tokens_list: List[torch.Tensor],
+    token_mask_list: List[torch.Tensor],
+) -> Iterator[Tuple[int, Tuple[KVCache, torch.Tensor]]]:
+    """Issue `engine.retrieve` for every sequence of the batch through a
+    bounded thread pool and yield the results in completion order.
+
+    :param engine: The LMCache engine.
+    :type engine: LMCacheEngine
+
+    :param full_tokens_list: The tokens of each sequence.
+    :type full_tokens_list: List[torch.Tensor]
+
+    :param token_mask_list: The mask of the tokens to retrieve of each sequence.
+    :type token_mask_list: List[torch.Tensor]
+
+    :return: An iterator of (sequence index, (kv_tuple, ret_token_mask)).
+    """
+    admission = g_retrieval_admission
+    backend_name = get_backend_name(engine)
+    metrics = get_metrics()
+    retrieved_bytes_counter = metrics.counter(
+        "lmcache:retrieved_bytes", "Bytes of KV retrieved from LMCache")
+    retrieve_latency_histogram = metrics.histogram(
+        "lmcache:retrieve_latency_seconds",
+        "Time of the retrieval of a sequence from LMCache")
+
+    def retrieve_fn(tokens, token_mask):
+        start = time.perf_counter()
+        with trace_span("retrieve_seq", num_tokens=len(tokens)):
+            kv_tuple, ret_token_mask = engine.retrieve(tokens, token_mask)
+        elapsed = time.perf_counter() - start
+        num_bytes = sum(k.nbytes + v.nbytes for k, v in kv_tuple) \
+            if kv_tuple else 0
+        retrieved_bytes_counter.inc(num_bytes)
+        retrieve_latency_histogram.observe(elapsed)
+        # Measure the backend for the retrieval admission
+        if admission is not None:
+            admission.observe_retrieval(backend_name, num_bytes, elapsed)
+        return kv_tuple, ret_token_mask
+
+    pool = get_retrieve_pool()
+    if pool is None or len(full_tokens_list) <= 1:
+        for idx, (tokens, token_mask) in enumerate(
+                zip(full_tokens_list, token_mask_list)):
+            yield idx, retrieve_fn(tokens, token_mask)
+        return
+
+    future_to_idx = {
+        pool.submit(retrieve_fn, tokens, token_mask): idx
+        for idx, (tokens, token_mask) in enumerate(
+            zip(full_tokens_list, token_mask_list))
+    }
+    for future in as_completed(future_to_idx):
+        yield future_to_idx[future], future.result()
 
 @_lmcache_nvtx_annotate
 def lmcache_retrieve_kv(
     model_executable,
-    model_name: str,
     model_input: "ModelInputForGPUWithSamplingMetadata",
     kv_caches: List[torch.Tensor],
-    retrieve_status: RetrieveStatus,
+    retrieve_status: List[RetrieveStatus],
 ) -> Tuple["ModelInputForGPUWithSamplingMetadata", bool]:
     """Retrieve the KV caches from LMCache for the current model_input. And 
     rebuild the model_input to reflect the changes in KV if necessary.
@@ -507,42 +930,67 @@ def lmcache_retrieve_kv(
     seq_lens = model_input.attn_metadata.seq_lens
 
 
-    model_input_subset = create_model_input_subset(
-        model_name, model_executable)
+    model_input_subset = create_model_input_subset(model_executable)
+    if model_input_subset is None:
+        # The architecture of the model is not supported
+        return model_input, False
     attn_layers = model_input_subset.attn_layers
     start_layer = model_input_subset.start_layer
     end_layer = model_input_subset.end_layer
     
     # The following metadata are needed to rebuilt the model input
-    full_tokens_list = []
+    seq_len_list = []
     num_computed_tokens_list = []
     lmc_num_computed_tokens_list= []
     
     start_pos_list = []
     is_prefill_list = []
+    do_sample_list = []
+    seq_group_idx_list = []
+    vllm_num_computed_tokens_list = []
      
     next_start_pos = 0
     num_request_not_found = 0
     temp_block_table_list = []
+
+    # The sequences to retrieve and their tokens and masks
+    retrieve_idx_list = []
+    full_tokens_list = []
+    token_mask_list = []
     
     # idx is on a sequence, not a sequence group.
     idx = 0
 
     seq_group_metadata_list = model_input.seq_group_metadata_list
+    token_cache = get_token_cache()
+    seq_id_list = []
+    request_id_list = []
 
-    for seq_group_metadata in seq_group_metadata_list:
+    prefix_memo = get_prefix_memo(engine)
+
+    # Decide how much of each hit is worth retrieving
+    admission = get_retrieval_admission(engine)
+    if admission is not None:
+        backend_name = get_backend_name(engine)
+        _, _, _, num_heads, head_size = kv_caches[0].shape
+        bytes_per_token = 2 * num_heads * head_size * \
+            kv_caches[0].element_size() * (end_layer - start_layer)
+
+    for seq_group_idx, seq_group_metadata in enumerate(seq_group_metadata_list):
         request_id = seq_group_metadata.request_id
         seq_ids = model_input.request_ids_to_seq_ids[request_id]
         for seq_id in seq_ids:
             seq_data = seq_group_metadata.seq_data[seq_id]
+            seq_id_list.append(seq_id)
+            request_id_list.append(request_id)
             is_prefill_list.append(seq_group_metadata.is_prompt)
-            if retrieve_status == RetrieveStatus.CHUNK_PREFILL:
-                total_seq_len = seq_lens[idx]
-            else:
-                total_seq_len = seq_data.get_len()
-            
-            full_token_tensor = torch.tensor(seq_data.get_token_ids()[:total_seq_len], device="cpu")
-            full_tokens_list.append(full_token_tensor)
+            do_sample_list.append(seq_group_metadata.do_sample)
+            seq_group_idx_list.append(seq_group_idx)
+
+            # The tokens up to the end of the current query, which is also
+            # the end of the current chunk in chunked prefill
+            total_seq_len = seq_lens[idx]
+            seq_len_list.append(total_seq_len)
             
             vllm_num_required_tokens = (query_start_loc[idx + 1] - query_start_loc[idx]).item()
             
@@ -551,95 +999,182 @@ def lmcache_retrieve_kv(
             next_start_pos = end_pos
             start_pos_list.append(start_pos)
             
-            # TODO(Jiayi): is deepcopy avoidable here?
-            temp_block_table = deepcopy(seq_group_metadata.block_tables[seq_id])
-            temp_block_table_list.append(temp_block_table)
+            # The block table is only read when rebuilding the input
+            temp_block_table_list.append(seq_group_metadata.block_tables[seq_id])
 
             # number of tokens computed by vllm (e.g., chunk prefill, prefix caching)
             vllm_num_computed_tokens = total_seq_len - vllm_num_required_tokens
-            
-            # construct token mesk to indicate what tokens should be retrieved
-            # from lmc. Tokens computed in vllm already shoudl be skipped
-            token_mask = torch.ones_like(full_token_tensor, dtype=torch.bool)
-            token_mask[:vllm_num_computed_tokens] = False
-            
-            # call lmcache retrieve
-            kv_tuple, ret_token_mask = engine.retrieve(full_token_tensor, token_mask)
-            lmc_num_computed_tokens = torch.sum(ret_token_mask).item()
-            
-            # total number of computed tokens (vllm + lmc)
-            num_computed_tokens = vllm_num_computed_tokens + lmc_num_computed_tokens
-            
-            # TODO(Jiayi): currently we do not skip anything if chunked prefill
-            # is batched with any decode or other chunked prefills.
-            # This is not done as I assume the performance benefit is marginal.
-            if retrieve_status == RetrieveStatus.CHUNK_PREFILL:
-                if num_computed_tokens != total_seq_len:
-                    return model_input, False
-            else:
-                # Avoid the error when prefix is exactly the same as the retrieved
-                # However, in chunk prefill, the entire prefill should be skipped
-                if num_computed_tokens == total_seq_len:
-                    lmc_num_computed_tokens -= 1
-                    num_computed_tokens -= 1
-            
-            num_computed_tokens_list.append(num_computed_tokens)
-            lmc_num_computed_tokens_list.append(lmc_num_computed_tokens)
-            
-            
-            # No cache found, move on
-            if lmc_num_computed_tokens == 0:
-                num_request_not_found += 1
-                idx += 1
-                continue
-            
-            
-            # Inject the lmc retrieved kv cache
-            logger.debug(f"Injected token number: {lmc_num_computed_tokens}")
-            for i in range(start_layer, end_layer):
-                layer_idx = i - start_layer
-                kv_cache = kv_caches[layer_idx]
-                attn_layer = attn_layers[i]
-                key_cache, value_cache = kv_cache[0], kv_cache[1]
-                ops.reshape_and_cache_flash(
-                    kv_tuple[layer_idx][0].to(key_cache.device),
-                    kv_tuple[layer_idx][1].to(value_cache.device),
-                    key_cache,
-                    value_cache,
-                    slot_mapping[start_pos:start_pos + lmc_num_computed_tokens],
-                    attn_layer.attn.kv_cache_dtype,
-                    attn_layer.attn._k_scale,
-                    attn_layer.attn._v_scale,
-                )
+            vllm_num_computed_tokens_list.append(vllm_num_computed_tokens)
+
+            if retrieve_status[idx] != RetrieveStatus.NONE:
+                full_token_tensor = token_cache.get_tokens(
+                    seq_id, request_id, seq_data, total_seq_len)
+                if admission is not None:
+                    # The hashes are memoized for the later steps and the
+                    # store of the sequence. Queued stores cannot be
+                    # retrieved yet, so only the stored prefix is planned
+                    plan = admission.plan(
+                        backend_name, vllm_num_computed_tokens,
+                        lmcache_lookup_seq(engine, prefix_memo, seq_id,
+                                           request_id, full_token_tensor,
+                                           include_pending=False),
+                        bytes_per_token)
+                    if plan.end <= vllm_num_computed_tokens:
+                        idx += 1
+                        continue
+                    full_token_tensor = full_token_tensor[:plan.end]
+                
+                # construct token mesk to indicate what tokens should be retrieved
+                # from lmc. Tokens computed in vllm already shoudl be skipped
+                token_mask = torch.ones_like(full_token_tensor, dtype=torch.bool)
+                token_mask[:vllm_num_computed_tokens] = False
+                retrieve_idx_list.append(idx)
+                full_tokens_list.append(full_token_tensor)
+                token_mask_list.append(token_mask)
             
             idx += 1
-            
     
     seq_cnt = len(query_start_loc) - 1
     assert idx == seq_cnt
-    assert len(lmc_num_computed_tokens_list) == seq_cnt
-    assert len(num_computed_tokens_list) == seq_cnt
-    
-    if retrieve_status == RetrieveStatus.CHUNK_PREFILL and \
-        num_request_not_found == 0:
+
+    # Sequences that are not retrieved keep their vllm computed tokens
+    num_computed_tokens_list = list(vllm_num_computed_tokens_list)
+    lmc_num_computed_tokens_list = [0] * seq_cnt
+
+    kv_tuple_list: List[Optional[KVCache]] = [None] * seq_cnt
+    fully_cached_chunk_list = []
+
+    metrics = get_metrics()
+    metrics.counter(
+        "lmcache:retrieve_queried_tokens",
+        "Number of tokens looked up in LMCache").inc(
+            sum(len(tokens) - vllm_num_computed_tokens_list[idx]
+                for idx, tokens in zip(retrieve_idx_list, full_tokens_list)))
+    hit_tokens_counter = metrics.counter(
+        "lmcache:retrieve_hit_tokens", "Number of tokens hit in LMCache")
+
+    # call lmcache retrieve for all sequences concurrently
+    for retrieve_idx, (kv_tuple, ret_token_mask) in retrieve_kv_concurrently(
+            engine, full_tokens_list, token_mask_list):
+        idx = retrieve_idx_list[retrieve_idx]
+        total_seq_len = seq_len_list[idx]
+        vllm_num_computed_tokens = vllm_num_computed_tokens_list[idx]
+        lmc_num_computed_tokens = torch.sum(ret_token_mask).item()
+        hit_tokens_counter.inc(lmc_num_computed_tokens)
+        
+        # total number of computed tokens (vllm + lmc)
+        num_computed_tokens = vllm_num_computed_tokens + lmc_num_computed_tokens
+
+        # Let the store path reuse the hit instead of looking it up again.
+        # Without a hit, the prefix computed by vllm may not be in LMCache.
+        if lmc_num_computed_tokens > 0 or vllm_num_computed_tokens == 0:
+            prefix_memo.record_stored(
+                seq_id_list[idx], request_id_list[idx], num_computed_tokens)
+        
+        # A chunk that is not the last one is partially skipped like a
+        # prefill: its cached prefix is injected and only the remainder of
+        # the chunk is computed. Nothing is sampled from such a chunk.
+        if retrieve_status[idx] == RetrieveStatus.CHUNK_PREFILL:
+            if num_computed_tokens == total_seq_len:
+                # The whole chunk may be skipped, decided after all retrievals
+                fully_cached_chunk_list.append(idx)
+        else:
+            # Avoid the error when prefix is exactly the same as the retrieved
+            if num_computed_tokens == total_seq_len:
+                lmc_num_computed_tokens -= 1
+                num_computed_tokens -= 1
+        
+        num_computed_tokens_list[idx] = num_computed_tokens
+        lmc_num_computed_tokens_list[idx] = lmc_num_computed_tokens
+        kv_tuple_list[idx] = kv_tuple
+
+    # The entire forward is skipped only if every sequence is a fully cached
+    # chunk. Otherwise the last token of such a chunk is recomputed, which
+    # keeps a non-empty query for every sequence in the batch.
+    skip_forward = len(fully_cached_chunk_list) == seq_cnt
+    if not skip_forward:
+        for idx in fully_cached_chunk_list:
+            num_computed_tokens_list[idx] -= 1
+            lmc_num_computed_tokens_list[idx] -= 1
+
+    hit_kv_tuples = []
+    hit_slot_mappings = []
+    for idx in range(seq_cnt):
+        lmc_num_computed_tokens = lmc_num_computed_tokens_list[idx]
+        
+        # No cache found, move on
+        if lmc_num_computed_tokens == 0:
+            num_request_not_found += 1
+            continue
+        
+        # The lmc retrieved kv cache of all sequences is injected at once
+        logger.debug(f"Injected token number: {lmc_num_computed_tokens}")
+        start_pos = start_pos_list[idx]
+        hit_kv_tuples.append(kv_tuple_list[idx])
+        hit_slot_mappings.append(
+            slot_mapping[start_pos:start_pos + lmc_num_computed_tokens])
+
+    # In layerwise mode, the KV of layer i is injected right before the
+    # attention of layer i runs instead of before the model forward. The
+    # retrieval above has already loaded every layer from LMCache.
+    use_layerwise = get_env_flag("LMCACHE_LAYERWISE_RETRIEVE") and \
+        not skip_forward
+    if len(hit_kv_tuples) > 0:
+        if use_layerwise:
+            # Deferred to the pre-hook of each attention layer
+            layerwise_task = LayerwiseInjectionTask(
+                kv_caches, attn_layers, start_layer, end_layer,
+                LMCACHE_CUDA_STREAM,
+                get_env_int("LMCACHE_LAYERWISE_PREFETCH", 2))
+            for kv_tuple, hit_slot_mapping in zip(hit_kv_tuples, hit_slot_mappings):
+                layerwise_task.add_request(kv_tuple, hit_slot_mapping)
+            install_layerwise_hooks(attn_layers, start_layer, end_layer)
+            start_layerwise_injection(layerwise_task)
+        else:
+            # One host-to-device copy and one injection call per layer
+            inject_start = time.perf_counter()
+            with trace_span("inject", num_seqs=len(hit_kv_tuples)):
+                hit_slot_mapping = torch.cat(hit_slot_mappings)
+                for i in range(start_layer, end_layer):
+                    layer_idx = i - start_layer
+                    kv_cache = kv_caches[layer_idx]
+                    layer_kv = concat_layer_kv(
+                        hit_kv_tuples, layer_idx, kv_cache.device)
+                    inject_layer_kv(
+                        attn_layers[i].attn, kv_cache, layer_kv, hit_slot_mapping)
+            # NOTE: the time to launch the copies and the injection kernels
+            metrics.histogram(
+                "lmcache:inject_latency_seconds",
+                "Time to inject the retrieved KV into the paged memory").observe(
+                    time.perf_counter() - inject_start)
+
+    if skip_forward:
         return model_input, True
             
     # Some of the request can be skipped for a bit
     # TODO(Jiayi): need e2e test full prefill and partial prefill
     # in a single batch
     if num_request_not_found < seq_cnt:
-        rebuilt_model_input = build_partial_prefill_input(
-            model_input,
-            full_tokens_list,
-            num_computed_tokens_list,
-            start_pos_list,
-            slot_mapping,
-            lmc_num_computed_tokens_list,
-            is_prefill_list,
-            seq_group_metadata_list,
-            temp_block_table_list,
-            device=kv_cache[0].device,
-        )
+        rebuild_start = time.perf_counter()
+        with trace_span("rebuild"):
+            rebuilt_model_input = build_partial_prefill_input(
+                model_input,
+                seq_len_list,
+                num_computed_tokens_list,
+                start_pos_list,
+                slot_mapping,
+                lmc_num_computed_tokens_list,
+                is_prefill_list,
+                do_sample_list,
+                seq_group_idx_list,
+                seq_group_metadata_list,
+                temp_block_table_list,
+                device=kv_caches[0].device,
+            )
+        metrics.histogram(
+            "lmcache:rebuild_latency_seconds",
+            "Time to rebuild the model input after retrieval").observe(
+                time.perf_counter() - rebuild_start)
         logger.debug("Rebuilt the input!")
         return rebuilt_model_input, False
     
@@ -648,28 +1183,36 @@ def lmcache_retrieve_kv(
 
 def build_partial_prefill_input(
     model_input: "ModelInputForGPUWithSamplingMetadata",
-    full_tokens_list: List[torch.Tensor],
+    seq_len_list: List[int],
     num_computed_tokens_list: List[int],
     start_pos_list: List[int],
     slot_mapping_flat: torch.Tensor,
     lmc_num_computed_tokens_list: List[int],
     is_prefill_list: List[bool],
+    do_sample_list: List[bool],
+    seq_group_idx_list: List[int],
     seq_group_metadata_list: List[SequenceGroupMetadata],
     temp_block_table_list: List[List[int]],
     device: torch.device,
 ) -> "ModelInputForGPUWithSamplingMetadata":
     """Helper function to rebuild the model input for the current request.
+
+    The new metadata objects are built by shallow replacement of the changed
+    fields, so no device tensor of the original input is copied. The input
+    tokens, positions and slots are gathered on device from the original
+    input, and all the small host arrays go to the device in one transfer.
+
+    Decodes batched with prefills (chunked prefill) keep their single query
+    token. Only sequences that are sampled get a selected token index, so the
+    sampling metadata stays aligned with the original input.
     """
-    rebuilt_input_tokens = []
-    rebuilt_input_positions = []
     rebuilt_query_lens = []
     rebuilt_num_prefills = 0
     rebuilt_num_prefill_tokens = 0
-    rebuilt_slot_mapping = []
     rebuilt_max_query_len = 0
 
-    rebuilt_block_tables = []
-
+    # Host arrays that are packed into a single transfer
+    kept_start_list = []
     rebuilt_query_start_loc = [0]
     rebuilt_context_lens_tensor = []
     rebuilt_selected_token_indices = []
@@ -677,21 +1220,19 @@ def build_partial_prefill_input(
     last_query_start_loc = 0
 
     # recounting query and context lengths
-    for idx in range(len(full_tokens_list)):
-        token_tensor = full_tokens_list[idx]
-        num_token = len(token_tensor)
+    for idx in range(len(seq_len_list)):
+        num_token = seq_len_list[idx]
         num_computed_token = num_computed_tokens_list[idx]
         start_pos = start_pos_list[idx]
         is_prefill = is_prefill_list[idx]
         lmc_num_computed_tokens = lmc_num_computed_tokens_list[idx]
-        rebuilt_input_tokens.append(token_tensor[num_computed_token:])
         q_len = num_token - num_computed_token
         assert q_len > 0
         rebuilt_query_lens.append(q_len)
-        start_input_pos_idx = start_pos + lmc_num_computed_tokens
-        end_input_pos_idx = start_input_pos_idx + q_len
-        rebuilt_input_positions.append(
-            model_input.input_positions[start_input_pos_idx: end_input_pos_idx])
+
+        # The remaining query of the sequence starts here in the original input
+        kept_start_list.append(start_pos + lmc_num_computed_tokens)
+
         # Attn metadata-related
         if is_prefill:
             rebuilt_num_prefills += 1
@@ -699,62 +1240,105 @@ def build_partial_prefill_input(
         else:
             assert q_len == 1
         
-        start_slot_idx = start_pos + lmc_num_computed_tokens
-        end_slot_idx = start_slot_idx + q_len
-        new_slot_mapping = slot_mapping_flat[start_slot_idx:end_slot_idx]
-        rebuilt_slot_mapping.append(new_slot_mapping)
         rebuilt_max_query_len = max(q_len, rebuilt_max_query_len)
-        temp_block_table = temp_block_table_list[idx]
-        temp_block_table_tensor = torch.tensor(temp_block_table).to(model_input.attn_metadata.block_tables.dtype)
-        rebuilt_block_tables.append(temp_block_table_tensor)
         last_query_start_loc += q_len
         rebuilt_query_start_loc.append(last_query_start_loc)  # start with 0
         rebuilt_context_lens_tensor.append(num_computed_token)
 
         # Sampling metadata related
         # seq_groups (use rebuilt query lens)
-        rebuilt_selected_token_indices.append(last_query_start_loc - 1)
-
-    # rebuilt attn_metadata
-    rebuilt_attn_metadata = deepcopy(model_input.attn_metadata)
-    rebuilt_attn_metadata.num_prefills = rebuilt_num_prefills
-    rebuilt_attn_metadata.num_prefill_tokens = rebuilt_num_prefill_tokens
-    rebuilt_attn_metadata.slot_mapping = torch.cat(
-        rebuilt_slot_mapping).to(device)
-    rebuilt_attn_metadata.max_query_len = rebuilt_max_query_len
-
-    rebuilt_attn_metadata.block_tables = pad_sequence(
-        rebuilt_block_tables,
-        batch_first=True
-        ).to(device)
-    rebuilt_attn_metadata.query_start_loc = torch.tensor(
+        if do_sample_list[idx]:
+            rebuilt_selected_token_indices.append(last_query_start_loc - 1)
+
+    num_seqs = len(seq_len_list)
+    max_num_blocks = max(len(block_table) for block_table in temp_block_table_list)
+    host_arrays = [
+        kept_start_list,
+        rebuilt_query_lens,
         rebuilt_query_start_loc,
-        dtype=model_input.attn_metadata.query_start_loc.dtype).to(device)
-    rebuilt_attn_metadata.context_lens_tensor = torch.tensor(
         rebuilt_context_lens_tensor,
-        dtype=model_input.attn_metadata.context_lens_tensor.dtype,
-    ).to(device)
+        rebuilt_selected_token_indices,
+    ]
+    array_lens = [len(array) for array in host_arrays] + \
+        [num_seqs * max_num_blocks]
+
+    # Pack all the host arrays (and the zero-padded block tables) into one
+    # pinned buffer and move it to the device with a single transfer
+    pin_memory = torch.device(device).type == "cuda"
+    packed = torch.zeros(sum(array_lens), dtype=torch.long,
+                         pin_memory=pin_memory)
+    offset = 0
+    for array in host_arrays:
+        packed[offset:offset + len(array)] = torch.tensor(array, dtype=torch.long)
+        offset += len(array)
+    block_tables_host = packed[offset:].view(num_seqs, max_num_blocks)
+    for idx, block_table in enumerate(temp_block_table_list):
+        block_tables_host[idx, :len(block_table)] = torch.tensor(
+            block_table, dtype=torch.long)
+    packed = packed.to(device, non_blocking=True)
+    (kept_start_dev, query_lens_dev, query_start_loc_dev, context_lens_dev,
+     selected_token_indices_dev, block_tables_dev) = \
+        torch.split(packed, array_lens)
+
+    # Indices of the kept tokens in the original input, built on device:
+    # the i-th token of sequence j is at kept_start[j] + (i - query_start_loc[j])
+    num_kept_tokens = last_query_start_loc
+    kept_token_indices_dev = torch.arange(
+        num_kept_tokens, dtype=torch.long, device=packed.device) + \
+        torch.repeat_interleave(
+            kept_start_dev - query_start_loc_dev[:-1],
+            query_lens_dev,
+            output_size=num_kept_tokens)
+
+    attn_metadata = model_input.attn_metadata
+    # rebuilt attn_metadata
+    rebuilt_attn_metadata = dataclasses.replace(
+        attn_metadata,
+        num_prefills=rebuilt_num_prefills,
+        num_prefill_tokens=rebuilt_num_prefill_tokens,
+        slot_mapping=slot_mapping_flat.index_select(0, kept_token_indices_dev),
+        max_query_len=rebuilt_max_query_len,
+        block_tables=block_tables_dev.view(num_seqs, max_num_blocks).to(
+            attn_metadata.block_tables.dtype),
+        query_start_loc=query_start_loc_dev.to(
+            attn_metadata.query_start_loc.dtype),
+        context_lens_tensor=context_lens_dev.to(
+            attn_metadata.context_lens_tensor.dtype),
+        _cached_prefill_metadata=None,
+        _cached_decode_metadata=None,
+    )
+    if hasattr(attn_metadata, "blend_metadata"):
+        setattr(rebuilt_attn_metadata, "blend_metadata",
+                attn_metadata.blend_metadata)
 
-    rebuilt_attn_metadata._cached_prefill_metadata = None
     rebuilt_sampling_metadata = None
     # rebuilt sampling_metadata
-    if model_input.sampling_metadata is not None:
-        rebuilt_sampling_metadata = deepcopy(model_input.sampling_metadata)
-        for idx, q_len in enumerate(rebuilt_query_lens):
-            if rebuilt_sampling_metadata.seq_groups is not None:
-                rebuilt_sampling_metadata.seq_groups[idx].query_len = q_len
-
-        rebuilt_sampling_metadata.selected_token_indices = torch.tensor(
-            rebuilt_selected_token_indices,
-            dtype=model_input.sampling_metadata.selected_token_indices.dtype,
-        ).to(device)
+    sampling_metadata = model_input.sampling_metadata
+    if sampling_metadata is not None:
+        rebuilt_sampling_metadata = copy.copy(sampling_metadata)
+        if sampling_metadata.seq_groups is not None:
+            rebuilt_seq_groups = list(sampling_metadata.seq_groups)
+            for idx, q_len in enumerate(rebuilt_query_lens):
+                # A prompt group has a single sequence
+                if not is_prefill_list[idx]:
+                    continue
+                seq_group_idx = seq_group_idx_list[idx]
+                rebuilt_seq_groups[seq_group_idx] = dataclasses.replace(
+                    rebuilt_seq_groups[seq_group_idx], query_len=q_len)
+            rebuilt_sampling_metadata.seq_groups = rebuilt_seq_groups
+
+        rebuilt_sampling_metadata.selected_token_indices = \
+            selected_token_indices_dev.to(
+                sampling_metadata.selected_token_indices.dtype)
 
     # import here to avoid circular import.
     from vllm.worker.model_runner import (
         ModelInputForGPUWithSamplingMetadata)
     rebuilt_model_input = ModelInputForGPUWithSamplingMetadata(
-        input_tokens=torch.cat(rebuilt_input_tokens).to(device),
-        input_positions=torch.cat(rebuilt_input_positions).to(device),
+        input_tokens=model_input.input_tokens.index_select(
+            0, kept_token_indices_dev),
+        input_positions=model_input.input_positions.index_select(
+            0, kept_token_indices_dev),
         seq_lens=model_input.seq_lens,
         query_lens=rebuilt_query_lens,
         lora_mapping=model_input.lora_mapping,
@@ -16,12 +16,20 @@ from lmcache_vllm.vllm_adapter import (lmcache_get_config,
         init_lmcache_engine, lmcache_should_store, lmcache_should_retrieve,
         lmcache_store_kv, lmcache_retrieve_kv, close_lmcache_engine,
         broadcast_seq_group_metadata, lmcache_blend_drop_spt,
-        lmcache_remove_request_id_indices, StoreStatus, RetrieveStatus,
-        SUPPORTED_MODELS)
+        lmcache_remove_request_id_indices, lmcache_free_finished_requests,
+        lmcache_prefetch, lmcache_cancel_prefetch, get_waiting_policy,
+        lmcache_begin_forward, lmcache_end_forward,
+        StoreStatus, RetrieveStatus, SUPPORTED_MODELS)
 from lmcache_vllm.blend_adapter import attach_blend_prompt_indices
+from lmcache_vllm.layerwise_injection import finish_layerwise_injection
+from lmcache_vllm.model_layout import resolve_model_input_subset
+from lmcache_vllm.lmcache_utils import get_env_flag
+from lmcache_vllm.stat_logger import LMCacheStatLogger
+from lmcache_vllm.tracing import trace_span, trace_step_begin, trace_step_end
 
-from lmcache_vllm.models.llama import inject_llama
+from lmcache_vllm.models.rope_decoder import inject_rope_decoders
 from lmcache_vllm.attention.flash_attn import inject_flash_attn
+from lmcache_vllm.attention.torch_sdpa import inject_sdpa_attn
 
 from lmcache.logging import init_logger
 logger = init_logger(__name__)
@@ -39,17 +47,22 @@ def new_execute_model(
 
     # TODO(Jiayi): broadcast the necessary `seq_group_metadata` in every model
     # execution. Maybe there's a more efficient way.
-    model_input = broadcast_seq_group_metadata(model_input, self.is_driver_worker)
+    with trace_span("broadcast"):
+        model_input = broadcast_seq_group_metadata(model_input, self.is_driver_worker)
+    lmcache_free_finished_requests(model_input.finished_requests_ids)
     
     # LMCache retrieval
-    retrieve_status = lmcache_should_retrieve(model_input, kv_caches)
+    with trace_span("should_retrieve"):
+        retrieve_status = lmcache_should_retrieve(model_input, kv_caches)
     is_skip = False
-    if retrieve_status != RetrieveStatus.NONE:
-        logger.info(f"KV cache retrieving mode: {retrieve_status}")
-        model_input, is_skip = lmcache_retrieve_kv(
-            self.model, self.model_config.model, model_input, kv_caches, retrieve_status)
+    if any([status != RetrieveStatus.NONE for status in retrieve_status]):
+        logger.debug(f"KV cache retrieving mode: {retrieve_status}")
+        with trace_span("retrieve"):
+            model_input, is_skip = lmcache_retrieve_kv(
+                self.model, model_input, kv_caches, retrieve_status)
         if is_skip:
             logger.debug("Prefill is entirely skipped")
+            finish_layerwise_injection()
             
             # Create a dummy hiddens_states
             num_tok = len(model_input.input_tokens)
@@ -60,8 +73,6 @@ def new_execute_model(
                 dtype=self.model.model.embed_tokens.weight.dtype)
             
     
-    # TODO(Jiayi): Currently, we do not handle the last chunk in chunk prefill
-    
     if num_steps > 1:
         raise ValueError("num_steps > 1 is not supported in ModelRunner")
  
@@ -107,26 +118,35 @@ def new_execute_model(
         model_forward_start.record()
 
     if not is_skip:
-        hidden_or_intermediate_states = model_executable(
-            input_ids=model_input.input_tokens,
-            positions=model_input.input_positions,
-            kv_caches=kv_caches,
-            attn_metadata=model_input.attn_metadata,
-            intermediate_tensors=intermediate_tensors,
-            **MultiModalInputs.as_kwargs(multi_modal_kwargs,
-                                        device=self.device),
-            **seqlen_agnostic_kwargs)
+        lmcache_begin_forward(model_input, self.device)
+        with trace_span("forward",
+                        num_tokens=len(model_input.input_tokens)):
+            hidden_or_intermediate_states = model_executable(
+                input_ids=model_input.input_tokens,
+                positions=model_input.input_positions,
+                kv_caches=kv_caches,
+                attn_metadata=model_input.attn_metadata,
+                intermediate_tensors=intermediate_tensors,
+                **MultiModalInputs.as_kwargs(multi_modal_kwargs,
+                                            device=self.device),
+                **seqlen_agnostic_kwargs)
+
+            # Inject the layers not reached by the layerwise retrieval hooks
+            finish_layerwise_injection()
+        lmcache_end_forward()
 
         if (self.observability_config is not None
                 and self.observability_config.collect_model_forward_time):
             model_forward_end.record()
 
         # LMCache storing
-        store_status = lmcache_should_store(model_input, kv_caches)
+        with trace_span("should_store"):
+            store_status = lmcache_should_store(model_input, kv_caches)
         if any([status != StoreStatus.NONE for status in store_status]):
-            logger.info(f"KV cache saving mode: {store_status}")
-            lmcache_store_kv(model_executable, model_input, self.cache_config,
-                            kv_caches, store_status)
+            logger.debug(f"KV cache saving mode: {store_status}")
+            with trace_span("store"):
+                lmcache_store_kv(self.model, model_input, self.cache_config,
+                                kv_caches, store_status)
 
     # CacheBlend updates
     if lmcache_get_config().enable_blending and \
@@ -209,6 +229,23 @@ def new_execute_model(
  
     return [output]
 
+original_load_model = None
+def new_load_model(self) -> None:
+    """Resolve the LMCache layout of the model once it is loaded, so that
+    the layers are not looked up in every step.
+    """
+    original_load_model(self)
+    resolve_model_input_subset(self.model)
+
+def traced_execute_model(self, *args, **kwargs):
+    """Count the steps of the model runner for the trace window.
+    """
+    trace_step_begin()
+    try:
+        return new_execute_model(self, *args, **kwargs)
+    finally:
+        trace_step_end()
+
 def _patch_padding_space(
     tokenizer_id: str,
     prompt: str,
@@ -334,6 +371,17 @@ def new_free_finished_seqs(self, seq_group) -> None:
             self.free_seq(seq)
     if seq_group.is_finished():
         lmcache_remove_request_id_indices(seq_group.request_id)
+        lmcache_cancel_prefetch([seq_group.request_id])
+
+original_schedule = None
+def new_schedule(self):
+    """Reorder the waiting queue by the uncached prefill work of each
+    request before vLLM schedules it.
+    """
+    waiting_policy = get_waiting_policy()
+    if waiting_policy is not None:
+        self.waiting = waiting_policy.reorder(self.waiting)
+    return original_schedule(self)
 
 
 def new_asdict_zerocopy(self,
@@ -394,6 +442,43 @@ async def new_extract_prompt_components_async(
     prompt_token_ids = lmcache_blend_drop_spt(request_id, prompt_token_ids)
     return prompt, prompt_token_ids, multi_modal_data
 
+original_prefetch_extract_prompt_components = None
+original_prefetch_extract_prompt_components_async = None
+
+def prefetch_extract_prompt_components(self,
+                                       inputs,
+                                       request_id,
+                                       lora_request = None):
+    """Start prefetching the KV of a request as soon as its prompt is
+    tokenized, while it waits in the queue.
+    """
+    prompt, prompt_token_ids, multi_modal_data = \
+        original_prefetch_extract_prompt_components(
+            self, inputs, request_id, lora_request)
+    lmcache_prefetch(request_id, prompt_token_ids)
+    return prompt, prompt_token_ids, multi_modal_data
+
+async def prefetch_extract_prompt_components_async(
+        self,
+        inputs,
+        request_id,
+        lora_request = None,
+    ):
+    prompt, prompt_token_ids, multi_modal_data = \
+        await original_prefetch_extract_prompt_components_async(
+            self, inputs, request_id, lora_request)
+    lmcache_prefetch(request_id, prompt_token_ids)
+    return prompt, prompt_token_ids, multi_modal_data
+
+original_abort_request = None
+def new_abort_request(self, request_id) -> None:
+    """Cancel the prefetch of the aborted requests.
+    """
+    original_abort_request(self, request_id)
+    if isinstance(request_id, str):
+        request_id = [request_id]
+    lmcache_cancel_prefetch(request_id)
+
 original_llm_engine_init = None
 from vllm.inputs import INPUT_REGISTRY, InputRegistry
 from vllm.usage.usage_lib import UsageContext
@@ -436,6 +521,15 @@ def new_llm_engine_init(
                              input_registry,
                              use_cached_outputs)
     init_lmcache_engine(model_config, parallel_config, cache_config)
+    # Fail on an unknown scheduling policy before the first step
+    get_waiting_policy()
+
+    # Export the LMCache metrics along with vLLM's
+    if log_stats and "lmcache" not in self.stat_loggers:
+        from vllm.engine.llm_engine import _LOCAL_LOGGING_INTERVAL_SEC
+        self.add_logger("lmcache", LMCacheStatLogger(
+            local_interval=_LOCAL_LOGGING_INTERVAL_SEC,
+            labels=dict(model_name=model_config.served_model_name)))
 
 def inject_blend():
     import vllm.attention.backends.abstract
@@ -453,6 +547,26 @@ def inject_blend():
     vllm.inputs.preprocess.InputPreprocessor._extract_prompt_components = new_extract_prompt_components
     vllm.inputs.preprocess.InputPreprocessor._extract_prompt_components_async = new_extract_prompt_components_async
 
+def inject_prefetch():
+    # Wraps the prompt extraction after CacheBlend so that the prefetched
+    # tokens are the ones that are retrieved
+    import vllm.inputs.preprocess
+    global original_prefetch_extract_prompt_components
+    global original_prefetch_extract_prompt_components_async
+    original_prefetch_extract_prompt_components = \
+        vllm.inputs.preprocess.InputPreprocessor._extract_prompt_components
+    original_prefetch_extract_prompt_components_async = \
+        vllm.inputs.preprocess.InputPreprocessor._extract_prompt_components_async
+    vllm.inputs.preprocess.InputPreprocessor._extract_prompt_components = \
+        prefetch_extract_prompt_components
+    vllm.inputs.preprocess.InputPreprocessor._extract_prompt_components_async = \
+        prefetch_extract_prompt_components_async
+
+    import vllm.engine.llm_engine
+    global original_abort_request
+    original_abort_request = vllm.engine.llm_engine.LLMEngine.abort_request
+    vllm.engine.llm_engine.LLMEngine.abort_request = new_abort_request
+
 
 def InitLMCacheEnvironment() -> None:
     """Initialize the LMCache environment.
@@ -463,7 +577,10 @@ def InitLMCacheEnvironment() -> None:
     vllm.engine.llm_engine.LLMEngine.__init__ = new_llm_engine_init
     
     import vllm.worker.model_runner 
-    vllm.worker.model_runner.ModelRunner.execute_model = new_execute_model
+    vllm.worker.model_runner.ModelRunner.execute_model = traced_execute_model
+    global original_load_model
+    original_load_model = vllm.worker.model_runner.ModelRunner.load_model
+    vllm.worker.model_runner.ModelRunner.load_model = new_load_model
 
     import vllm.engine.async_llm_engine
     vllm.engine.async_llm_engine._log_task_completion = new_log_task_completion
@@ -479,6 +596,9 @@ def InitLMCacheEnvironment() -> None:
 
     import vllm.core.scheduler
     vllm.core.scheduler.Scheduler._free_finished_seqs = new_free_finished_seqs
+    global original_schedule
+    original_schedule = vllm.core.scheduler.Scheduler._schedule
+    vllm.core.scheduler.Scheduler._schedule = new_schedule
     
     import vllm
     vllm.inputs.preprocess.InputPreprocessor._tokenize_prompt = _new_tokenize_prompt
@@ -486,6 +606,11 @@ def InitLMCacheEnvironment() -> None:
     
     # Cacheblend
     if lmcache_get_config().enable_blending:
-        inject_llama()
+        inject_rope_decoders()
         inject_flash_attn()
-        inject_blend()
\ No newline at end of file
+        inject_sdpa_attn()
+        inject_blend()
+
+    # KV prefetching at request arrival
+    if get_env_flag("LMCACHE_PREFETCH"):
+        inject_prefetch()
\ No newline at end of file